@@ -0,0 +1,34 @@
+"""
+Demonstration webhook for testing the forwarding of received SMS messages.
+Set the webhook URL in the settings dialog to http://localhost:8080/ then run
+this script to print each message that the gateway forwards.
+"""
+import BaseHTTPServer
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+class WebhookHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    # Keep the connection open between requests, as the gateway does
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+
+        # Read & decode the forwarded message
+        body = self.rfile.read(int(self.headers.getheader('Content-Length', 0)))
+        message = json.loads(body)
+        print 'Message %d from %s: %s' % (message['id'], message['sender'], message['message'])
+
+        # Any 2xx response tells the gateway that the message was accepted.
+        # Other responses (or no response) make the gateway try again later.
+        self.send_response(204)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+# Start the server
+server = BaseHTTPServer.HTTPServer(('', 8080), WebhookHandler)
+print 'Listening for messages on port 8080...'
+server.serve_forever()
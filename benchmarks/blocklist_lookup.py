@@ -0,0 +1,65 @@
+"""
+Benchmark of the blocklist (see blocklist.py): compiling a text file of
+random numbers, mapping the compiled file & looking numbers up. The text
+file is written to a temporary directory, which is removed afterwards.
+
+Usage: python benchmarks/blocklist_lookup.py [numbers]
+"""
+
+# Standard library modules
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+# Local application modules
+import blocklist
+
+LOOKUPS = 100000
+
+def write_numbers(filename, count):
+    """
+    Writes the numbers in the ways they are written in a message request:
+    national, international & international without the "+".
+    """
+    random.seed(1)
+    formats = ('07%09d', '+447%09d', '447%09d', '00447%09d')
+    text_file = open(filename, 'w')
+    try:
+        for x in xrange(count):
+            text_file.write(formats[x % len(formats)] % random.randrange(10 ** 9) + '\n')
+    finally:
+        text_file.close()
+
+
+def main():
+    count = len(sys.argv) > 1 and int(sys.argv[1]) or 3000000
+    directory = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(directory, 'blocklist.txt')
+        write_numbers(filename, count)
+
+        start = time.time()
+        numbers = blocklist.Blocklist(filename)
+        numbers.load()
+        print 'Compiled %d numbers in %.2fs' % (len(numbers), time.time() - start)
+
+        start = time.time()
+        numbers = blocklist.Blocklist(filename)
+        numbers.load()
+        print 'Loaded the compiled file in %.2f ms' % ((time.time() - start) * 1000)
+
+        lookups = ['+447%09d' % random.randrange(10 ** 9) for x in xrange(LOOKUPS)]
+        start = time.time()
+        blocked = len([x for x in lookups if numbers.is_blocked(x)])
+        print '%d lookups (%d blocked) at %.1f us each' % (LOOKUPS, blocked, (time.time() - start) * 1000000 / LOOKUPS)
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
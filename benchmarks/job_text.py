@@ -0,0 +1,62 @@
+"""
+Benchmark of the work done on the text of a message request before its
+messages are queued, (see httpserver.RequestHandler.queue_job & msgstore.Job)
+for single recipient requests & for one request to many recipients. The
+work done for each message before jobs were used, (the text hashed with each
+recipient & put on one line for each message) is timed alongside.
+
+Usage: python benchmarks/job_text.py [messages]
+"""
+
+# Standard library modules
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+# Local application modules
+import duplicates
+import msgstore
+
+TEXT = 'Your appointment on Tuesday at 10:30 is confirmed. Reply STOP to opt out.\n' * 25
+
+def per_message(recipients, text):
+    for recipient in recipients:
+        duplicates.message_key(recipient, text)
+        msgstore.one_line(text)
+
+
+def single_recipient_jobs(recipients, text):
+    for recipient in recipients:
+        job = msgstore.Job(0, 1, '127.0.0.1', text)
+        duplicates.message_key(recipient, duplicates.text_key(text))
+        msgstore.Message(None, job, recipient).summary()
+
+
+def one_job(recipients, text):
+    job = msgstore.Job(0, 1, '127.0.0.1', text)
+    text_key = duplicates.text_key(text)
+    for recipient in recipients:
+        duplicates.message_key(recipient, text_key)
+        msgstore.Message(None, job, recipient).summary()
+
+
+def timed(function, *args):
+    start = time.time()
+    function(*args)
+    return (time.time() - start) * 1000
+
+
+def main():
+    count = len(sys.argv) > 1 and int(sys.argv[1]) or 10000
+    recipients = ['+4477%08d' % x for x in xrange(count)]
+    for length in (160, 1530):
+        text = TEXT[:length]
+        print '%4d characters, %d messages: per message %.1f ms, single recipient jobs %.1f ms, one job %.1f ms' % \
+            (length, count, timed(per_message, recipients, text), timed(single_recipient_jobs, recipients, text),
+             timed(one_job, recipients, text))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+"""
+Benchmark of the memory used by each queued message, measured as the growth
+of the resident set size (from /proc, so Linux only) while a request's
+messages are built & queued. "dict" builds the dictionaries that messages
+were kept as before msgstore.Message, "message" builds msgstore.Message
+objects as the HTTP server does. Each mode is run in its own process.
+
+Usage: python benchmarks/message_memory.py [dict|message] [messages]
+"""
+
+# Standard library modules
+import gc
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+# Local application modules
+import msgstore
+import tracing
+
+TEXT = 'Your appointment is confirmed for Tuesday at 10:30. Reply STOP to opt out.'
+
+def resident_size():
+    for line in open('/proc/self/status'):
+        if line.startswith('VmRSS:'):
+            return int(line.split()[1]) * 1024
+    return 0
+
+
+def dict_messages(count, received_time, received_at):
+    messages = []
+    for x in xrange(count):
+        message_data = {'time': received_time,
+                        'timestamp': time.strftime('%d/%m/%y %H:%M:%S', time.localtime(received_time)),
+                        'recipient': '+4477%08d' % x,
+                        'class': 1,
+                        'message': TEXT,
+                        'sender_ip': '192.168.0.%d' % 7,
+                        'trace': [('received', received_at), ('validated', tracing.monotonic())],
+                        'trace_start': received_time}
+        message_data['id'] = x + 1
+        message_data['queued_at'] = time.time()
+        message_data['trace'].append(('enqueued', tracing.monotonic()))
+        messages.append(message_data)
+    return messages
+
+
+def slotted_messages(count, received_time, received_at):
+    job = msgstore.Job(received_time, 1, intern('192.168.0.%d' % 7), TEXT)
+    received = ('received', received_at)
+    validated = ('validated', tracing.monotonic())
+    messages = []
+    for x in xrange(count):
+        message_data = msgstore.Message(x + 1, job, '+4477%08d' % x, None, [received, validated], received_time)
+        message_data.queued_at = time.time()
+        tracing.stage(message_data, 'enqueued')
+        messages.append(message_data)
+    return messages
+
+
+def main():
+    mode = len(sys.argv) > 1 and sys.argv[1] or 'message'
+    count = len(sys.argv) > 2 and int(sys.argv[2]) or 200000
+    build = {'dict': dict_messages, 'message': slotted_messages}[mode]
+
+    received_time = time.time()
+    received_at = tracing.monotonic()
+    gc.collect()
+    before = resident_size()
+    messages = build(count, received_time, received_at)
+    gc.collect()
+    print '%s: %.0f bytes per message' % (mode, (resident_size() - before) / float(len(messages)))
+
+
+if __name__ == '__main__':
+    main()
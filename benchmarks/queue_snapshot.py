@@ -0,0 +1,64 @@
+"""
+Benchmark of the snapshot of the send queue (see snapshot.py): writing it
+on exit, loading it on start & taking every message from the queue, as the
+sender does. The snapshot is written to a temporary directory, which is
+removed afterwards.
+
+Usage: python benchmarks/queue_snapshot.py [messages] [jobs]
+"""
+
+# Standard library modules
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+# Local application modules
+import msgstore
+import snapshot
+import util
+
+def main():
+    count = len(sys.argv) > 1 and int(sys.argv[1]) or 1000000
+    job_count = len(sys.argv) > 2 and int(sys.argv[2]) or 100
+
+    queue = util.CustomQueue()
+    message_id = 0
+    for x in xrange(job_count):
+        job = msgstore.Job(1700000000.0 + x, x % 3, intern('10.0.0.%d' % (x % 4)), 'Text of job %d\nline two' % x)
+        for y in xrange(count // job_count):
+            message_id += 1
+            queue.put(msgstore.Message(message_id, job, '+4477%08d' % message_id))
+
+    directory = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(directory, 'messages.db.queue')
+        token = snapshot.new_token()
+
+        start = time.time()
+        snapshot.write(filename, token, queue.items())
+        print 'Wrote %d messages in %.2fs (%.1f MB)' % (message_id, time.time() - start,
+                                                       os.path.getsize(filename) / 1048576.0)
+        del queue
+
+        start = time.time()
+        backlog = snapshot.load(filename, token, {})
+        queue = util.CustomQueue()
+        queue.set_backlog(backlog)
+        print 'Loaded %d messages in %.2f ms' % (queue.qsize(), (time.time() - start) * 1000)
+
+        start = time.time()
+        while not queue.empty():
+            queue.get()
+        elapsed = time.time() - start
+        print 'Took every message in %.2fs (%.1f us each)' % (elapsed, elapsed * 1000000 / message_id)
+        backlog.close()
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
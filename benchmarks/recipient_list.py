@@ -0,0 +1,47 @@
+"""
+Benchmark of checking & normalising the recipients of a message request,
+(see recipients.parse_recipients) against checking the list one character
+at a time & splitting it, as was done before the numbers were normalised.
+
+Usage: python benchmarks/recipient_list.py [recipients]
+"""
+
+# Standard library modules
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+# Local application modules
+import recipients
+
+def character_loop(recipient_list):
+    for char in recipient_list:
+        if char not in ';+0123456789':
+            raise ValueError(char)
+    return filter(None, recipient_list.split(';'))
+
+
+def timed(function, *args):
+    start = time.time()
+    function(*args)
+    return (time.time() - start) * 1000
+
+
+def main():
+    count = len(sys.argv) > 1 and int(sys.argv[1]) or 100000
+    random.seed(1)
+    national = ';'.join(['07%09d' % random.randrange(10 ** 9) for x in xrange(count)])
+    international = ';'.join(['+447%09d' % random.randrange(10 ** 9) for x in xrange(count)])
+    bare = ';'.join(['447%09d' % random.randrange(10 ** 9) for x in xrange(count)])
+
+    print '%d recipients: character loop %.1f ms' % (count, timed(character_loop, national))
+    for name, recipient_list in (('national', national), ('international', international), ('without "+"', bare)):
+        print '%d recipients (%s): parse_recipients %.1f ms' % \
+            (count, name, timed(recipients.parse_recipients, recipient_list))
+
+
+if __name__ == '__main__':
+    main()
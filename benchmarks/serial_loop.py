@@ -0,0 +1,160 @@
+"""
+Benchmark of the serial I/O loop (see serialloop.py) driving many modems at
+once. Each modem is simulated on a pseudo terminal by a second process, which
+answers every command with OK & every AT+CMGS with a prompt & a message
+reference. Every channel sends messages back to back & the time & CPU taken
+by this process are printed.
+
+Usage: python benchmarks/serial_loop.py [modems] [messages per modem]
+
+This only runs on POSIX systems, as it needs pseudo terminals & fork.
+"""
+
+# Standard library modules
+import os
+import resource
+import select
+import sys
+import threading
+import time
+import tty
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+# Local application modules
+import modem
+import serialloop
+
+RECIPIENT = '+447700900123'
+MESSAGE = 'Hello from the gateway'
+
+def simulate_modems(fds):
+    """
+    Answers the commands written to the master side of each pseudo terminal
+    until they have all been closed.
+    """
+    states = dict([(fd, {'input': '', 'output': '', 'data': False, 'reference': 0}) for fd in fds])
+    fds = list(fds)
+    while fds:
+        writable = [fd for fd in fds if states[fd]['output']]
+        readable, writable, errors = select.select(fds, writable, [])
+        for fd in writable:
+            state = states[fd]
+            state['output'] = state['output'][os.write(fd, state['output']):]
+        for fd in readable:
+            try:
+                data = os.read(fd, 4096)
+            except OSError:
+                data = ''
+            if not data:
+                fds.remove(fd)
+                continue
+            state = states[fd]
+            state['input'] += data
+            while True:
+                if state['data']:
+
+                    # The text of a message, which ends with Ctrl-Z
+                    if '\x1a' not in state['input']:
+                        break
+                    text, state['input'] = state['input'].split('\x1a', 1)
+                    state['data'] = False
+                    state['reference'] = (state['reference'] + 1) % 256
+                    state['output'] += '\r\n+CMGS: %d\r\n\r\nOK\r\n' % state['reference']
+                    continue
+                if '\r' not in state['input']:
+                    break
+                command, state['input'] = state['input'].split('\r', 1)
+                if command.startswith('AT+CMGS'):
+                    state['data'] = True
+                    state['output'] += '\r\n> '
+                else:
+                    state['output'] += '\r\nOK\r\n'
+
+
+class Port(object):
+    """
+    The slave side of a pseudo terminal, standing in for a serial.Serial.
+    """
+    def __init__(self, fd):
+        self.fd = fd
+        self.port = os.ttyname(fd)
+
+    def fileno(self):
+        return self.fd
+
+    def flushInput(self):
+        pass
+
+    def close(self):
+        os.close(self.fd)
+
+
+def main():
+    modem_count = len(sys.argv) > 1 and int(sys.argv[1]) or 64
+    message_count = len(sys.argv) > 2 and int(sys.argv[2]) or 200
+
+    terminals = []
+    for x in range(modem_count):
+        master, slave = os.openpty()
+        tty.setraw(slave)
+        terminals.append((master, slave))
+
+    pid = os.fork()
+    if pid == 0:
+        for master, slave in terminals:
+            os.close(slave)
+        simulate_modems([master for master, slave in terminals])
+        os._exit(0)
+    for master, slave in terminals:
+        os.close(master)
+
+    loop = serialloop.SerialLoop()
+    loop.setDaemon(True)
+    loop.start()
+
+    finished = threading.Event()
+    remaining = [modem_count]
+
+    def send_messages(channel):
+        sent = [0]
+
+        def send_next(command=None):
+            if command is not None:
+                if command.result != 'OK':
+                    print 'A message failed on %s: %r' % (channel.serial_conn.port, command.result)
+                sent[0] += 1
+                if sent[0] == message_count:
+                    remaining[0] -= 1
+                    if not remaining[0]:
+                        finished.set()
+                    return
+            channel.submit(modem.Command('AT+CMGS="%s"' % RECIPIENT, MESSAGE), 10, send_next)
+        send_next()
+
+    channels = []
+    for master, slave in terminals:
+        channel = serialloop.Channel(loop, Port(slave))
+        channel.open()
+        channels.append(channel)
+
+    start_usage = resource.getrusage(resource.RUSAGE_SELF)
+    start = time.time()
+    for channel in channels:
+        send_messages(channel)
+    finished.wait(300)
+    elapsed = time.time() - start
+    end_usage = resource.getrusage(resource.RUSAGE_SELF)
+    cpu = (end_usage.ru_utime - start_usage.ru_utime) + (end_usage.ru_stime - start_usage.ru_stime)
+
+    print '%d modems x %d messages: %.2fs wall, %.2fs CPU, %d messages/s, %d threads' % \
+        (modem_count, message_count, elapsed, cpu, modem_count * message_count / elapsed, threading.activeCount())
+
+    for channel in channels:
+        channel.close()
+    os.kill(pid, 9)
+    os.waitpid(pid, 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,300 @@
+"""
+Module containing the blocklist of numbers that have opted out of receiving
+messages, (i.e. by replying STOP). Messages to these numbers are dropped
+before they are queued.
+
+The blocklist is kept as a text file with one number per line, written in
+any of the ways accepted in a message request. Other lines, (i.e. comments)
+are ignored. It is compiled to a binary file alongside it ("<blocklist>.bin")
+holding the numbers as sorted 64-bit integers, which is memory mapped &
+binary searched, so a list of millions of numbers is ready as soon as the
+application starts & only the pages that are searched are read from the
+disk. The text file is only read again when it changes.
+"""
+
+# Standard library modules
+import itertools
+import mmap
+import os
+import re
+import string
+import struct
+import threading
+import time
+
+# Local application modules
+import recipients
+
+# The header of the compiled file: a magic string, the size & modification
+# time of the text file it was compiled from, the country code used for
+# national numbers & the number of numbers that follow
+HEADER = struct.Struct('<8sQd3sxQ')
+MAGIC = 'SMSGWBL1'
+
+# Each number in the compiled file, (see "number_key")
+NUMBER_RECORD = struct.Struct('<Q')
+
+# How often (in seconds) the text file is checked for changes
+CHECK_INTERVAL = 5
+
+# A line of the text file (once the whitespace has been removed) that holds
+# a number, as (prefix, digits). Numbers without a prefix are international
+# numbers written without the "+" or short codes.
+NUMBER_LINE_RE = re.compile(r'^(\+|00|0)?([0-9]{1,%d})$' % recipients.MAX_DIGITS, re.M)
+
+# A translation table that leaves the characters unchanged, used to delete
+# the whitespace from the text file
+IDENTITY_TABLE = string.maketrans('', '')
+
+def compiled_name(filename):
+    return filename + '.bin'
+
+
+def number_key(number):
+    """
+    Returns the integer that a normalised international number is stored as
+    (its digits), or None for other numbers, (i.e. short codes) which cannot
+    opt out. A number without a "+" that is longer than a short code is
+    international, (see recipients.normalise) so it cannot get past the
+    blocklist by being written without the "+".
+    """
+    if number.startswith('+'):
+        number = number[1:]
+    elif len(number) <= recipients.MAX_SHORT_CODE_DIGITS:
+        return None
+    if number.isdigit():
+        return int(number)
+    return None
+
+
+class SortedNumbers(object):
+    """
+    Read-only view of the numbers in a compiled blocklist, which are binary
+    searched. The data can be a memory map of the file or a string.
+    """
+    def __init__(self, data, count, source=None, short_codes=0):
+        self.data = data
+        self.count = count
+        self.source = source
+
+        # The number of lines of the text file that were short codes, which
+        # are not compiled
+        self.short_codes = short_codes
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, key):
+        low, high = 0, self.count
+        offset = HEADER.size
+        size = NUMBER_RECORD.size
+        while low < high:
+            middle = (low + high) // 2
+            value = NUMBER_RECORD.unpack_from(self.data, offset + middle * size)[0]
+            if value < key:
+                low = middle + 1
+            elif value > key:
+                high = middle
+            else:
+                return True
+        return False
+
+
+def source_info(filename, country_code):
+    """
+    Returns the (size, modification time, country code) that a compiled file
+    must match to be up to date with the text file.
+    """
+    stat = os.stat(filename)
+    return stat.st_size, stat.st_mtime, country_code
+
+
+def open_compiled(filename, source):
+    """
+    Returns a SortedNumbers for the compiled blocklist, memory mapped, or
+    None if there is no compiled file or it is out of date.
+    """
+    try:
+        compiled_file = open(compiled_name(filename), 'rb')
+    except IOError:
+        return None
+    try:
+        header = compiled_file.read(HEADER.size)
+        if len(header) < HEADER.size:
+            return None
+        magic, size, mtime, country_code, count = HEADER.unpack(header)
+        if magic != MAGIC or (size, mtime, country_code.rstrip('\0')) != source:
+            return None
+        if os.path.getsize(compiled_name(filename)) != HEADER.size + count * NUMBER_RECORD.size:
+            return None
+        data = mmap.mmap(compiled_file.fileno(), 0, access=mmap.ACCESS_READ)
+        return SortedNumbers(data, count, source)
+    finally:
+        compiled_file.close()
+
+
+def compile_blocklist(filename, source):
+    """
+    Reads the text file & returns a SortedNumbers holding the numbers in it.
+    The compiled data is written to the compiled file (through a temporary
+    file that is renamed over it) so that it can be mapped next time.
+
+    The numbers are normalised in the same way as the recipients of a
+    message request, (see recipients.normalise) but the whole file is
+    matched at once with a regular expression rather than line by line.
+    Lines that are not numbers are skipped, as are short codes, which are
+    counted so that they can be reported.
+    """
+    country_code = source[2]
+    text = open(filename, 'rU').read().translate(IDENTITY_TABLE, ' \t')
+    numbers = NUMBER_LINE_RE.findall(text)
+    bare = [digits for prefix, digits in numbers if not prefix]
+    international = [digits for digits in bare if len(digits) > recipients.MAX_SHORT_CODE_DIGITS]
+    short_codes = len(bare) - len(international)
+    keys = map(int, [digits for prefix, digits in numbers if prefix in ('+', '00')] +
+                    [country_code + digits for prefix, digits in numbers if prefix == '0'] +
+                    international)
+    keys.sort()
+    keys = [key for key, group in itertools.groupby(keys)]
+
+    data = HEADER.pack(MAGIC, source[0], source[1], country_code, len(keys)) + struct.pack('<%dQ' % len(keys), *keys)
+
+    temp_name = compiled_name(filename) + '.tmp'
+    try:
+        temp_file = open(temp_name, 'wb')
+        try:
+            temp_file.write(data)
+        finally:
+            temp_file.close()
+
+        # Windows cannot rename over an existing file, or remove one that is
+        # mapped, in which case the file is compiled again next time
+        if os.name == 'nt' and os.path.exists(compiled_name(filename)):
+            os.remove(compiled_name(filename))
+        os.rename(temp_name, compiled_name(filename))
+    except (IOError, OSError):
+        pass
+    return SortedNumbers(data, len(keys), source, short_codes)
+
+
+class Blocklist(object):
+    """
+    The numbers that messages must not be sent to. The text file is checked
+    for changes at most every CHECK_INTERVAL seconds when a number is looked
+    up. A changed file is compiled on a background thread while lookups carry
+    on using the old numbers, which are then swapped for the new ones in a
+    single assignment, so lookups never wait for a reload. Lookups only wait
+    for the first load, (see "start") so that no message is sent to a number
+    that has opted out.
+    """
+    def __init__(self, filename, country_code=recipients.DEFAULT_COUNTRY_CODE, load_error=None, loaded=None):
+        """
+        The "load_error" parameter is a function that is called with an error
+        message if the blocklist could not be read, & "loaded" is a function
+        that is called with the blocklist each time it has been loaded on a
+        background thread.
+        """
+        self.filename = filename
+        self.country_code = country_code
+        self.load_error = load_error
+        self.loaded = loaded
+        self.numbers = None
+        self.last_error = None
+        self.lock = threading.Lock()
+        self.loading = False
+        self.checked_at = 0
+        self.ready = threading.Event()
+
+    def __len__(self):
+        numbers = self.numbers
+        return numbers is not None and len(numbers) or 0
+
+    def start(self):
+        """
+        Loads the blocklist on a background thread, as compiling a list of
+        millions of numbers takes several seconds. Lookups wait until it has
+        loaded.
+        """
+        self.lock.acquire()
+        try:
+            self.loading = True
+        finally:
+            self.lock.release()
+
+        thread = threading.Thread(target=self.reload)
+        thread.setDaemon(True)
+        thread.start()
+
+    def load(self):
+        """
+        Loads the blocklist, compiling it if the text file has changed.
+        Returns True if different numbers were loaded.
+        """
+        self.checked_at = time.time()
+        try:
+            try:
+                source = source_info(self.filename, self.country_code)
+                numbers = self.numbers
+                if numbers is not None and numbers.source == source:
+                    return False
+                numbers = open_compiled(self.filename, source) or compile_blocklist(self.filename, source)
+            except (IOError, OSError, mmap.error), e:
+
+                # Keep using the numbers that were loaded last, & only report
+                # the error once
+                error_message = 'The blocklist (%s) could not be read: %s' % (self.filename, e)
+                if self.load_error is not None and error_message != self.last_error:
+                    self.load_error(error_message)
+                self.last_error = error_message
+                return False
+
+            # The old numbers are unmapped once the lookups using them finish
+            self.numbers = numbers
+            self.last_error = None
+            if numbers.short_codes and self.load_error is not None:
+                self.load_error('%d short codes in the blocklist (%s) were skipped, as short codes cannot be '
+                                'blocked' % (numbers.short_codes, self.filename))
+            return True
+        finally:
+            self.ready.set()
+
+    def check(self):
+        """
+        Starts a reload in the background if the text file may have changed
+        since it was last checked.
+        """
+        if time.time() - self.checked_at < CHECK_INTERVAL:
+            return
+        self.lock.acquire()
+        try:
+            if self.loading:
+                return
+            self.loading = True
+            self.checked_at = time.time()
+        finally:
+            self.lock.release()
+
+        thread = threading.Thread(target=self.reload)
+        thread.setDaemon(True)
+        thread.start()
+
+    def reload(self):
+        try:
+            changed = self.load()
+        finally:
+            self.loading = False
+        if changed and self.loaded is not None:
+            self.loaded(self)
+
+    def is_blocked(self, number):
+        """
+        Returns True if a normalised number is on the blocklist. Waits for the
+        blocklist to be loaded the first time.
+        """
+        self.ready.wait()
+        self.check()
+        numbers = self.numbers
+        if numbers is None:
+            return False
+        key = number_key(number)
+        return key is not None and key in numbers
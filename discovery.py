@@ -0,0 +1,254 @@
+"""
+Module containing classes & functions to find the serial ports on the system
+& identify the GSM modems connected to them.
+"""
+
+# Standard library modules
+import os
+import Queue
+import re
+import threading
+import time
+
+# 3rd party modules
+import serial
+
+# Local application modules
+import modem
+
+# How long (in seconds) to wait for a device to answer each probe command
+PROBE_TIMEOUT = 0.5
+
+# The maximum number of ports probed at the same time
+MAX_PROBE_THREADS = 16
+
+# How long (in seconds) the results of a scan are used for when the operating
+# system's list of ports cannot be read, so plugged in devices cannot be
+# detected from it
+CACHE_MAX_AGE = 300
+
+# The directory where Linux lists the serial devices by their hardware ID
+SERIAL_BY_ID = '/dev/serial/by-id'
+
+def os_ports():
+    """
+    Returns the operating system's list of serial port names, or None if it
+    cannot be read. pyserial's port listing is used where it is available,
+    otherwise the Linux "/dev/serial/by-id" directory.
+    """
+    try:
+        from serial.tools import list_ports
+    except ImportError:
+        pass
+    else:
+        return sorted([port[0] for port in list_ports.comports()])
+
+    if os.path.isdir(SERIAL_BY_ID):
+        return sorted([os.path.realpath(os.path.join(SERIAL_BY_ID, name)) for name in os.listdir(SERIAL_BY_ID)])
+    return None
+
+
+def port_name(com_port):
+    """
+    Returns the name of the serial port chosen in the settings, which is a
+    COM port number on Windows (i.e. 3 for "COM3") & the device name on
+    other systems, (i.e. "/dev/ttyUSB0").
+    """
+    if isinstance(com_port, (int, long)):
+        return 'COM%d' % com_port
+    return com_port
+
+
+def port_setting(port):
+    """
+    Returns the value that a port name is kept as in the settings, (see
+    "port_name").
+    """
+    match = re.match(r'COM(\d+)$', port)
+    if match:
+        return int(match.group(1))
+    return port
+
+
+def candidate_ports():
+    """
+    Returns the names of the ports to look at. If the operating system does
+    not list them then every COM port name is a candidate.
+    """
+    ports = os_ports()
+    if ports is None:
+        ports = ['COM%d' % (i + 1) for i in range(256)]
+    return ports
+
+
+def probe_port(port):
+    """
+    Opens a serial port & identifies the device on it. Returns a dictionary
+    with the keys:
+
+    "port" - the port name
+    "available" - True if the port could be opened
+    "modem" - True if a GSM modem answered on the port
+    "model" - the model of the modem (from AT+CGMM, or ATI if that fails)
+    "identity" - the serial number (IMEI) of the modem (from AT+CGSN)
+
+    Devices that do not answer "AT" within PROBE_TIMEOUT, (i.e. Bluetooth
+    serial ports with nothing connected) are given up on straight away.
+    """
+    info = {'port': port, 'available': False, 'modem': False, 'model': None, 'identity': None}
+    try:
+        serial_conn = serial.Serial(port, timeout=PROBE_TIMEOUT)
+    except (serial.SerialException, ValueError):
+        return info
+    info['available'] = True
+
+    try:
+        try:
+            if probe_command(serial_conn, 'AT') is None:
+                return info
+
+            lines = probe_command(serial_conn, 'AT+CGMM') or probe_command(serial_conn, 'ATI') or []
+            info['model'] = ' '.join(lines) or None
+            info['identity'] = modem.serial_number(probe_command(serial_conn, 'AT+CGSN') or [])
+            info['modem'] = info['identity'] is not None
+        except serial.SerialException:
+            pass
+    finally:
+        serial_conn.close()
+    return info
+
+
+def probe_command(serial_conn, command):
+    """
+    Writes a command & reads the response. Returns the information lines of
+    the response (without the echo of the command) if the device answered
+    "OK", otherwise None.
+    """
+    serial_conn.write(command + '\r')
+    response = ''
+    deadline = time.time() + PROBE_TIMEOUT
+    while time.time() < deadline:
+        response += serial_conn.read(serial_conn.inWaiting() or 1)
+        lines = [x.strip() for x in response.splitlines() if x.strip()]
+        if 'OK' in lines:
+            return [x for x in lines if x not in (command, 'OK')]
+        if 'ERROR' in lines or [x for x in lines if x.startswith('+CME ERROR')]:
+            return None
+    return None
+
+
+class PortDiscovery(object):
+    """
+    Finds the serial ports on the system & the modems connected to them. The
+    ports are probed in parallel & the results are cached. The cache is
+    invalidated by hotplug: when the operating system's list of ports
+    changes, only the ports that have appeared are probed & the ones that
+    have gone are forgotten. Where the list cannot be read the cache expires
+    after "max_age" seconds instead.
+    """
+    def __init__(self, max_age=CACHE_MAX_AGE):
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.scan_lock = threading.Lock()
+        self.results = {}
+        self.listing = None
+        self.scanned_at = None
+
+    def cached(self):
+        """
+        Returns the results of the last scan, (see "probe_port") for the ports
+        that could be opened, without probing anything.
+        """
+        self.lock.acquire()
+        try:
+            return [self.results[port] for port in sorted(self.results.keys()) if self.results[port]['available']]
+        finally:
+            self.lock.release()
+
+    def discover(self, force=False):
+        """
+        Returns the results for the ports that could be opened, probing the
+        ports whose results are not cached. "force" probes every port again.
+        Only one scan runs at a time; other callers wait for it & share the
+        results.
+        """
+        self.scan_lock.acquire()
+        try:
+            listing = os_ports()
+            if listing is None:
+                ports = candidate_ports()
+                expired = self.scanned_at is None or time.time() - self.scanned_at > self.max_age
+            else:
+                ports = listing
+                expired = False
+
+            self.lock.acquire()
+            try:
+                if force or expired:
+                    self.results = {}
+                else:
+                    for port in self.results.keys():
+                        if port not in ports:
+                            del self.results[port]
+                to_probe = [port for port in ports if port not in self.results]
+            finally:
+                self.lock.release()
+
+            results = probe_ports(to_probe)
+
+            self.lock.acquire()
+            try:
+                self.results.update(results)
+                self.listing = listing
+                if to_probe:
+                    self.scanned_at = time.time()
+            finally:
+                self.lock.release()
+        finally:
+            self.scan_lock.release()
+
+        return self.cached()
+
+    def invalidate(self, port=None):
+        """
+        Forgets the cached result for a port (or for every port), so that it
+        is probed again by the next scan.
+        """
+        self.lock.acquire()
+        try:
+            if port is None:
+                self.results = {}
+            else:
+                self.results.pop(port, None)
+        finally:
+            self.lock.release()
+
+
+def probe_ports(ports):
+    """
+    Probes several ports at once. Returns a dictionary of port name -> the
+    result of "probe_port".
+    """
+    results = {}
+    if not ports:
+        return results
+
+    port_queue = Queue.Queue()
+    for port in ports:
+        port_queue.put(port)
+
+    def worker():
+        while True:
+            try:
+                port = port_queue.get_nowait()
+            except Queue.Empty:
+                return
+            results[port] = probe_port(port)
+
+    workers = [threading.Thread(target=worker) for i in range(min(MAX_PROBE_THREADS, len(ports)))]
+    for thread in workers:
+        thread.setDaemon(True)
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return results
@@ -0,0 +1,121 @@
+"""
+Module containing a filter that suppresses repeated message requests, (i.e.
+when another system sends the same notification twice within a few seconds).
+"""
+
+# Standard library modules
+import md5
+import threading
+import time
+
+# How long (in seconds) a message to a recipient is remembered for by default
+DEFAULT_WINDOW = 60
+
+# The number of buckets that the window is split into
+BUCKETS = 6
+
+def text_key(message):
+    """
+    Returns a short key for the text of a message, which can be passed to
+    DuplicateFilter.is_duplicate instead of the text, so that a long text
+    sent to many recipients is only hashed once.
+    """
+    return md5.new(message).digest()
+
+
+def template_key(template_id, values):
+    """
+    Returns the key for a message sent with a template, which is compared by
+    its template & values so that it does not need to be rendered.
+    """
+    return '%d\0%s' % (template_id, '\0'.join(values))
+
+
+def message_key(recipient, message):
+    """
+    Returns the key that a message is remembered by: the first 8 bytes of
+    the MD5 hash of the (normalised) recipient & the text. Keeping the hash
+    rather than the text bounds the memory used by each message, & with 64
+    bits the chance of two different messages sharing a key is negligible.
+    """
+    return md5.new('%s\0%s' % (recipient, message)).digest()[:8]
+
+
+class DuplicateFilter(object):
+    """
+    Remembers the messages seen in the last "window" seconds. The window is
+    split into BUCKETS time buckets, each holding a set of message keys, &
+    whole buckets are dropped as they fall out of the window, so the memory
+    used is bounded by the number of messages received in one window however
+    many are sent in a day. A message is remembered from when it was first
+    seen for between "window" seconds & one bucket longer, as the oldest
+    bucket is only dropped once all of it is out of the window.
+
+    A window of 0 turns the filter off.
+    """
+    def __init__(self, window=DEFAULT_WINDOW, buckets=BUCKETS):
+        self.lock = threading.Lock()
+        self.bucket_count = buckets
+        self.set_window(window)
+
+    def set_window(self, window):
+        """
+        Changes the length of the window. Messages that have been seen are
+        forgotten.
+        """
+        self.lock.acquire()
+        try:
+            self.window = window
+            self.bucket_seconds = float(window) / self.bucket_count
+
+            # Keyed on the bucket number (the time divided by the length of a
+            # bucket): the set of message keys first seen in that bucket
+            self.buckets = {}
+        finally:
+            self.lock.release()
+
+    def is_duplicate(self, recipient, message, now=None):
+        """
+        Returns True if the same message has been sent to the recipient
+        within the window, otherwise remembers the message & returns False.
+        """
+        if not self.window:
+            return False
+        if now is None:
+            now = time.time()
+        key = message_key(recipient, message)
+
+        self.lock.acquire()
+        try:
+            current = int(now // self.bucket_seconds)
+            oldest = current - self.bucket_count
+            for bucket in self.buckets.keys():
+                if bucket < oldest:
+                    del self.buckets[bucket]
+
+            for keys in self.buckets.itervalues():
+                if key in keys:
+                    return True
+            try:
+                self.buckets[current].add(key)
+            except KeyError:
+                self.buckets[current] = set([key])
+            return False
+        finally:
+            self.lock.release()
+
+    def forget(self, recipient, message):
+        """
+        Forgets a message that has been seen, (i.e. because it could not be
+        sent) so that the client can send it again within the window.
+        """
+        key = message_key(recipient, message)
+        self.lock.acquire()
+        try:
+            for keys in self.buckets.itervalues():
+                keys.discard(key)
+        finally:
+            self.lock.release()
+
+    def __len__(self):
+        return sum([len(keys) for keys in self.buckets.values()])
@@ -8,33 +8,135 @@ import BaseHTTPServer
 import cgi
 import md5
 import os
+import Queue
 import socket
+import SocketServer
 import sys
+import threading
 import time
+import urlparse
 
 # Local application modules
 from sms_gateway_server import __version__, APP_NAME
+import duplicates
+import metrics
+import msgstore
+import profiler
+import recipients
+import tracing
 import util
 
-class StoppableHTTPServer(BaseHTTPServer.HTTPServer):
+# The longest time (in seconds) that a status request may wait for a change
+MAX_STATUS_WAIT = 60
+
+# The number of events that can be waiting to be sent to an "/events" client.
+# A client that falls this far behind is disconnected.
+EVENT_BUFFER_SIZE = 1000
+
+# How often (in seconds) a comment is sent to idle "/events" clients to keep
+# the connection open
+EVENT_KEEPALIVE = 15
+
+# How long (in seconds) "/api/v1/profile" profiles for, if no time is given
+DEFAULT_PROFILE_SECONDS = 10
+
+class EventStream(object):
+    """
+    Fans out gateway events to the clients connected to "/events" as
+    Server-Sent Events. Each event is serialized once & the same text is added
+    to the buffer of every subscriber. Publishing never blocks: a subscriber
+    whose buffer is full is marked as dropped & removed, and its request
+    handler then closes the connection.
+    """
+    def __init__(self, buffer_size=EVENT_BUFFER_SIZE):
+        self.buffer_size = buffer_size
+        self.lock = threading.Lock()
+        self.subscribers = []
+        self.event_id = 0
+
+    def subscribe(self):
+        """
+        Returns a new subscriber, which is a queue of serialized events with a
+        "dropped" attribute.
+        """
+        subscriber = Queue.Queue(self.buffer_size)
+        subscriber.dropped = False
+        self.lock.acquire()
+        try:
+            self.subscribers.append(subscriber)
+        finally:
+            self.lock.release()
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        self.lock.acquire()
+        try:
+            if subscriber in self.subscribers:
+                self.subscribers.remove(subscriber)
+        finally:
+            self.lock.release()
+
+    def publish(self, event_type, data):
+        """
+        Sends an event to every subscriber. The "data" is serialized as JSON.
+        """
+        if not self.subscribers:
+            return
+
+        event_text = 'event: %s\ndata: %s\n\n' % (event_type, util.json.dumps(data))
+        self.lock.acquire()
+        try:
+            self.event_id += 1
+            event_text = 'id: %d\n%s' % (self.event_id, event_text)
+            for subscriber in self.subscribers[:]:
+                try:
+                    subscriber.put_nowait(event_text)
+                except Queue.Full:
+                    subscriber.dropped = True
+                    self.subscribers.remove(subscriber)
+        finally:
+            self.lock.release()
+
+
+class StoppableHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
     """
     Subclass of BaseHTTPServer.HTTPServer to provide a stoppable HTTP server.
     This is done by setting a timeout when accepting socket connections. This
     allows the server to be arbitrarily started & stopped. (Without a timeout
     the "handle_request" method will block until a request is received)
+
+    Each request is handled in its own thread, so that requests waiting for a
+    message status change do not hold up other requests.
     """
-    def __init__(self, log_http_data, message_received, *args):
+    daemon_threads = True
+
+    # The country calling code given to national numbers, (see recipients)
+    country_code = recipients.DEFAULT_COUNTRY_CODE
+
+    # The duplicates.DuplicateFilter that repeated messages are checked
+    # against, & the blocklist.Blocklist of numbers that have opted out, if
+    # any
+    duplicate_filter = None
+    blocklist = None
+
+    def __init__(self, log_http_data, message_received, message_store, event_stream, *args):
         """
-        The "log_http_data" parameter is a function/method that is called when
-        the server logs a request. Refer to HTTPHandler.log_message to see the
-        function being used.
+        The "log_http_data" parameter is a function/method that is called with
+        a dictionary of request details when the server logs a request. Refer
+        to HTTPHandler.log_message to see the function being used.
 
         The "message_received" parameter is a function/method that is called
-        when a new message request is received. Refer to HTTPHandler.do_POST to
-        see the function being used.
+        with a job & its messages when a new message request is received.
+        Refer to HTTPHandler.queue_messages to see the function being used.
+
+        The "message_store" parameter is the msgstore.MessageStore that is
+        used to look up the status of messages. The "event_stream" parameter
+        is the EventStream that is served to "/events" clients.
         """
         self.log_http_data = log_http_data
         self.message_received = message_received
+        self.message_store = message_store
+        self.event_stream = event_stream
 
         BaseHTTPServer.HTTPServer.__init__(self, *args)
 
@@ -76,6 +178,20 @@ class StoppableHTTPServer(BaseHTTPServer.HTTPServer):
 
 
 class HTTPHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def handle_one_request(self):
+        """
+        Overrides the "handle_one_request" method to count requests & time
+        them. "/events" requests last as long as the client is connected, so
+        they are counted but not timed.
+        """
+        start_time = time.time()
+        self.path = None
+        BaseHTTPServer.BaseHTTPRequestHandler.handle_one_request(self)
+        if self.path is not None:
+            metrics.HTTP_REQUESTS.inc()
+            if self.path != '/events':
+                metrics.HTTP_REQUEST_SECONDS.observe(time.time() - start_time)
+
     def version_string(self):
         """
         Returns the server software version string.
@@ -154,6 +270,32 @@ class HTTPHandler(BaseHTTPServer.BaseHTTPRequestHandler):
                 self.end_headers()
                 self.wfile.write(response_data)
 
+        elif self.path.startswith('/api/v1/messages/'):
+            self.serve_message_status()
+
+        elif self.path == '/events':
+            self.serve_events()
+
+        elif self.path == '/metrics':
+            self.serve_metrics()
+
+        elif self.path.startswith('/api/v1/templates/'):
+            try:
+                template_id = int(self.path[len('/api/v1/templates/'):])
+            except ValueError:
+                template_id = None
+            template = self.server.message_store.get_template(template_id)
+            if template is None:
+                self.serve_json(404, {'error': 'There is no template with that ID.'})
+            else:
+                self.serve_template(template)
+
+        elif self.path == '/api/v1/traces/summary':
+            self.serve_json(200, {'steps': tracing.SUMMARY.summary()})
+
+        elif urlparse.urlsplit(self.path)[2] == '/api/v1/profile':
+            self.serve_profile()
+
         elif self.path == '/' or self.path.endswith('.html') or self.path.endswith('.htm'):
                 self.send_response(302)
                 self.send_header('Location', '/sms_sender.html')
@@ -168,7 +310,16 @@ class HTTPHandler(BaseHTTPServer.BaseHTTPRequestHandler):
         """
 
         # Get a timestamp for the request
-        timestamp = time.strftime('%d/%m/%y %H:%M:%S')
+        received_at = tracing.monotonic()
+        received_time = time.time()
+
+        path = urlparse.urlsplit(self.path)[2]
+        if path == '/api/v1/templates':
+            self.create_template()
+            return
+        if path.startswith('/api/v1/templates/') and path.endswith('/messages'):
+            self.send_template_messages(path, received_time, received_at)
+            return
 
         # Redirect any POST request that does not match the current URL
         if not self.path == '/send_message':
@@ -186,7 +337,7 @@ class HTTPHandler(BaseHTTPServer.BaseHTTPRequestHandler):
             # Get the form data
             post_data = cgi.parse_qs(self.rfile.read(content_length))
             try:
-                recipients = post_data['recipients'][0]
+                recipient_data = post_data['recipients'][0]
                 message = post_data['message'][0]
             except KeyError, IndexError:
                 self.serve_message(400, 'Error', 'The message request was missing either recipient or message data.')
@@ -201,11 +352,16 @@ class HTTPHandler(BaseHTTPServer.BaseHTTPRequestHandler):
             except KeyError, IndexError:
                 msg_class = '1'
 
-            # Validate the recipient data
-            for char in recipients:
-                if char not in ';+0123456789 \t':
-                    self.serve_message(400, 'Error', 'The recipient data contains an invalid character ("%s").' % char)
-                    return
+            # Validate the recipient data & get the list of recipients,
+            # normalised to international format & without duplicates
+            try:
+                recipient_list = recipients.parse_recipients(recipient_data, self.server.country_code)
+            except ValueError, e:
+                self.serve_message(400, 'Error', str(e))
+                return
+            if not recipient_list:
+                self.serve_message(400, 'Error', 'The message request has no recipients.')
+                return
 
             # Validate the SMS class data
             try:
@@ -217,24 +373,313 @@ class HTTPHandler(BaseHTTPServer.BaseHTTPRequestHandler):
                 self.serve_message(400, 'Error', 'The SMS class can only be either 0, 1 or 2.')
                 return
 
-            # Get a list of recipients from the recipient string
-            recipient_list = [x.strip() for x in recipients.split(';') if x]
+            self.queue_messages([(x, None) for x in recipient_list], msg_class, received_time, received_at, message=message)
+
+    def create_template(self):
+        """
+        Stores a new message template, for POST requests to
+        "/api/v1/templates" with a JSON object holding the template "body",
+        (i.e. "Hi {name}, your code is {code}"). The template's ID & fields are
+        served as JSON.
+        """
+        try:
+            body = util.utf8(self.read_json()['body'])
+        except (ValueError, KeyError, TypeError):
+            self.serve_json(400, {'error': 'The request must be a JSON object with the template "body".'})
+            return
+        if not body:
+            self.serve_json(400, {'error': 'The template body is empty.'})
+            return
+
+        template = self.server.message_store.add_template(body)
+        self.serve_template(template)
+
+    def send_template_messages(self, path, received_time, received_at):
+        """
+        Queues a message for each row of a table of recipients, for POST
+        requests to "/api/v1/templates/<id>/messages". The request is a JSON
+        object with the "columns" of the table (a "recipient" column & one
+        for each field of the template), the "rows" & optionally the SMS
+        "class". The messages hold the template & their row's values, & are
+        rendered when they are sent.
+        """
+        try:
+            template_id = int(path[len('/api/v1/templates/'):-len('/messages')])
+        except ValueError:
+            template_id = None
+        template = self.server.message_store.get_template(template_id)
+        if template is None:
+            self.serve_json(404, {'error': 'There is no template with that ID.'})
+            return
+
+        try:
+            request_data = self.read_json()
+            columns = list(request_data['columns'])
+            rows = list(request_data['rows'])
+            msg_class = request_data.get('class', 1)
+        except (ValueError, KeyError, TypeError, AttributeError):
+            self.serve_json(400, {'error': 'The request must be a JSON object with the "columns" & "rows" of a table of recipients.'})
+            return
+
+        if 'recipient' not in columns:
+            self.serve_json(400, {'error': 'The table has no "recipient" column.'})
+            return
+        try:
+            positions = template.columns(columns)
+        except ValueError, e:
+            self.serve_json(400, {'error': str(e)})
+            return
+        if msg_class not in (0, 1, 2):
+            self.serve_json(400, {'error': 'The SMS class can only be either 0, 1 or 2.'})
+            return
+
+        # Validate the recipients & normalise them to international format
+        recipient_column = columns.index('recipient')
+        try:
+            numbers = recipients.normalise_recipients(';'.join([util.utf8(row[recipient_column]) for row in rows]),
+                                                      self.server.country_code)
+            if len(numbers) != len(rows) or '' in numbers:
+                raise ValueError('Each row must have a single recipient.')
+
+            # Keep the first row for each recipient
+            seen = set()
+            recipient_values = []
+            for number, row in zip(numbers, rows):
+                if number not in seen:
+                    seen.add(number)
+                    recipient_values.append((number, tuple([util.utf8(row[x]) for x in positions])))
+        except (IndexError, TypeError, KeyError):
+            self.serve_json(400, {'error': 'Each row must have a value for every column.'})
+            return
+        except ValueError, e:
+            self.serve_json(400, {'error': str(e)})
+            return
+
+        if not recipient_values:
+            self.serve_json(400, {'error': 'The message request has no recipients.'})
+            return
+
+        self.queue_messages(recipient_values, msg_class, received_time, received_at, template=template)
+
+    def queue_messages(self, recipient_values, msg_class, received_time, received_at, message=None, template=None):
+        """
+        Passes the request to the server to be queued as a job, with a message
+        for each recipient, then serves the IDs of the queued messages.
+        "recipient_values" is a list of (recipient, values) where values is
+        the tuple of template field values if a template is used, otherwise
+        None.
+
+        The text is only worked on once for the whole job, (see msgstore.Job)
+        so the work done for each recipient does not grow with the length of
+        the text.
+        """
+        job = msgstore.Job(received_time, msg_class, intern(self.client_address[0]), message, template)
+        if template is None:
+            text_key = duplicates.text_key(message)
+
+        # The stages that every message of the request starts with are shared
+        # by the messages, rather than copied
+        received = ('received', received_at)
+        validated = ('validated', tracing.monotonic())
+
+        messages = []
+        suppressed = []
+        blocked = []
+        for recipient, values in recipient_values:
+
+            # Numbers that have opted out are never sent to
+            blocklist = self.server.blocklist
+            if blocklist is not None and blocklist.is_blocked(recipient):
+                metrics.MESSAGES_BLOCKED.inc()
+                blocked.append(recipient)
+                continue
+
+            # Repeats of a message that was sent to the recipient a moment ago
+            # are dropped rather than queued. Template messages are compared
+            # by their template & values, without rendering them.
+            duplicate_filter = self.server.duplicate_filter
+            if duplicate_filter is not None:
+                if template is not None:
+                    text_key = duplicates.template_key(template.id, values)
+                if duplicate_filter.is_duplicate(recipient, text_key):
+                    metrics.MESSAGES_SUPPRESSED.inc()
+                    suppressed.append(recipient)
+                    continue
+
+            messages.append(msgstore.Message(None, job, recipient, values, [received, validated], received_time))
+
+        if messages:
+            self.server.message_received(job, messages)
+        queued = [{'id': x.id, 'recipient': x.recipient} for x in messages]
+
+        # Reply with the IDs of the queued messages, which can be used to look
+        # up their status, & the recipients whose message was a repeat or who
+        # have opted out
+        if self.wants_json() or template is not None:
+            self.serve_json(200, {'messages': queued, 'suppressed': suppressed, 'blocked': blocked})
+        else:
+            response_text = []
+            if queued:
+                response_text.append('Your message(s) have been added to the queue to be sent. Message ID(s): %s.' % ', '.join([str(x['id']) for x in queued]))
+            if suppressed:
+                response_text.append('The same message was sent to %s moments ago, so it has not been sent again.' % ', '.join(suppressed))
+            if blocked:
+                response_text.append('The message has not been sent to %s, as they have opted out of receiving messages.' % ', '.join(blocked))
+            self.serve_message(200, 'Message(s) Queued', ' '.join(response_text))
+
+    def serve_message_status(self):
+        """
+        Serves the status of a message as JSON, for requests to
+        "/api/v1/messages/<id>". If a "wait" parameter is given (in seconds)
+        the response is held until the status of the message changes or the
+        time runs out. The change is measured from the current status, or from
+        the "status" parameter if one is given.
+        """
+        path, query = urlparse.urlsplit(self.path)[2:4]
+        parameters = cgi.parse_qs(query)
+
+        try:
+            message_id = int(path[len('/api/v1/messages/'):])
+        except ValueError:
+            self.serve_json(404, {'error': 'The message ID is not valid.'})
+            return
 
-            for recipient in recipient_list:
-                self.server.message_received({'timestamp': timestamp,
-                                              'recipient': recipient,
-                                              'class': msg_class,
-                                              'message': message,
-                                              'sender_ip': self.client_address[0]})
+        try:
+            wait = min(max(float(parameters.get('wait', ['0'])[0]), 0), MAX_STATUS_WAIT)
+        except ValueError:
+            self.serve_json(400, {'error': 'The "wait" parameter must be a number of seconds.'})
+            return
 
-            self.serve_message(200, 'Message(s) Queued', 'Your message(s) have been added to the queue to be sent.')
+        if wait:
+            message = self.server.message_store.wait_for_status(message_id,
+                                                                parameters.get('status', [None])[0],
+                                                                wait)
+        else:
+            message = self.server.message_store.get_message(message_id)
+
+        if message is None:
+            self.serve_json(404, {'error': 'There is no message with the ID %d.' % message_id})
+        else:
+            self.serve_json(200, {'id': message['id'],
+                                  'recipient': message['recipient'],
+                                  'class': message['class'],
+                                  'status': message['status'],
+                                  'error': message['error'],
+                                  'received_at': message['received_at'],
+                                  'updated_at': message['updated_at']})
 
     def log_message(self, *args):
-        self.server.log_http_data('%s - %s:%d - %s - %s' % (time.strftime('%d/%m/%y %H:%M:%S'),
-                                                            self.client_address[0],
-                                                            self.client_address[1],
-                                                            self.requestline,
-                                                            self.headers.getheader('User-Agent')))
+        request_time = time.time()
+        self.server.log_http_data({'time': request_time,
+                                   'timestamp': time.strftime('%d/%m/%y %H:%M:%S', time.localtime(request_time)),
+                                   'client_ip': self.client_address[0],
+                                   'client_port': self.client_address[1],
+                                   'request': self.requestline,
+                                   'user_agent': self.headers.getheader('User-Agent')})
+
+    def serve_events(self):
+        """
+        Streams gateway events to the client as Server-Sent Events until the
+        client disconnects, falls too far behind or the server is stopped.
+        """
+        subscriber = self.server.event_stream.subscribe()
+        try:
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Cache-Control', 'no-cache')
+            self.end_headers()
+            self.wfile.write('retry: 5000\n\n')
+
+            while self.server.is_running and not subscriber.dropped:
+
+                # Wait for the next event then send everything that is waiting
+                # in a single write
+                events = []
+                try:
+                    events.append(subscriber.get(timeout=EVENT_KEEPALIVE))
+                    while True:
+                        events.append(subscriber.get_nowait())
+                except Queue.Empty:
+                    if not events:
+                        events.append(': keepalive\n\n')
+                self.wfile.write(''.join(events))
+        except socket.error:
+            pass
+        finally:
+            self.server.event_stream.unsubscribe(subscriber)
+
+    def serve_metrics(self):
+        """
+        Serves the gateway's metrics in the Prometheus text format.
+        """
+        response_data = metrics.exposition()
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', len(response_data))
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        self.wfile.write(response_data)
+
+    def serve_profile(self):
+        """
+        Profiles every thread of the gateway for the number of seconds given
+        by the "seconds" parameter & serves the collapsed stacks as text, (see
+        profiler). Profiling is only allowed from the gateway's own machine.
+        """
+        if self.client_address[0] not in ('127.0.0.1', '::1'):
+            self.serve_json(403, {'error': 'Profiling is only allowed from the local machine.'})
+            return
+
+        parameters = cgi.parse_qs(urlparse.urlsplit(self.path)[3])
+        try:
+            seconds = float(parameters.get('seconds', [DEFAULT_PROFILE_SECONDS])[0])
+        except ValueError:
+            seconds = -1
+        if not 0 < seconds <= profiler.MAX_SECONDS:
+            self.serve_json(400, {'error': 'The "seconds" parameter must be a number of seconds up to %d.' % profiler.MAX_SECONDS})
+            return
+
+        response_data = profiler.profile(seconds)
+        if response_data is None:
+            self.serve_json(409, {'error': 'A profile is already running.'})
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', len(response_data))
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        self.wfile.write(response_data)
+
+    def serve_template(self, template):
+        self.serve_json(200, {'id': template.id,
+                              'body': template.body,
+                              'fields': template.fields})
+
+    def read_json(self):
+        """
+        Returns the JSON data POSTed with the request. Raises ValueError if
+        it is not valid JSON.
+        """
+        content_length = int(self.headers.getheader('content-length') or 0)
+        return util.json.loads(self.rfile.read(content_length))
+
+    def wants_json(self):
+        """
+        Returns True if the client asked for a JSON response.
+        """
+        return 'application/json' in (self.headers.getheader('Accept') or '')
+
+    def serve_json(self, status_code, data):
+        response_data = util.json.dumps(data)
+
+        self.send_response(status_code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', len(response_data))
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        self.wfile.write(response_data)
 
     def serve_message(self, status_code, title, message):
         file_path = os.path.join(os.path.dirname(sys.argv[0]), 'public_html/page.html')
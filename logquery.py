@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+
+"""
+Command line tool for searching the SMS & HTTP log files written in the
+"JSON Lines" log format. The index files written alongside the logs are used
+to find the matching lines, so only those lines are read from the log files.
+
+Example - show what happened to messages sent to +447... last Tuesday:
+
+    python logquery.py sms_log.txt --recipient +447 --day "last tuesday"
+"""
+
+# Standard library modules
+import datetime
+import gzip
+import mmap
+import optparse
+import os
+import sys
+import time
+
+# Local application modules
+import logwriter
+import util
+
+WEEKDAYS = ['monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday']
+DATE_FORMATS = ['%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d',
+                '%d/%m/%y %H:%M:%S', '%d/%m/%y %H:%M', '%d/%m/%y']
+
+class LogIndex(object):
+    """
+    Read-only view of a log index file (see logwriter.INDEX_RECORD). The file
+    is memory mapped & binary searched by time, so only the records in the
+    requested time range are read.
+    """
+    def __init__(self, filename):
+        self.file = open(filename, 'rb')
+        size = os.path.getsize(filename)
+        self.count = size // logwriter.INDEX_RECORD.size
+        if self.count:
+            self.map = mmap.mmap(self.file.fileno(), self.count * logwriter.INDEX_RECORD.size, access=mmap.ACCESS_READ)
+        else:
+            self.map = None
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+        self.file.close()
+
+    def record(self, position):
+        """
+        Returns the (time, offset, recipient) record at the given position.
+        """
+        record_time, offset, recipient = logwriter.INDEX_RECORD.unpack_from(self.map, position * logwriter.INDEX_RECORD.size)
+        return record_time, offset, recipient.rstrip('\0')
+
+    def first_position(self, start_time):
+        """
+        Returns the position of the first record at or after "start_time".
+        """
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.record(middle)[0] < start_time:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def search(self, start_time=None, end_time=None, recipient=None):
+        """
+        Returns the log file offsets of the records within the time range whose
+        recipient starts with "recipient".
+        """
+        offsets = []
+        if not self.count:
+            return offsets
+
+        if start_time is None:
+            position = 0
+        else:
+            position = self.first_position(start_time)
+
+        while position < self.count:
+            record_time, offset, record_recipient = self.record(position)
+            if end_time is not None and record_time >= end_time:
+                break
+            if recipient is None or record_recipient.startswith(recipient):
+                offsets.append(offset)
+            position += 1
+        return offsets
+
+
+def log_files(filename):
+    """
+    Returns a list of (log file, index file) pairs for a log & its rotated
+    copies, oldest first. Files that have no index are skipped.
+    """
+    files = []
+    if os.path.exists(logwriter.index_name(filename)):
+        files.append((filename, logwriter.index_name(filename)))
+
+    number = 1
+    while True:
+        index_file = logwriter.backup_index_name(filename, number)
+        if not os.path.exists(index_file):
+            break
+        for log_file in ('%s.%d' % (filename, number), '%s.%d.gz' % (filename, number)):
+            if os.path.exists(log_file):
+                files.append((log_file, index_file))
+                break
+        number += 1
+
+    files.reverse()
+    return files
+
+
+def read_records(log_file, offsets):
+    """
+    Reads & decodes the JSON records at the given offsets of a log file.
+    """
+    if log_file.endswith('.gz'):
+        log = gzip.open(log_file, 'rb')
+    else:
+        log = open(log_file, 'rb')
+    try:
+        for offset in sorted(offsets):
+            log.seek(offset)
+            yield util.json.loads(log.readline())
+    finally:
+        log.close()
+
+
+def parse_date(text, end=False):
+    """
+    Converts a date given on the command line into a timestamp. Dates can be
+    absolute (e.g. "2010-01-18" or "18/01/10 17:10") or relative ("today",
+    "yesterday", "tuesday" or "last tuesday"). When "end" is True a date
+    without a time refers to the end of that day.
+    """
+    text = text.strip().lower()
+    if text.startswith('last '):
+        text = text[5:].strip()
+
+    today = datetime.date.today()
+    day = None
+    if text == 'today':
+        day = today
+    elif text == 'yesterday':
+        day = today - datetime.timedelta(days=1)
+    elif text in WEEKDAYS:
+        days_back = (today.weekday() - WEEKDAYS.index(text)) % 7 or 7
+        day = today - datetime.timedelta(days=days_back)
+    else:
+        for date_format in DATE_FORMATS:
+            try:
+                parsed = time.strptime(text, date_format)
+            except ValueError:
+                continue
+            if '%H' in date_format:
+                return time.mktime(parsed)
+            day = datetime.date(*parsed[:3])
+            break
+        else:
+            raise ValueError('Unrecognised date: "%s"' % text)
+
+    if end:
+        day = day + datetime.timedelta(days=1)
+    return time.mktime(day.timetuple())
+
+
+def format_record(record):
+    """
+    Formats a log record in the same layout as the plain text log files.
+    """
+    timestamp = time.strftime('%d/%m/%y %H:%M:%S', time.localtime(record['time']))
+    if record.get('type') == 'http':
+        return '%s - %s:%d - %s - %s' % (timestamp,
+                                         record['client_ip'],
+                                         record['client_port'],
+                                         record['request'],
+                                         record['user_agent'])
+
+    message_text = record['message'].replace('\r\n', ' ').replace('\n', ' ')
+    return '%s - %s - %s - C%d - %s: %s' % (timestamp,
+                                            record['sender_ip'],
+                                            record['recipient'],
+                                            record['class'],
+                                            record['status'].upper(),
+                                            message_text)
+
+
+def main(args):
+    parser = optparse.OptionParser(usage='%prog [options] LOG_FILE')
+    parser.add_option('-r', '--recipient', help='only show messages to recipients starting with RECIPIENT')
+    parser.add_option('-s', '--since', help='only show records at or after DATE', metavar='DATE')
+    parser.add_option('-u', '--until', help='only show records up to the end of DATE', metavar='DATE')
+    parser.add_option('-d', '--day', help='only show records from DATE', metavar='DATE')
+    parser.add_option('-j', '--json', action='store_true', default=False, help='print the raw JSON records')
+    options, args = parser.parse_args(args)
+    if len(args) != 1:
+        parser.error('a single log file must be given')
+
+    try:
+        start_time = end_time = None
+        if options.day:
+            start_time = parse_date(options.day)
+            end_time = parse_date(options.day, end=True)
+        if options.since:
+            start_time = parse_date(options.since)
+        if options.until:
+            end_time = parse_date(options.until, end=True)
+    except ValueError, e:
+        parser.error(str(e))
+
+    recipient = None
+    if options.recipient:
+        recipient = ''.join(options.recipient.split())
+
+    files = log_files(args[0])
+    if not files:
+        parser.error('no index was found for "%s". Only logs written in the JSON Lines format are indexed.' % args[0])
+
+    for log_file, index_file in files:
+        index = LogIndex(index_file)
+        try:
+            offsets = index.search(start_time, end_time, recipient)
+        finally:
+            index.close()
+
+        for record in read_records(log_file, offsets):
+            if options.json:
+                print util.json.dumps(record)
+            else:
+                print format_record(record)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,366 @@
+"""
+Module containing classes to write the application log files from a
+background thread.
+"""
+
+# Standard library modules
+import gzip
+import os
+import Queue
+import struct
+import threading
+import time
+
+# The maximum number of lines that can be waiting to be written. Once the
+# queue is full further lines are dropped rather than blocking the caller.
+MAX_QUEUE_SIZE = 10000
+
+# The maximum number of lines written in a single batch
+MAX_BATCH_SIZE = 1000
+
+# Lines written with an index key also get a record in an index file named
+# "<filename>.idx". Each record holds the time of the line, the offset of the
+# line in the log file & the recipient, padded to 16 characters. Records are
+# appended in time order so the index can be binary searched by time.
+INDEX_RECORD = struct.Struct('<dQ16s')
+
+class RotatingLogFile(object):
+    """
+    A log file that is kept open between writes. The file is rotated when it
+    grows past "max_bytes" or when the "rotate_interval" (in seconds) has
+    passed, keeping "backup_count" old copies named "<filename>.1",
+    "<filename>.2", etc. Old copies are gzip compressed if "compress" is True.
+    A "max_bytes" or "rotate_interval" of 0 disables that type of rotation.
+
+    The index file of the log (see INDEX_RECORD) is rotated along with it.
+    """
+    def __init__(self, filename, max_bytes=0, rotate_interval=0, backup_count=5, compress=False):
+        self.filename = filename
+        self.max_bytes = max_bytes
+        self.rotate_interval = rotate_interval
+        self.backup_count = backup_count
+        self.compress = compress
+
+        self.file = None
+        self.open()
+
+    def open(self):
+        """
+        Opens the log file for appending & works out when it is next due to be
+        rotated.
+        """
+        # The file is opened in binary mode so that the size & the offsets
+        # in the index match the file contents exactly
+        self.file = open(self.filename, 'ab')
+        self.file.seek(0, 2)
+        self.size = self.file.tell()
+        self.index_file = None
+        self.last_index_time = last_index_time(self.filename)
+        self.rollover_at = self.next_rollover_time(time.time())
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        if self.index_file is not None:
+            self.index_file.close()
+            self.index_file = None
+
+    def next_rollover_time(self, now):
+        """
+        Returns the time of the next interval boundary (in local time) after
+        "now", so that daily logs are rotated at midnight.
+        """
+        if not self.rotate_interval:
+            return None
+        if time.localtime(now).tm_isdst and time.daylight:
+            utc_offset = time.altzone
+        else:
+            utc_offset = time.timezone
+        intervals = int((now - utc_offset) // self.rotate_interval) + 1
+        return intervals * self.rotate_interval + utc_offset
+
+    def should_rollover(self, length):
+        """
+        Returns True if writing "length" more bytes should first rotate the
+        file.
+        """
+        if self.max_bytes and self.size and self.size + length > self.max_bytes:
+            return True
+        if self.rollover_at is not None and time.time() >= self.rollover_at:
+            return True
+        return False
+
+    def backup_name(self, number):
+        if self.compress:
+            return '%s.%d.gz' % (self.filename, number)
+        return '%s.%d' % (self.filename, number)
+
+    def rollover(self):
+        """
+        Closes the current file, renames it to the first backup (shifting the
+        existing backups along) & opens a new file.
+        """
+        self.close()
+
+        if self.backup_count > 0:
+
+            # Shift the existing backups along, discarding the oldest
+            for i in range(self.backup_count - 1, 0, -1):
+                source = self.backup_name(i)
+                if os.path.exists(source):
+                    destination = self.backup_name(i + 1)
+                    if os.path.exists(destination):
+                        os.remove(destination)
+                    os.rename(source, destination)
+
+                source = backup_index_name(self.filename, i)
+                if os.path.exists(source):
+                    destination = backup_index_name(self.filename, i + 1)
+                    if os.path.exists(destination):
+                        os.remove(destination)
+                    os.rename(source, destination)
+
+            # Move the current file into the first backup slot
+            first_backup = '%s.1' % self.filename
+            if os.path.exists(first_backup):
+                os.remove(first_backup)
+            os.rename(self.filename, first_backup)
+
+            first_index = backup_index_name(self.filename, 1)
+            if os.path.exists(first_index):
+                os.remove(first_index)
+            if os.path.exists(index_name(self.filename)):
+                os.rename(index_name(self.filename), first_index)
+
+            if self.compress:
+                compress_file(first_backup, self.backup_name(1))
+        else:
+            os.remove(self.filename)
+            if os.path.exists(index_name(self.filename)):
+                os.remove(index_name(self.filename))
+
+        self.open()
+
+    def write(self, data, index_key=None):
+        """
+        Appends data to the log file. If an "index_key" tuple of (time,
+        recipient) is given then a record is also added to the index file.
+        The time is taken by the thread that logged the line, so lines from
+        different threads can arrive slightly out of order. A time earlier
+        than the last one indexed is recorded as the last one, so that the
+        index stays in time order.
+        """
+        if os.linesep != '\n':
+            data = data.replace('\n', os.linesep)
+        if self.should_rollover(len(data)):
+            self.rollover()
+
+        if index_key is not None:
+            if self.index_file is None:
+                self.index_file = open(index_name(self.filename), 'ab')
+            self.last_index_time = max(self.last_index_time, index_key[0])
+            self.index_file.write(INDEX_RECORD.pack(self.last_index_time, self.size, index_key[1][:16]))
+
+        self.file.write(data)
+        self.size += len(data)
+
+    def flush(self):
+        self.file.flush()
+        if self.index_file is not None:
+            self.index_file.flush()
+
+
+class LogWriter(threading.Thread):
+    """
+    Background thread that writes lines to log files. Callers add lines to a
+    bounded queue using the "write" method, which never blocks. The thread
+    writes the queued lines in batches, keeps the log files open between
+    batches & flushes them every "flush_interval" seconds.
+
+    All writes go through this single thread, so several logs can safely share
+    the same file.
+    """
+    def __init__(self, write_error=None, flush_interval=1, max_bytes=0, rotate_interval=0, backup_count=5, compress=False):
+        """
+        The "write_error" parameter is a function that is called with the file
+        name when a log file cannot be written to. The remaining parameters are
+        described in the "configure" method.
+        """
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+
+        self.write_error = write_error
+        self.queue = Queue.Queue(MAX_QUEUE_SIZE)
+        self.log_files = {}
+        self.dropped = 0
+
+        self.configure(flush_interval, max_bytes, rotate_interval, backup_count, compress)
+
+        # Set before the thread starts so that an early "stop" is not lost
+        self.keep_running = True
+
+    def configure(self, flush_interval=1, max_bytes=0, rotate_interval=0, backup_count=5, compress=False):
+        """
+        Changes the log file options. These are applied by the writer thread
+        before it writes the next batch.
+
+        "flush_interval" is the maximum number of seconds that written lines
+        are buffered before being flushed to disk. "max_bytes" and
+        "rotate_interval" are the size (in bytes) and the age (in seconds) at
+        which a log file is rotated, where 0 disables that type of rotation.
+        "backup_count" is the number of rotated files to keep and "compress"
+        gzip compresses them.
+        """
+        self.flush_interval = flush_interval
+        self.options = {'max_bytes': max_bytes,
+                        'rotate_interval': rotate_interval,
+                        'backup_count': backup_count,
+                        'compress': compress}
+
+    def write(self, filename, text, index_key=None):
+        """
+        Queues text to be appended to a log file. If the queue is full the text
+        is dropped & False is returned. See RotatingLogFile.write for the
+        "index_key" parameter.
+        """
+        try:
+            self.queue.put_nowait((filename, text, index_key))
+        except Queue.Full:
+            self.dropped += 1
+            return False
+        return True
+
+    def run(self):
+        """
+        Starts the thread which writes the queued lines to the log files.
+        """
+        options = self.options
+        last_flush = time.time()
+        while self.keep_running or not self.queue.empty():
+
+            # Wait for the next line then take everything else that is queued
+            batch = []
+            try:
+                batch.append(self.queue.get(timeout=max(self.flush_interval, 0.1)))
+                while len(batch) < MAX_BATCH_SIZE:
+                    batch.append(self.queue.get_nowait())
+            except Queue.Empty:
+                pass
+
+            # Apply any changes to the log file options
+            if options is not self.options:
+                options = self.options
+                self.close_files()
+
+            # Group the lines by file so that each file is opened once
+            file_lines = {}
+            file_order = []
+            for filename, text, index_key in batch:
+                key = os.path.normcase(os.path.abspath(filename))
+                if key not in file_lines:
+                    file_lines[key] = []
+                    file_order.append((key, filename))
+                file_lines[key].append((text, index_key))
+
+            for key, filename in file_order:
+                try:
+                    log_file = self.log_files.get(key)
+                    if log_file is None:
+                        log_file = RotatingLogFile(filename, **options)
+                        self.log_files[key] = log_file
+                    for text, index_key in file_lines[key]:
+                        log_file.write(text, index_key)
+                except (IOError, OSError):
+                    self.close_file(key)
+                    if self.write_error is not None:
+                        self.write_error(filename)
+
+            if time.time() - last_flush >= self.flush_interval:
+                self.flush_files()
+                last_flush = time.time()
+
+        self.close_files()
+
+    def stop(self):
+        """
+        Stops the thread once all of the queued lines have been written.
+        """
+        self.keep_running = False
+
+    def flush_files(self):
+        for key in self.log_files.keys():
+            try:
+                self.log_files[key].flush()
+            except (IOError, OSError):
+                filename = self.log_files[key].filename
+                self.close_file(key)
+                if self.write_error is not None:
+                    self.write_error(filename)
+
+    def close_file(self, key):
+        log_file = self.log_files.pop(key, None)
+        if log_file is not None:
+            try:
+                log_file.close()
+            except (IOError, OSError):
+                pass
+
+    def close_files(self):
+        for key in self.log_files.keys():
+            self.close_file(key)
+
+
+def index_name(filename):
+    """
+    Returns the name of the index file for a log file.
+    """
+    return filename + '.idx'
+
+
+def last_index_time(filename):
+    """
+    Returns the time of the last record in the index file of a log, or 0 if
+    it has no index file or the index is empty.
+    """
+    try:
+        index_file = open(index_name(filename), 'rb')
+    except IOError:
+        return 0
+    try:
+        index_file.seek(0, 2)
+        size = index_file.tell() // INDEX_RECORD.size * INDEX_RECORD.size
+        if not size:
+            return 0
+        index_file.seek(size - INDEX_RECORD.size)
+        return INDEX_RECORD.unpack(index_file.read(INDEX_RECORD.size))[0]
+    finally:
+        index_file.close()
+
+
+def backup_index_name(filename, number):
+    """
+    Returns the name of the index file for a rotated copy of a log file.
+    """
+    return '%s.%d.idx' % (filename, number)
+
+
+def compress_file(source, destination):
+    """
+    Gzip compresses the "source" file to "destination" then removes the
+    source file.
+    """
+    source_file = open(source, 'rb')
+    try:
+        destination_file = gzip.open(destination, 'wb')
+        try:
+            while True:
+                data = source_file.read(65536)
+                if not data:
+                    break
+                destination_file.write(data)
+        finally:
+            destination_file.close()
+    finally:
+        source_file.close()
+    os.remove(source)
@@ -0,0 +1,164 @@
+"""
+Module containing the counters, gauges & histograms that describe what the
+gateway is doing, & a function to write them in the Prometheus text format
+(served at "/metrics").
+"""
+
+# Standard library modules
+import bisect
+import thread
+import threading
+
+# The upper bounds (in seconds) of the histogram buckets
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1, 2.5, 5, 10, 30, 60, 300, 1800, 3600)
+
+# Every metric, in the order they are written
+REGISTRY = []
+
+class Counter(object):
+    """
+    A count that only goes up. Recording is on the hot path, so rather than
+    taking a lock each thread adds to its own stripe, which no other thread
+    writes to, & the stripes are added up when the counter is read. Thread
+    IDs are reused by the operating system, so the number of stripes is
+    bounded by the number of threads running at once.
+
+    A counter with a "label" name holds a child counter for each value of the
+    label, (see "labels").
+    """
+    def __init__(self, name, help, label=None, register=True):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.stripes = {}
+        self.children = {}
+        self.children_lock = threading.Lock()
+        if register:
+            REGISTRY.append(self)
+
+    def inc(self, amount=1):
+        key = thread.get_ident()
+        self.stripes[key] = self.stripes.get(key, 0) + amount
+
+    def value(self):
+        return sum(self.stripes.values())
+
+    def labels(self, value):
+        """
+        Returns the child counter for a value of the label.
+        """
+        try:
+            return self.children[value]
+        except KeyError:
+            self.children_lock.acquire()
+            try:
+                return self.children.setdefault(value, Counter(self.name, self.help, register=False))
+            finally:
+                self.children_lock.release()
+
+    def samples(self):
+        if self.label is None:
+            return [(self.name, '', self.value())]
+        return [(self.name, '{%s="%s"}' % (self.label, escape(value)), child.value())
+                for value, child in sorted(self.children.items())]
+
+    def metric_type(self):
+        return 'counter'
+
+
+class Gauge(object):
+    """
+    A value that is read when the metrics are written, from the function
+    given to "set_function", (i.e. the length of a queue).
+    """
+    def __init__(self, name, help, register=True):
+        self.name = name
+        self.help = help
+        self.function = None
+        if register:
+            REGISTRY.append(self)
+
+    def set_function(self, function):
+        self.function = function
+
+    def samples(self):
+        if self.function is None:
+            return []
+        return [(self.name, '', self.function())]
+
+    def metric_type(self):
+        return 'gauge'
+
+
+class Histogram(object):
+    """
+    Counts values (usually durations in seconds) into buckets. Like Counter,
+    each thread records into its own stripe: a list of the count in each
+    bucket, followed by the sum of the values.
+    """
+    def __init__(self, name, help, buckets=DEFAULT_BUCKETS, register=True):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.stripes = {}
+        if register:
+            REGISTRY.append(self)
+
+    def observe(self, value):
+        key = thread.get_ident()
+        try:
+            counts = self.stripes[key]
+        except KeyError:
+            counts = self.stripes[key] = [0] * (len(self.buckets) + 1) + [0.0]
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def samples(self):
+        totals = [0] * (len(self.buckets) + 2)
+        for counts in self.stripes.values():
+            for i, count in enumerate(counts):
+                totals[i] += count
+
+        samples = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + ('+Inf',), totals):
+            cumulative += count
+            samples.append((self.name + '_bucket', '{le="%s"}' % bound, cumulative))
+        samples.append((self.name + '_sum', '', totals[-1]))
+        samples.append((self.name + '_count', '', cumulative))
+        return samples
+
+    def metric_type(self):
+        return 'histogram'
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def exposition():
+    """
+    Returns every metric in the Prometheus text format (version 0.0.4).
+    """
+    lines = []
+    for metric in REGISTRY:
+        lines.append('# HELP %s %s' % (metric.name, metric.help))
+        lines.append('# TYPE %s %s' % (metric.name, metric.metric_type()))
+        for name, labels, value in metric.samples():
+            lines.append('%s%s %s' % (name, labels, repr(float(value)) if isinstance(value, float) else value))
+    return '\n'.join(lines) + '\n'
+
+
+# The metrics recorded by the gateway
+HTTP_REQUESTS = Counter('smsgw_http_requests_total', 'HTTP requests handled.')
+HTTP_REQUEST_SECONDS = Histogram('smsgw_http_request_seconds', 'Time taken to handle HTTP requests, other than "/events".')
+MESSAGES_QUEUED = Counter('smsgw_messages_queued_total', 'Messages added to the send queue.')
+MESSAGES_SUPPRESSED = Counter('smsgw_messages_suppressed_total', 'Repeated messages that were not queued.')
+MESSAGES_BLOCKED = Counter('smsgw_messages_blocked_total', 'Messages that were not queued as the recipient is on the blocklist.')
+MESSAGES_SENT = Counter('smsgw_messages_sent_total', 'Messages sent, by COM port.', 'port')
+MESSAGES_FAILED = Counter('smsgw_messages_failed_total', 'Messages that could not be sent.')
+MESSAGES_REQUEUED = Counter('smsgw_messages_requeued_total', 'Messages put back in the queue to be tried again.')
+QUEUE_DEPTH = Gauge('smsgw_queue_depth', 'Messages waiting in the send queue.')
+QUEUE_WAIT_SECONDS = Histogram('smsgw_queue_wait_seconds', 'Time messages spent in the send queue before being taken by the sender.')
+AT_COMMAND_SECONDS = Histogram('smsgw_at_command_seconds', 'Round trip time of AT commands, from being written to the final result code (or the timeout).')
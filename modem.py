@@ -0,0 +1,593 @@
+"""
+Module containing functions & classes for working with the responses of GSM
+modems to AT commands.
+"""
+
+# Standard library modules
+import re
+import threading
+import time
+
+# Delivery report outcomes
+DELIVERED = 'delivered'
+PENDING = 'pending'
+FAILED = 'failed'
+
+# How long (in seconds) a sent message is remembered while waiting for its
+# delivery report
+REPORT_MAX_AGE = 3 * 86400
+
+# How long (in seconds) the parts of a concatenated message are kept while
+# waiting for the rest of the parts to arrive
+PARTS_MAX_AGE = 86400
+
+# How long (in seconds) the modem can be silent before it is probed, how
+# often the signal quality & registration are refreshed, and the number of
+# commands in a row that can go unanswered before the modem is considered
+# to have hung
+IDLE_INTERVAL = 30
+SIGNAL_INTERVAL = 120
+MAX_TIMEOUTS = 3
+
+# Network registration statuses (AT+CREG) in which messages can be sent
+REGISTERED = (1, 5)
+
+# Final result codes, which end the response to a command
+FINAL_RESULTS = ('OK', 'ERROR', 'NO CARRIER', 'NO DIALTONE', 'BUSY', 'NO ANSWER')
+ERROR_RESULTS = ('+CME ERROR', '+CMS ERROR')
+
+# Prefixes of the unsolicited result codes that the modem can send at any
+# time, rather than in response to a command
+URC_PREFIXES = ('+CMTI:', '+CDSI:', '+CMT:', '+CDS:', '+CBM:', '+CREG:', '+CGREG:',
+                '+CUSD:', '+CRING:', 'RING', '^RSSI:', '^BOOT:', '^MODE:')
+
+# The pause (in seconds) between sending messages on a modem that is not in
+# MODEL_PROFILES
+DEFAULT_SEND_INTERVAL = 2
+
+# Settings for the modems that are known to cope with a faster pace, matched
+# (ignoring case) against the manufacturer & model. "send_interval" is the
+# pause between messages & "max_length" is the longest message the model
+# sends in text mode (None leaves it to the modem to reject longer messages).
+MODEL_PROFILES = ((r'huawei', {'send_interval': 0.5, 'max_length': 160}),
+                  (r'quectel|simcom|telit|sierra', {'send_interval': 0.5, 'max_length': 160}),
+                  (r'wavecom|siemens|cinterion', {'send_interval': 1, 'max_length': 160}))
+
+def split_fields(text):
+    """
+    Splits the comma separated fields of an AT response, removing the quotes
+    from quoted fields. Commas within quotes do not split a field.
+    (i.e. '1,"+4477,1",,145' returns ['1', '+4477,1', '', '145'])
+    """
+    fields = []
+    field = []
+    quoted = False
+    for char in text:
+        if char == '"':
+            quoted = not quoted
+        elif char == ',' and not quoted:
+            fields.append(''.join(field).strip())
+            field = []
+        else:
+            field.append(char)
+    fields.append(''.join(field).strip())
+    return fields
+
+
+def response_fields(line):
+    """
+    Returns the fields of a response line such as '+CMGS: 12' as a list,
+    (i.e. ['12']).
+    """
+    return split_fields(line.split(':', 1)[1])
+
+
+def parse_status_report(fields):
+    """
+    Parses the fields of a text mode status report, as given by "+CDS:"
+    (<fo>,<mr>,[<ra>],[<tora>],<scts>,<dt>,<st>). Returns a tuple of
+    (message reference, recipient, status) or None if the fields are not a
+    status report.
+    """
+    if len(fields) < 7:
+        return None
+    try:
+        return int(fields[1]), fields[2], int(fields[6])
+    except ValueError:
+        return None
+
+
+def command_prefix(text):
+    """
+    Returns the prefix of the information lines in the response to a command,
+    (i.e. 'AT+CMGS="+4477"' and 'AT+CREG?' return '+CMGS:' and '+CREG:'), or
+    None for basic commands such as 'AT' & 'ATI'.
+    """
+    match = re.match(r'AT([+^][A-Z]+)', text.upper())
+    if match is None:
+        return None
+    return match.group(1) + ':'
+
+
+def urc_prefix(line):
+    """
+    Returns the prefix of an unsolicited result code, or None if the line is
+    not one.
+    """
+    for prefix in URC_PREFIXES:
+        if line.startswith(prefix):
+            return prefix
+    return None
+
+
+def urc_has_body(line):
+    """
+    Returns True if an unsolicited result code is followed by a second line.
+    Received messages (+CMT & +CBM) always are, while a status report (+CDS)
+    is only followed by a PDU in PDU mode, where its only field is a length.
+    """
+    if line.startswith('+CMT:') or line.startswith('+CBM:'):
+        return True
+    if line.startswith('+CDS:'):
+        return len(response_fields(line)) == 1
+    return False
+
+
+def serial_number(lines):
+    """
+    Returns the serial number (IMEI) from the response to AT+CGSN, which is
+    either on a line of its own or after a "+CGSN:" prefix, or None if there
+    isn't one.
+    """
+    for line in lines:
+        if line.startswith('+CGSN:'):
+            line = response_fields(line)[0]
+        line = line.strip()
+        if line.isdigit() and len(line) >= 14:
+            return line
+    return None
+
+
+def command_list(lines):
+    """
+    Returns the set of command names, (i.e. '+CMGW') listed in the response
+    to AT+CLAC. Modems list the commands with or without the "AT".
+    """
+    commands = set()
+    for line in lines:
+        match = re.match(r'(?:AT)?([+^&]?[A-Z0-9]+)', line.strip().upper())
+        if match is not None:
+            commands.add(match.group(1))
+    return commands
+
+
+def number_list(lines):
+    """
+    Returns the numbers listed in the response to a test command, such as
+    '+CMGF: (0,1)' or '+IPR: (),(300,1200-115200)' where ranges are given by
+    their first & last values.
+    """
+    numbers = []
+    for line in lines:
+        for first, last in re.findall(r'(\d+)(?:-(\d+))?', line.split(':', 1)[-1]):
+            numbers.append(int(first))
+            if last:
+                numbers.append(int(last))
+    return numbers
+
+
+def report_outcome(report_status):
+    """
+    Returns the outcome of the <st> value of a status report (3GPP TS 23.040).
+    Values below 32 mean that the message was delivered, 32 to 63 mean that
+    the service centre is still trying to deliver it & 64 upwards mean that
+    delivery failed.
+    """
+    if report_status < 32:
+        return DELIVERED
+    elif report_status < 64:
+        return PENDING
+    return FAILED
+
+
+def same_number(number1, number2):
+    """
+    Returns True if two phone numbers look like the same number. Only the
+    last 9 digits are compared, so that national & international forms of a
+    number match.
+    """
+    digits1 = ''.join([x for x in number1 if x.isdigit()])
+    digits2 = ''.join([x for x in number2 if x.isdigit()])
+    return digits1[-9:] == digits2[-9:]
+
+
+class Command(object):
+    """
+    An AT command & the response to it, which is filled in by the thread
+    reading the modem output. "data" is written after the modem's "> "
+    prompt, (i.e. the text of a message sent with AT+CMGS).
+    """
+    def __init__(self, text, data=None):
+        self.text = text
+        self.data = data
+        self.prefix = command_prefix(text)
+
+        # The information lines & the final result code of the response. The
+        # result is None until the response is complete.
+        self.lines = []
+        self.result = None
+
+        # When (see tracing.monotonic) the serial port was acquired for the
+        # command, the command (& its data, if any) was written & the command
+        # finished
+        self.acquired_at = None
+        self.written_at = None
+        self.finished_at = None
+
+        self.prompt_event = threading.Event()
+        self.done_event = threading.Event()
+
+    def ok(self):
+        return self.result == 'OK'
+
+    def values(self, prefix=None):
+        """
+        Returns the fields of each information line starting with "prefix"
+        (by default the prefix of the command) as a list of lists.
+        """
+        prefix = prefix or self.prefix
+        return [response_fields(line) for line in self.lines if line.startswith(prefix)]
+
+
+class ResponseParser(object):
+    """
+    State machine that splits the output of a modem into events. Data can be
+    fed in any sized pieces; partial lines are kept until they are complete.
+
+    The events returned by "feed" are tuples of (event type, value):
+
+    'response' - an information line in the response to the current command
+    'result'   - a final result code, which ends the current command
+    'prompt'   - the "> " prompt for the data of the current command
+    'urc'      - an unsolicited result code, as a tuple of (line, body),
+                 where the body is the second line of a two line code or None
+
+    A line is part of the response to the current command if it starts with
+    the command's response prefix, even if the same prefix is also used by an
+    unsolicited result code (such as +CREG:). Echoes of the command are
+    dropped.
+    """
+    def __init__(self):
+        self.buffer = ''
+
+        # The first line of a two line unsolicited result code, while its
+        # second line is awaited
+        self.urc_line = None
+
+    def feed(self, data, command=None):
+        """
+        Parses data read from the modem. "command" is the modem.Command that
+        is waiting for a response, if any.
+        """
+        events = []
+        lines = re.split('\r\n|\r|\n', self.buffer + data)
+        self.buffer = lines.pop()
+        for line in lines:
+            if line:
+                self.parse_line(line, command, events)
+
+        # The data prompt is not followed by a line break
+        if command is not None and command.data is not None and self.buffer.strip() == '>':
+            self.buffer = ''
+            events.append(('prompt', None))
+        return events
+
+    def parse_line(self, line, command, events):
+        if self.urc_line is not None:
+            events.append(('urc', (self.urc_line, line)))
+            self.urc_line = None
+            return
+
+        if command is not None:
+            if line == command.text:
+                return
+            if command.prefix is not None and line.startswith(command.prefix):
+                events.append(('response', line))
+                return
+
+        if urc_prefix(line) is not None:
+            if urc_has_body(line):
+                self.urc_line = line
+            else:
+                events.append(('urc', (line, None)))
+        elif line in FINAL_RESULTS or line.startswith(ERROR_RESULTS):
+            events.append(('result', line))
+        else:
+            events.append(('response', line))
+
+
+class ModemProfile(object):
+    """
+    What a modem supports, learnt when it is connected (see
+    ModemReader.load_profile), & the pace that messages are sent at. The
+    commands are the set listed by AT+CLAC, or None if the modem does not
+    list them, in which case every command is assumed to be supported.
+    """
+    def __init__(self, manufacturer=None, model=None, commands=None, formats=(), baud_rates=()):
+        self.manufacturer = manufacturer
+        self.model = model
+        self.commands = commands
+
+        # The message formats (AT+CMGF) are assumed to be text mode only if
+        # the modem does not list them
+        formats = formats or (1,)
+        self.text_mode = 1 in formats
+        self.pdu_mode = 0 in formats
+        self.max_baud = baud_rates and max(baud_rates) or None
+
+        self.send_interval = DEFAULT_SEND_INTERVAL
+        self.max_length = None
+        name = '%s %s' % (manufacturer or '', model or '')
+        for pattern, settings in MODEL_PROFILES:
+            if re.search(pattern, name, re.I):
+                self.send_interval = settings['send_interval']
+                self.max_length = settings['max_length']
+                break
+
+    def supports(self, command):
+        return self.commands is None or command in self.commands
+
+    def store_and_send(self):
+        """
+        Returns True if messages can be written to the SIM & then sent from
+        there (AT+CMGW & AT+CMSS), which lets a send that was interrupted be
+        recovered. Otherwise they are sent directly with AT+CMGS.
+        """
+        return self.supports('+CMGW') and self.supports('+CMSS')
+
+    def description(self):
+        """
+        Returns a summary of the profile for the activity log, (i.e.
+        "huawei E173 (text mode, store & send, up to 115200 baud)").
+        """
+        features = []
+        if self.text_mode:
+            features.append('text mode')
+        if self.pdu_mode:
+            features.append('PDU mode')
+        if self.store_and_send():
+            features.append('store & send')
+        if self.max_baud is not None:
+            features.append('up to %d baud' % self.max_baud)
+        name = ' '.join([x for x in (self.manufacturer, self.model) if x]) or 'Unknown modem'
+        return '%s (%s)' % (name, ', '.join(features))
+
+
+class ModemHealth(object):
+    """
+    Tracks the health of a modem from the traffic that passes through the
+    modem reader anyway: any output from the modem shows that it is alive,
+    answered commands show that it is responding, and registration changes
+    are reported by +CREG codes. "probe_due" says when the modem has been
+    quiet for long enough that it should be probed, which is also when the
+    signal quality (AT+CSQ) & registration (AT+CREG?) are refreshed.
+    """
+    def __init__(self, changed=None):
+        """
+        The "changed" parameter is a function that is called with the result
+        of "status" whenever the health score or registration changes.
+        """
+        self.changed = changed
+        now = time.time()
+        self.last_activity = now
+        self.last_probe = 0
+        self.timeouts = 0
+        self.lost = False
+
+        # The signal quality (0 - 31, or 99 if not known) & the registration
+        # status, or None until they have been read
+        self.signal = None
+        self.registration = None
+
+        # The description of the modem's profile, see ModemProfile
+        self.model = None
+
+        self.last_status = None
+
+    def activity(self):
+        """
+        Called whenever anything is read from the modem.
+        """
+        self.last_activity = time.time()
+
+    def command_finished(self, command):
+        """
+        Called with every modem.Command once it has finished or timed out.
+        """
+        if command.result is None:
+            self.timeouts += 1
+        else:
+            self.timeouts = 0
+        self.check_changed()
+
+    def connection_lost(self):
+        """
+        Called when the port has been closed or has failed, so that the modem
+        is no longer responding straight away rather than after the next
+        command times out.
+        """
+        self.lost = True
+        self.check_changed()
+
+    def update_signal(self, signal):
+        self.signal = signal
+        self.check_changed()
+
+    def update_registration(self, registration):
+        self.registration = registration
+        self.check_changed()
+
+    def update_model(self, model):
+        self.model = model
+        self.check_changed()
+
+    def probe_due(self):
+        now = time.time()
+        return now - self.last_activity >= IDLE_INTERVAL or now - self.last_probe >= SIGNAL_INTERVAL
+
+    def responding(self):
+        return not self.lost and self.timeouts < MAX_TIMEOUTS
+
+    def registered(self):
+        return self.registration is None or self.registration in REGISTERED
+
+    def score(self):
+        """
+        Returns the health of the modem from 0 to 100. A modem that is not
+        responding or is not registered on the network scores 0, otherwise
+        the score is based on the signal quality & is halved for each
+        unanswered command.
+        """
+        if not (self.responding() and self.registered()):
+            return 0
+        if self.signal is None or self.signal == 99:
+            score = 50
+        else:
+            score = min(self.signal, 20) * 5
+        return score >> self.timeouts
+
+    def can_send(self):
+        return self.score() > 0
+
+    def status(self):
+        return {'score': self.score(),
+                'signal': self.signal,
+                'registered': self.registered(),
+                'responding': self.responding(),
+                'model': self.model}
+
+    def check_changed(self):
+        status = self.status()
+        if status != self.last_status:
+            self.last_status = status
+            if self.changed is not None:
+                self.changed(status)
+
+
+class DeliveryReportIndex(object):
+    """
+    Matches delivery reports to sent messages. Sent messages are indexed on
+    the modem (its identity, see threads.ModemReader.identify) & the message
+    reference returned by +CMGS.
+
+    Message references are only 0 - 255, so they wrap around & are reused. A
+    new message replaces an older message with the same reference, and a
+    report is only matched if its recipient also matches the message. Entries
+    are evicted once they are older than "max_age" seconds. As references
+    are reused there are never more than 256 entries for each modem.
+    """
+    def __init__(self, max_age=REPORT_MAX_AGE):
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.last_eviction = time.time()
+
+    def add(self, modem, reference, message, recipient):
+        """
+        Adds a sent message, which is kept as it is, (i.e. a msgstore.Message)
+        so that it does not need to be looked up when its report arrives.
+        """
+        now = time.time()
+        key = (modem, reference)
+        self.lock.acquire()
+        try:
+            self.evict(now)
+            self.entries[key] = (message, recipient, now)
+        finally:
+            self.lock.release()
+
+    def match(self, modem, reference, recipient, remove=True):
+        """
+        Returns the message that a report is for, or None if there is no
+        matching message. The entry is removed unless "remove" is False.
+        """
+        key = (modem, reference)
+        self.lock.acquire()
+        try:
+            self.evict(time.time())
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            message, message_recipient, added = entry
+            if recipient and not same_number(recipient, message_recipient):
+                return None
+            if remove:
+                del self.entries[key]
+            return message
+        finally:
+            self.lock.release()
+
+    def evict(self, now):
+        """
+        Removes entries older than "max_age", checking at most once a minute.
+        Must be called with the lock held.
+        """
+        if now - self.last_eviction < 60:
+            return
+        self.last_eviction = now
+        for key, entry in self.entries.items():
+            if now - entry[2] > self.max_age:
+                del self.entries[key]
+
+
+class MessageAssembler(object):
+    """
+    Reassembles concatenated messages from their parts. Parts are grouped on
+    the sender, the concatenation reference & the number of parts. Messages
+    that are still incomplete after "max_age" seconds are given up on & are
+    returned with the parts that did arrive, so that a lost part does not
+    lose the whole message.
+
+    This class is only used by the modem reader thread, so it is not locked.
+    """
+    def __init__(self, max_age=PARTS_MAX_AGE):
+        self.max_age = max_age
+        self.messages = {}
+
+    def add(self, sender, text, timestamp, concat=None):
+        """
+        Adds a received message, where "concat" is the (reference, total parts,
+        part number) of a concatenated message or None. Returns a list of the
+        messages that are now complete, as (sender, text, timestamp) tuples.
+        """
+        now = time.time()
+        complete = self.expired(now)
+        if concat is None or concat[1] < 2:
+            complete.append((sender, text, timestamp))
+            return complete
+
+        reference, total, number = concat
+        key = (sender, reference, total)
+        parts = self.messages.setdefault(key, (now, {}))[1]
+        parts[number] = (text, timestamp)
+        if len(parts) == total:
+            del self.messages[key]
+            complete.append(self.join(sender, parts))
+        return complete
+
+    def expired(self, now):
+        """
+        Removes & returns the messages that have been waiting for their
+        remaining parts for longer than "max_age".
+        """
+        complete = []
+        for key, (first_received, parts) in self.messages.items():
+            if now - first_received > self.max_age:
+                del self.messages[key]
+                complete.append(self.join(key[0], parts))
+        return complete
+
+    def join(self, sender, parts):
+        numbers = sorted(parts.keys())
+        text = u''.join([parts[number][0] for number in numbers])
+        return sender, text, parts[numbers[0]][1]
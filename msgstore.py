@@ -0,0 +1,694 @@
+"""
+Module containing a SQLite database that records every message & its status,
+from the time it is queued until it has been sent or has failed. Messages
+received by the modem are recorded in the same database.
+"""
+
+# Standard library modules
+import Queue
+import sqlite3
+import threading
+import time
+
+# Local application modules
+import smspdu
+import templates
+import util
+
+# Message statuses
+QUEUED = 'queued'
+SENDING = 'sending'
+SENT = 'sent'
+DELIVERED = 'delivered'
+FAILED = 'failed'
+
+# The maximum number of changes written in a single transaction
+MAX_BATCH_SIZE = 1000
+
+# How long (in seconds) to wait before trying again to write changes that
+# could not be written
+RETRY_INTERVAL = 5
+
+SCHEMA = ['''CREATE TABLE IF NOT EXISTS messages (
+                 id INTEGER PRIMARY KEY,
+                 recipient TEXT NOT NULL,
+                 sender_ip TEXT,
+                 class INTEGER,
+                 message TEXT,
+                 status TEXT NOT NULL,
+                 error TEXT,
+                 received_at REAL,
+                 updated_at REAL,
+                 template_id INTEGER,
+                 variables TEXT,
+                 sim_location TEXT)''',
+          'CREATE INDEX IF NOT EXISTS messages_recipient ON messages (recipient, received_at)',
+          'CREATE INDEX IF NOT EXISTS messages_sender_ip ON messages (sender_ip, received_at)',
+          'CREATE INDEX IF NOT EXISTS messages_status ON messages (status, received_at)',
+          'CREATE INDEX IF NOT EXISTS messages_received_at ON messages (received_at)',
+          '''CREATE TABLE IF NOT EXISTS inbound (
+                 id INTEGER PRIMARY KEY,
+                 sender TEXT NOT NULL,
+                 message TEXT,
+                 sent_at TEXT,
+                 received_at REAL,
+                 forwarded_at REAL,
+                 error TEXT)''',
+          'CREATE INDEX IF NOT EXISTS inbound_forwarded_at ON inbound (forwarded_at, id)',
+          '''CREATE TABLE IF NOT EXISTS templates (
+                 id INTEGER PRIMARY KEY,
+                 body TEXT NOT NULL,
+                 created_at REAL)''',
+          'CREATE TABLE IF NOT EXISTS queue_snapshot (token TEXT)']
+
+# Columns added to the messages table since it was first created, which are
+# added to older databases
+ADDED_COLUMNS = [('template_id', 'INTEGER'), ('variables', 'TEXT'), ('sim_location', 'TEXT')]
+
+COLUMNS = ['id', 'recipient', 'sender_ip', 'class', 'message', 'status', 'error', 'received_at', 'updated_at']
+INBOUND_COLUMNS = ['id', 'sender', 'message', 'sent_at', 'received_at', 'forwarded_at', 'error']
+
+class StatusWaiters(object):
+    """
+    Registry of threads that are waiting for the status of a message to
+    change. Each waiting thread registers an event against the message ID and
+    every event for the message is set when its status changes. Notifying a
+    message that nobody is waiting on is a single dictionary lookup.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.waiters = {}
+
+    def register(self, message_id):
+        """
+        Returns an event that will be set when the status of the message next
+        changes. The event must be passed to "unregister" when finished with.
+        """
+        event = threading.Event()
+        self.lock.acquire()
+        try:
+            self.waiters.setdefault(message_id, []).append(event)
+        finally:
+            self.lock.release()
+        return event
+
+    def unregister(self, message_id, event):
+        self.lock.acquire()
+        try:
+            events = self.waiters.get(message_id)
+            if events is not None and event in events:
+                events.remove(event)
+                if not events:
+                    del self.waiters[message_id]
+        finally:
+            self.lock.release()
+
+    def notify(self, message_id):
+        """
+        Wakes up every thread waiting on the message.
+        """
+        if message_id not in self.waiters:
+            return
+
+        self.lock.acquire()
+        try:
+            events = self.waiters.pop(message_id, [])
+        finally:
+            self.lock.release()
+        for event in events:
+            event.set()
+
+
+class MessageStore(threading.Thread):
+    """
+    Records messages & their status in a SQLite database. Changes are queued
+    by the calling thread & written by this thread in batched transactions, so
+    recording a change never waits on the disk. The database uses write-ahead
+    logging so that lookups from other threads are not blocked by the writes.
+
+    Changes that are waiting to be written are kept in memory & merged into
+    the results of "get_message", so a lookup always sees the latest status.
+    """
+    def __init__(self, filename, store_error=None, flush_interval=0.2):
+        """
+        The "store_error" parameter is a function that is called with an error
+        message if a batch of changes could not be written to the database.
+        """
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+
+        self.filename = filename
+        self.store_error = store_error
+        self.flush_interval = flush_interval
+        self.queue = Queue.Queue()
+        self.local = threading.local()
+
+        # Changes that have not been written yet, stored as message ID ->
+        # (change number, changed columns)
+        self.pending = {}
+        self.pending_lock = threading.Lock()
+        self.change_number = 0
+
+        self.waiters = StatusWaiters()
+
+        # Create the database tables & find the next free message ID
+        conn = self.connect()
+        try:
+            for statement in SCHEMA:
+                conn.execute(statement)
+            existing_columns = [row[1] for row in conn.execute('PRAGMA table_info(messages)')]
+            for name, column_type in ADDED_COLUMNS:
+                if name not in existing_columns:
+                    conn.execute('ALTER TABLE messages ADD COLUMN %s %s' % (name, column_type))
+            conn.commit()
+            self.last_id = conn.execute('SELECT MAX(id) FROM messages').fetchone()[0] or 0
+            self.last_inbound_id = conn.execute('SELECT MAX(id) FROM inbound').fetchone()[0] or 0
+
+            # Templates are few & used for every message sent with them, so
+            # they are all kept in memory, compiled
+            self.templates = {}
+            for template_id, body in conn.execute('SELECT id, body FROM templates'):
+                self.templates[template_id] = templates.Template(template_id, body)
+            self.last_template_id = max(self.templates.keys() + [0])
+
+            # The token of the send queue snapshot written when the
+            # application last exited, (see snapshot). It is given up here, so
+            # that the snapshot is not used again once messages may have
+            # changed.
+            row = conn.execute('SELECT token FROM queue_snapshot').fetchone()
+            self.snapshot_token = row and row[0]
+            conn.execute('DELETE FROM queue_snapshot')
+            conn.commit()
+        finally:
+            conn.close()
+        self.id_lock = threading.Lock()
+
+        # Set before the thread starts so that an early "stop" is not lost
+        self.keep_running = True
+        self.stopping = threading.Event()
+
+    def connect(self):
+        """
+        Opens a new connection to the database.
+        """
+        conn = sqlite3.connect(self.filename, timeout=30)
+
+        # Message text is stored exactly as it was received, so use byte
+        # strings rather than decoding it
+        conn.text_factory = str
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    def reader(self):
+        """
+        Returns the database connection used for lookups by the calling
+        thread. SQLite connections cannot be shared between threads, so one is
+        opened for each thread.
+        """
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = self.connect()
+            self.local.conn = conn
+        return conn
+
+    def add_messages(self, job, messages):
+        """
+        Records the newly queued messages of a job, (see Job & Message).
+        Message IDs are assigned in order & stored in each message's "id".
+        """
+        self.id_lock.acquire()
+        try:
+            first_id = self.last_id + 1
+            self.last_id += len(messages)
+        finally:
+            self.id_lock.release()
+
+        now = time.time()
+        template_id = job.template and job.template.id
+        for message_id, message_data in zip(xrange(first_id, first_id + len(messages)), messages):
+            message_data.id = message_id
+            columns = {'id': message_id,
+                       'recipient': message_data.recipient,
+                       'sender_ip': job.sender_ip,
+                       'class': job.msg_class,
+                       'message': job.message,
+                       'status': QUEUED,
+                       'error': None,
+                       'received_at': job.time,
+                       'updated_at': now}
+
+            # A message sent with a template is stored as the template & the
+            # values of its fields until it has been rendered, (see
+            # "set_status")
+            if template_id is not None:
+                columns['template_id'] = template_id
+                columns['variables'] = util.json.dumps(message_data.variables)
+            self.record_change(message_id, columns, True)
+
+    def set_status(self, message_id, status, error=None, message=None):
+        """
+        Records a change to the status of a message & wakes up any threads
+        waiting for it in "wait_for_status". "message" is the rendered text of
+        a message that was queued with a template.
+        """
+        columns = {'status': status,
+                   'error': error,
+                   'updated_at': time.time()}
+        if message is not None:
+            columns['message'] = message
+        self.record_change(message_id, columns, False)
+        self.waiters.notify(message_id)
+
+    def set_sim_location(self, message_id, sim_location):
+        """
+        Records where a message that is being sent is stored on the SIM, (see
+        Message) or that it is no longer stored if "sim_location" is None, so
+        that the stored copy can still be checked after a crash.
+        """
+        if sim_location is not None:
+            sim_location = '%s:%d' % sim_location
+        self.record_change(message_id, {'sim_location': sim_location}, False)
+
+    def set_snapshot_token(self, token):
+        """
+        Records the token of a send queue snapshot, once the thread has
+        stopped & every change has been written, (see snapshot).
+        """
+        conn = self.connect()
+        try:
+            conn.execute('DELETE FROM queue_snapshot')
+            conn.execute('INSERT INTO queue_snapshot (token) VALUES (?)', (token,))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def add_template(self, body):
+        """
+        Stores a new template & returns it, compiled, (see templates.Template).
+        """
+        self.id_lock.acquire()
+        try:
+            self.last_template_id += 1
+            template = templates.Template(self.last_template_id, body)
+            self.templates[template.id] = template
+        finally:
+            self.id_lock.release()
+
+        self.queue.put(('templates', None, template.id, {'id': template.id,
+                                                         'body': body,
+                                                         'created_at': time.time()}, True))
+        return template
+
+    def get_template(self, template_id):
+        """
+        Returns a compiled template, or None if there is no template with the
+        given ID.
+        """
+        return self.templates.get(template_id)
+
+    def wait_for_status(self, message_id, known_status=None, timeout=30):
+        """
+        Waits until the status of a message differs from "known_status" (or
+        from its current status if "known_status" is None), or until the
+        timeout expires, then returns the message as for "get_message".
+        """
+        event = self.waiters.register(message_id)
+        try:
+
+            # The event is registered before the status is read, so a change
+            # made in between is not missed
+            message = self.get_message(message_id)
+            if message is None:
+                return None
+            if known_status is None:
+                known_status = message['status']
+            if message['status'] != known_status:
+                return message
+
+            event.wait(timeout)
+            return self.get_message(message_id)
+        finally:
+            self.waiters.unregister(message_id, event)
+
+    def add_inbound(self, inbound_data):
+        """
+        Records a message received by the modem. An ID is assigned, stored in
+        inbound_data['id'] & returned.
+        """
+        self.id_lock.acquire()
+        try:
+            self.last_inbound_id += 1
+            inbound_id = self.last_inbound_id
+        finally:
+            self.id_lock.release()
+
+        inbound_data['id'] = inbound_id
+        self.queue.put(('inbound', None, inbound_id, {'id': inbound_id,
+                                                      'sender': inbound_data['sender'],
+                                                      'message': inbound_data['message'],
+                                                      'sent_at': inbound_data['sent_at'],
+                                                      'received_at': inbound_data['time']}, True))
+        return inbound_id
+
+    def set_forwarded(self, inbound_id, error=None):
+        """
+        Records that a received message has been forwarded to the webhook, or
+        the error from the last attempt if "error" is given.
+        """
+        if error is None:
+            columns = {'forwarded_at': time.time(), 'error': None}
+        else:
+            columns = {'error': error}
+        self.queue.put(('inbound', None, inbound_id, columns, False))
+
+    def unforwarded_inbound(self):
+        """
+        Returns the received messages that have not been forwarded to the
+        webhook yet, oldest first, as inbound data dictionaries.
+        """
+        rows = self.reader().execute('SELECT id, sender, message, sent_at, received_at FROM inbound '
+                                     'WHERE forwarded_at IS NULL ORDER BY id')
+        return [inbound_data(*row) for row in rows]
+
+    def record_change(self, message_id, columns, insert):
+        self.pending_lock.acquire()
+        try:
+            self.change_number += 1
+            change_number = self.change_number
+            if message_id in self.pending:
+                merged = self.pending[message_id][1].copy()
+                merged.update(columns)
+            else:
+                merged = columns
+            self.pending[message_id] = (change_number, merged)
+        finally:
+            self.pending_lock.release()
+
+        self.queue.put(('messages', change_number, message_id, columns, insert))
+
+    def get_message(self, message_id):
+        """
+        Returns a dictionary of the columns of a message, or None if there is
+        no message with the given ID.
+        """
+        row = self.reader().execute('SELECT %s FROM messages WHERE id = ?' % ', '.join(COLUMNS),
+                                    (message_id,)).fetchone()
+        if row is None:
+            message = None
+        else:
+            message = dict(zip(COLUMNS, row))
+
+        self.pending_lock.acquire()
+        try:
+            pending = self.pending.get(message_id)
+        finally:
+            self.pending_lock.release()
+
+        if pending is not None:
+            if message is None:
+                message = dict.fromkeys(COLUMNS)
+            message.update(pending[1])
+        return message
+
+    def find_messages(self, recipient=None, sender_ip=None, status=None, since=None, until=None, limit=100):
+        """
+        Returns the most recent messages matching all of the given criteria,
+        newest first. "since" & "until" are limits on the time the message was
+        received. Changes that have not been written yet are not included.
+        """
+        conditions = []
+        parameters = []
+        for column, value in (('recipient', recipient), ('sender_ip', sender_ip), ('status', status)):
+            if value is not None:
+                conditions.append('%s = ?' % column)
+                parameters.append(value)
+        if since is not None:
+            conditions.append('received_at >= ?')
+            parameters.append(since)
+        if until is not None:
+            conditions.append('received_at < ?')
+            parameters.append(until)
+
+        query = 'SELECT %s FROM messages' % ', '.join(COLUMNS)
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        query += ' ORDER BY received_at DESC LIMIT ?'
+        parameters.append(limit)
+
+        return [dict(zip(COLUMNS, row)) for row in self.reader().execute(query, parameters)]
+
+    def status_counts(self, since=None):
+        """
+        Returns a dictionary of status -> number of messages, optionally only
+        counting messages received since the given time.
+        """
+        if since is None:
+            rows = self.reader().execute('SELECT status, COUNT(*) FROM messages GROUP BY status')
+        else:
+            rows = self.reader().execute('SELECT status, COUNT(*) FROM messages WHERE received_at >= ? GROUP BY status', (since,))
+        return dict(rows.fetchall())
+
+    def get_message_data(self, message_id):
+        """
+        Returns a message in the same form as the messages created by the
+        HTTP server, (see Message) or None if there is no such message.
+        """
+        message = self.get_message(message_id)
+        if message is None:
+            return None
+        job = job_data(message['sender_ip'], message['class'], message['message'], message['received_at'])
+        return Message(message['id'], job, message['recipient'])
+
+    def queued_messages(self):
+        """
+        Returns the messages that were queued but not sent, oldest first, as
+        Message objects that can be put back into the message queue. Messages
+        that were being sent when the application stopped are included, as
+        they may not have been sent. The messages of each request share a Job
+        again.
+        """
+        rows = self.reader().execute('SELECT id, recipient, sender_ip, class, message, received_at, template_id, variables, '
+                                     'sim_location FROM messages WHERE status IN (?, ?) ORDER BY id', (QUEUED, SENDING))
+        messages = []
+        jobs = {}
+        for message_id, recipient, sender_ip, msg_class, message, received_at, template_id, variables, sim_location in rows:
+            if message is not None:
+                template_id = None
+            job_key = (sender_ip, msg_class, message, received_at, template_id)
+            job = jobs.get(job_key)
+            if job is None:
+                job = jobs[job_key] = job_data(sender_ip, msg_class, message, received_at, self.templates.get(template_id))
+            if template_id is None:
+                message_data = Message(message_id, job, recipient)
+            else:
+                message_data = Message(message_id, job, recipient,
+                                       tuple([util.utf8(x) for x in util.json.loads(variables)]))
+            if sim_location:
+                identity, location = sim_location.rsplit(':', 1)
+                message_data.sim_location = (identity, int(location))
+            messages.append(message_data)
+        return messages
+
+    def run(self):
+        """
+        Starts the thread which writes the queued changes to the database.
+        """
+        conn = self.connect()
+        failed = []
+        retried = False
+        last_error = None
+        while self.keep_running or failed or not self.queue.empty():
+
+            # Wait for the next change then take everything else that is
+            # queued. Changes that could not be written are tried again first,
+            # after a pause (or straight away when stopping).
+            batch = failed
+            failed = []
+            try:
+                if batch:
+                    self.stopping.wait(RETRY_INTERVAL)
+                else:
+                    batch.append(self.queue.get(timeout=self.flush_interval))
+                while len(batch) < MAX_BATCH_SIZE:
+                    batch.append(self.queue.get_nowait())
+            except Queue.Empty:
+                pass
+            if not batch:
+                continue
+
+            # Write the whole batch in a single transaction
+            try:
+                for table, change_number, row_id, columns, insert in batch:
+                    names = columns.keys()
+                    if insert:
+                        conn.execute('INSERT OR REPLACE INTO %s (%s) VALUES (%s)' % (table,
+                                                                                   ', '.join(names),
+                                                                                   ', '.join(['?'] * len(names))),
+                                     [columns[name] for name in names])
+                    else:
+                        conn.execute('UPDATE %s SET %s WHERE id = ?' % (table, ', '.join(['%s = ?' % name for name in names])),
+                                     [columns[name] for name in names] + [row_id])
+                conn.commit()
+            except sqlite3.Error, e:
+                conn.rollback()
+
+                # Only report the error once while it keeps happening. The
+                # pending changes are kept, so lookups still see them, & the
+                # batch is tried again. Once the thread is stopping it is only
+                # tried once more, so that the application can exit.
+                error_message = 'Error when writing to the message database (%s).' % e
+                if self.store_error is not None and error_message != last_error:
+                    self.store_error(error_message)
+                last_error = error_message
+                if self.keep_running or not retried:
+                    failed = batch
+                    retried = not self.keep_running
+                continue
+            last_error = None
+
+            # Forget the pending changes that have now been written, unless
+            # the message has been changed again since. Received messages are
+            # not kept in memory while they are waiting to be written.
+            self.pending_lock.acquire()
+            try:
+                for table, change_number, message_id, columns, insert in batch:
+                    if table != 'messages':
+                        continue
+                    pending = self.pending.get(message_id)
+                    if pending is not None and pending[0] <= change_number:
+                        del self.pending[message_id]
+            finally:
+                self.pending_lock.release()
+
+        conn.close()
+
+    def stop(self):
+        """
+        Stops the thread once all of the queued changes have been written.
+        """
+        self.keep_running = False
+        self.stopping.set()
+
+
+class Job(object):
+    """
+    A request to send a message to a list of recipients. Everything the
+    recipients have in common is kept once in the job: the time it was
+    received (as seconds since the epoch), the SMS class, the sender IP
+    (interned) & the text or the template, (see templates.Template). The
+    work on the text is also done once: "summary" is the text on one line,
+    as it is shown in the GUI & the text log, & "segments" is how the text
+    is encoded & split up to be sent. Most jobs have a single recipient, so
+    the segments are only worked out when the first message is sent rather
+    than when the request is received. A template job has no segments, as
+    they depend on each recipient's values, & its summary is the template.
+
+    Each recipient of the job is a Message that refers to it.
+    """
+    __slots__ = ('time', 'msg_class', 'sender_ip', 'message', 'template', 'summary', 'cached_segments')
+
+    def __init__(self, received_at, msg_class, sender_ip, message=None, template=None):
+        self.time = received_at
+        self.msg_class = msg_class
+        self.sender_ip = sender_ip
+        self.message = message
+        self.template = template
+        self.cached_segments = None
+        if template is None:
+            self.summary = one_line(message)
+        else:
+            self.summary = one_line(template.body)
+
+    def segments(self):
+        """
+        Returns how the text is encoded & split up to be sent, (see
+        smspdu.segments) or None for a template job.
+        """
+        if self.cached_segments is None and self.template is None:
+            self.cached_segments = smspdu.segments(self.message)
+        return self.cached_segments
+
+
+class Message(object):
+    """
+    A message to one recipient of a job, from the time it is received until
+    it has been sent or has failed. Large backlogs of messages are kept in
+    memory, so a message only holds what is particular to its recipient, in
+    slots rather than a dictionary, & refers to its Job for the rest.
+
+    "variables" is the tuple of the template's field values & "message" is
+    None until a template message has been rendered, (see
+    templates.render_message). "queued_at" is when the message was last put
+    in the send queue, "sim_location" is where the message is stored on the
+    SIM while it is being sent, (see threads.MsgSender.send) & "trace" &
+    "trace_start" are its trace, (see tracing).
+    """
+    __slots__ = ('id', 'job', 'recipient', 'variables', 'message', 'queued_at', 'sim_location', 'trace',
+                 'trace_start')
+
+    def __init__(self, message_id, job, recipient, variables=None, trace=None, trace_start=None):
+        self.id = message_id
+        self.job = job
+        self.recipient = recipient
+        self.variables = variables
+        self.message = job.message
+        self.queued_at = None
+        self.sim_location = None
+        self.trace = trace
+        self.trace_start = trace_start
+
+    time = property(lambda self: self.job.time)
+    msg_class = property(lambda self: self.job.msg_class)
+    sender_ip = property(lambda self: self.job.sender_ip)
+    template = property(lambda self: self.job.template)
+
+    def timestamp(self):
+        return time.strftime('%d/%m/%y %H:%M:%S', time.localtime(self.job.time))
+
+    def segments(self):
+        """
+        Returns how the message is encoded & split up to be sent, (see
+        smspdu.segments). Only a rendered template message works this out
+        itself.
+        """
+        if self.message is self.job.message:
+            return self.job.segments()
+        return smspdu.segments(self.message)
+
+    def summary(self):
+        """
+        Returns the text of the message on one line. A template message that
+        has not been rendered yet shows the template.
+        """
+        if self.message is None or self.message is self.job.message:
+            return self.job.summary
+        return one_line(self.message)
+
+
+def one_line(text):
+    """
+    Returns a message's text with the line breaks replaced by spaces.
+    """
+    return text.replace('\r\n', ' ').replace('\n', ' ')
+
+
+def job_data(sender_ip, msg_class, message, received_at, template=None):
+    """
+    Builds a Job from the columns of a stored message.
+    """
+    if sender_ip is not None:
+        sender_ip = intern(str(sender_ip))
+    return Job(received_at, msg_class, sender_ip, message, template)
+
+
+def inbound_data(inbound_id, sender, message, sent_at, received_at):
+    """
+    Builds an inbound data dictionary from the columns of a received message.
+    """
+    return {'id': inbound_id,
+            'time': received_at,
+            'timestamp': time.strftime('%d/%m/%y %H:%M:%S', time.localtime(received_at)),
+            'sender': sender,
+            'message': message,
+            'sent_at': sent_at}
@@ -0,0 +1,133 @@
+"""
+Module containing a sampling profiler that can be turned on while the
+gateway is running, to find out what every thread is spending its time on.
+The output is in the "collapsed stack" format read by flame graph tools,
+(i.e. flamegraph.pl & speedscope): one line per distinct stack, with the
+frames separated by semicolons followed by the number of samples.
+"""
+
+# Standard library modules
+import os
+import sys
+import thread
+import threading
+import time
+
+# How often (in seconds) the stacks of the threads are sampled
+SAMPLE_INTERVAL = 0.01
+
+# The longest (in seconds) that a profile can run for
+MAX_SECONDS = 600
+
+# Only one profile runs at a time
+profile_lock = threading.Lock()
+
+def frame_name(frame):
+    code = frame.f_code
+    return '%s:%s' % (os.path.basename(code.co_filename), code.co_name)
+
+
+def thread_name(ident, stack, names):
+    """
+    Returns the name of a thread. Threads started by the threading module
+    have names, but QThreads do not, so they are named after the class of
+    the object whose "run" method is at the bottom of the stack, (i.e.
+    "MsgSender").
+    """
+    try:
+        return names[ident]
+    except KeyError:
+        instance = stack[-1].f_locals.get('self')
+        if instance is not None:
+            return instance.__class__.__name__
+        return 'Thread-%d' % ident
+
+
+class SamplingProfiler(object):
+    """
+    Records the stacks of every thread (other than the one doing the
+    sampling) every "interval" seconds. Sampling only reads the frames the
+    interpreter already keeps, so the threads being profiled are not slowed
+    down, other than by sharing the interpreter lock with the sampler.
+    """
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+
+        # The number of times each stack was seen, keyed on the collapsed
+        # stack (outermost frame first, starting with the thread name)
+        self.counts = {}
+        self.samples = 0
+
+    def sample(self):
+        own_ident = thread.get_ident()
+        names = dict([(ident, t.getName()) for ident, t in threading._active.items()])
+        for ident, frame in sys._current_frames().items():
+            if ident == own_ident:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(frame)
+                frame = frame.f_back
+            key = ';'.join([thread_name(ident, stack, names)] + [frame_name(x) for x in reversed(stack)])
+            self.counts[key] = self.counts.get(key, 0) + 1
+        self.samples += 1
+
+    def run(self, seconds):
+        """
+        Samples the threads for a number of seconds.
+        """
+        deadline = time.time() + seconds
+        while time.time() < deadline:
+            self.sample()
+            time.sleep(self.interval)
+
+    def collapsed(self):
+        """
+        Returns the samples in the collapsed stack format.
+        """
+        return ''.join(['%s %d\n' % (stack, count) for stack, count in sorted(self.counts.items())])
+
+
+def profile(seconds, interval=SAMPLE_INTERVAL):
+    """
+    Profiles every thread for a number of seconds (up to MAX_SECONDS) &
+    returns the collapsed stacks, or None if another profile is running.
+    """
+    if not profile_lock.acquire(False):
+        return None
+    try:
+        profiler = SamplingProfiler(interval)
+        profiler.run(min(seconds, MAX_SECONDS))
+        return profiler.collapsed()
+    finally:
+        profile_lock.release()
+
+
+class ProfileWriter(threading.Thread):
+    """
+    Background thread that profiles the gateway for a number of seconds &
+    writes the collapsed stacks to a file. "finished" is called with the
+    file name, & an error message if the profile could not be written.
+    """
+    def __init__(self, seconds, filename, finished):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.seconds = seconds
+        self.filename = filename
+        self.finished = finished
+
+    def run(self):
+        stacks = profile(self.seconds)
+        if stacks is None:
+            self.finished(self.filename, 'A profile is already running')
+            return
+        try:
+            output_file = open(self.filename, 'w')
+            try:
+                output_file.write(stacks)
+            finally:
+                output_file.close()
+        except IOError, e:
+            self.finished(self.filename, str(e))
+        else:
+            self.finished(self.filename, None)
@@ -0,0 +1,112 @@
+"""
+Module containing functions to check the recipients of a message request &
+normalise them to international (E.164) format, so that the same number
+written in different ways is only sent to once.
+"""
+
+# Standard library modules
+import re
+import string
+
+# The country calling code used for national numbers, (i.e. "07745896325")
+DEFAULT_COUNTRY_CODE = '44'
+
+# The fewest & most digits an international number can have
+MIN_DIGITS = 7
+MAX_DIGITS = 15
+
+# The most digits a short code can have. Longer numbers without a prefix are
+# international numbers written without the "+", (i.e. "447745896325")
+MAX_SHORT_CODE_DIGITS = 8
+
+# The characters allowed in a list of recipients
+VALID_CHARS = ';,+0123456789 \t'
+
+# Patterns that find a number with a "+" that is not at the start, & an
+# international number that is too short or too long. They are searched for
+# in the normalised list, where every number is followed by a semicolon.
+MISPLACED_PLUS_RE = re.compile(r'[0-9+]\+')
+BAD_LENGTH_RE = re.compile(r'\+(?:[0-9]{0,%d}|[0-9]{%d,});' % (MIN_DIGITS - 1, MAX_DIGITS + 1))
+
+# A number without a prefix that is too long to be a short code
+BARE_INTERNATIONAL_RE = re.compile(r';(?=[1-9][0-9]{%d,};)' % MAX_SHORT_CODE_DIGITS)
+
+# Country calling codes are 1-3 digits & do not start with 0
+COUNTRY_CODE_RE = re.compile(r'[1-9][0-9]{0,2}\Z')
+
+# Translation tables that leave the characters unchanged (used to find the
+# invalid characters by deleting the valid ones) & that turn commas into
+# semicolons (used along with deleting the whitespace to clean up a list of
+# recipients in one pass)
+IDENTITY_TABLE = string.maketrans('', '')
+SEPARATOR_TABLE = string.maketrans(',', ';')
+
+def normalise(number, country_code=DEFAULT_COUNTRY_CODE):
+    """
+    Returns a number in international format. Numbers starting with "+" are
+    already international, "00" is the international prefix & a single "0"
+    is the national prefix, which is replaced with the country code. A
+    number without a prefix that is longer than a short code is international
+    without the "+". Any other number, (i.e. a short code such as "88222") is
+    left unchanged.
+    """
+    if number.startswith('+'):
+        return number
+    if number.startswith('00'):
+        return '+' + number[2:]
+    if number.startswith('0'):
+        return '+' + country_code + number[1:]
+    if len(number) > MAX_SHORT_CODE_DIGITS:
+        return '+' + number
+    return number
+
+
+def normalise_recipients(recipients, country_code=DEFAULT_COUNTRY_CODE):
+    """
+    Returns the normalised numbers (see "normalise") in a string of
+    recipients separated by semicolons or commas, in the order given &
+    including any empty entries as "". Raises ValueError with a message for
+    the client if a recipient is not a valid number.
+
+    Lists can have many thousands of recipients, so rather than looking at
+    each number in turn the whole list is normalised with string methods &
+    checked with regular expressions, which all run in C.
+    """
+    invalid_chars = recipients.translate(IDENTITY_TABLE, VALID_CHARS)
+    if invalid_chars:
+        raise ValueError('The recipient data contains an invalid character ("%s").' % invalid_chars[0])
+
+    # Remove the whitespace & put a semicolon before & after every number, so
+    # that the prefixes of all the numbers can be replaced at once
+    recipients = ';%s;' % recipients.translate(SEPARATOR_TABLE, ' \t')
+    recipients = recipients.replace(';00', ';+').replace(';0', ';+' + country_code)
+    if recipients.count(';+') != recipients.count(';') - 1:
+        recipients = BARE_INTERNATIONAL_RE.sub(';+', recipients)
+
+    # Every "+" should now be at the start of a number. Counting is quicker
+    # than searching, so the list is only searched if it has a stray "+".
+    patterns = [BAD_LENGTH_RE]
+    if recipients.count('+') != recipients.count(';+'):
+        patterns.insert(0, MISPLACED_PLUS_RE)
+    for pattern in patterns:
+        bad_number = pattern.search(recipients)
+        if bad_number is not None:
+            start = recipients.rindex(';', 0, bad_number.start() + 1) + 1
+            end = recipients.index(';', start)
+            raise ValueError('The recipient "%s" is not a valid number.' % recipients[start:end])
+
+    return recipients[1:-1].split(';')
+
+
+def parse_recipients(recipients, country_code=DEFAULT_COUNTRY_CODE):
+    """
+    Returns the list of normalised numbers in a string of recipients, (see
+    "normalise_recipients") in the order given & without duplicates.
+    """
+    numbers = filter(None, normalise_recipients(recipients, country_code))
+
+    # Remove the duplicates, keeping the first of each
+    if len(set(numbers)) == len(numbers):
+        return numbers
+    seen = set()
+    return [x for x in numbers if not (x in seen or seen.add(x))]
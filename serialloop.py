@@ -0,0 +1,354 @@
+"""
+Module containing an event loop that does the serial I/O of any number of
+modems on a single thread, using non-blocking file descriptors & select.
+"""
+
+# Standard library modules
+import errno
+import os
+import select
+import threading
+import time
+
+# fcntl is not available on Windows, where the serial ports cannot be used
+# with select
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Local application modules
+import modem
+import tracing
+
+# The most that is read from a port at a time
+READ_SIZE = 4096
+
+# How long (in seconds) the loop waits for I/O when there is nothing to time
+# out, so that it notices when it should stop
+IDLE_TIMEOUT = 1
+
+# The states of a channel's command state machine
+IDLE = 'idle'
+PROMPT = 'prompt'
+RESULT = 'result'
+
+def supported(serial_conn=None):
+    """
+    Returns True if serial ports can be multiplexed on a SerialLoop, (i.e.
+    not on Windows) & if given, the port has a file descriptor.
+    """
+    if fcntl is None:
+        return False
+    return serial_conn is None or hasattr(serial_conn, 'fileno')
+
+
+def set_non_blocking(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+
+class SerialLoop(threading.Thread):
+    """
+    Background thread that reads & writes every serial port added to it (see
+    Channel) with select, rather than a reader & a writer thread blocking on
+    each port. Other threads talk to the loop through "call", which queues a
+    function to be run by the loop thread & wakes it up, so the channels are
+    only ever touched by the loop thread & need no locks.
+    """
+    def __init__(self):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+
+        # The channels, keyed on their file descriptor
+        self.channels = {}
+
+        # Functions waiting to be run by the loop thread, as (function, args)
+        self.calls = []
+        self.calls_lock = threading.Lock()
+
+        # A pipe that is written to wake the loop up from select
+        self.wake_read, self.wake_write = os.pipe()
+        set_non_blocking(self.wake_read)
+        set_non_blocking(self.wake_write)
+
+        self.keep_running = True
+
+    def call(self, function, *args):
+        """
+        Runs a function on the loop thread. This can be called from any
+        thread & returns straight away.
+        """
+        self.calls_lock.acquire()
+        try:
+            self.calls.append((function, args))
+        finally:
+            self.calls_lock.release()
+        self.wake()
+
+    def wake(self):
+        try:
+            os.write(self.wake_write, 'x')
+        except OSError:
+
+            # The pipe is full, so the loop is going to wake up anyway
+            pass
+
+    def add(self, channel):
+        self.call(self.add_channel, channel)
+
+    def remove(self, channel):
+        self.call(self.remove_channel, channel)
+
+    def add_channel(self, channel):
+        self.channels[channel.fd] = channel
+
+    def remove_channel(self, channel):
+        if self.channels.get(channel.fd) is channel:
+            del self.channels[channel.fd]
+
+    def run(self):
+        """
+        Starts the thread which runs the loop.
+        """
+        while self.keep_running:
+            self.run_calls()
+
+            readers = [self.wake_read] + self.channels.keys()
+            writers = [fd for fd, channel in self.channels.items() if channel.output]
+            try:
+                readable, writable, errors = select.select(readers, writers, [], self.next_timeout())
+            except (select.error, OSError, ValueError), e:
+                if e.args and e.args[0] == errno.EINTR:
+                    continue
+
+                # A port has been closed without being removed first
+                self.drop_closed_channels()
+                continue
+
+            if self.wake_read in readable:
+                try:
+                    os.read(self.wake_read, READ_SIZE)
+                except OSError:
+                    pass
+            for fd in writable:
+                channel = self.channels.get(fd)
+                if channel is not None:
+                    channel.handle_write()
+            for fd in readable:
+                channel = self.channels.get(fd)
+                if channel is not None:
+                    channel.handle_read()
+
+            now = time.time()
+            for channel in self.channels.values():
+                channel.check_timeout(now)
+
+        for channel in self.channels.values():
+            channel.fail()
+        os.close(self.wake_read)
+        os.close(self.wake_write)
+
+    def stop(self):
+        self.keep_running = False
+        self.wake()
+
+    def run_calls(self):
+        self.calls_lock.acquire()
+        try:
+            calls = self.calls
+            self.calls = []
+        finally:
+            self.calls_lock.release()
+        for function, args in calls:
+            function(*args)
+
+    def next_timeout(self):
+        """
+        Returns how long select can wait before a command times out.
+        """
+        timeout = IDLE_TIMEOUT
+        now = time.time()
+        for channel in self.channels.values():
+            if channel.deadline is not None:
+                timeout = min(timeout, max(channel.deadline - now, 0))
+        return timeout
+
+    def drop_closed_channels(self):
+        for fd, channel in self.channels.items():
+            try:
+                os.fstat(fd)
+            except OSError:
+                channel.fail()
+
+
+class Channel(object):
+    """
+    The non-blocking connection to one modem on a SerialLoop. Data written
+    to the modem is buffered until the port can take it & the output of the
+    modem is parsed by a modem.ResponseParser as it arrives.
+
+    Commands (modem.Command objects) are queued with "submit" & run one at a
+    time by a state machine: once a command has been written the channel
+    waits for the "> " prompt if the command has data (state PROMPT), writes
+    the data followed by Ctrl-Z & then waits for the final result code (state
+    RESULT). A command that times out is finished with a result of None; if
+    the prompt never came the command is cancelled with ESC first. The
+    command's done_event is set when it finishes & the callback given to
+    "submit", if any, is called on the loop thread.
+    """
+    def __init__(self, loop, serial_conn, urc=None, activity=None, closed=None):
+        """
+        The "urc" parameter is a function that is called with the line & the
+        body of every unsolicited result code, "activity" is called whenever
+        anything is read & "closed" is called once the channel has been closed
+        or the port has failed. They are all called on the loop thread, so
+        must return quickly.
+        """
+        self.loop = loop
+        self.serial_conn = serial_conn
+        self.fd = serial_conn.fileno()
+        self.urc = urc
+        self.activity = activity
+        self.closed = closed
+
+        self.parser = modem.ResponseParser()
+        self.output = ''
+
+        # The commands waiting to be run, as (command, timeout, callback), &
+        # the one that is running
+        self.commands = []
+        self.current = None
+        self.state = IDLE
+        self.deadline = None
+
+        self.failed = False
+
+    def open(self):
+        """
+        Adds the channel to the loop.
+        """
+        set_non_blocking(self.fd)
+        self.loop.add(self)
+
+    def close(self):
+        """
+        Removes the channel from the loop. Commands that have not finished
+        are finished with a result of None.
+        """
+        self.loop.call(self.fail)
+
+    def submit(self, command, timeout=10, callback=None):
+        """
+        Queues a command to be run. This can be called from any thread &
+        returns straight away.
+        """
+        self.loop.call(self.queue_command, command, timeout, callback)
+
+    def queue_command(self, command, timeout, callback):
+        self.commands.append((command, timeout, callback))
+        if self.failed:
+            self.fail()
+        elif self.state == IDLE:
+            self.next_command()
+
+    def next_command(self):
+        self.current = None
+        self.state = IDLE
+        self.deadline = None
+        if not self.commands:
+            return
+
+        self.current = self.commands.pop(0)
+        command, timeout, callback = self.current
+        self.output += command.text + '\r'
+        if command.data is None:
+            command.written_at = tracing.monotonic()
+            self.state = RESULT
+        else:
+            self.state = PROMPT
+        self.deadline = time.time() + timeout
+
+    def finish(self, result=None):
+        command, timeout, callback = self.current
+        command.result = result
+        command.finished_at = tracing.monotonic()
+        command.done_event.set()
+        if callback is not None:
+            callback(command)
+        self.next_command()
+
+    def handle_read(self):
+        try:
+            data = os.read(self.fd, READ_SIZE)
+        except OSError, e:
+            if e.errno not in (errno.EAGAIN, errno.EINTR):
+                self.fail()
+            return
+        if not data:
+
+            # The device has gone, (i.e. a USB modem has been unplugged)
+            self.fail()
+            return
+
+        if self.activity is not None:
+            self.activity()
+        command = self.current and self.current[0]
+        for event_type, value in self.parser.feed(data, command):
+            if event_type == 'urc':
+                if self.urc is not None:
+                    self.urc(*value)
+            elif command is None:
+
+                # A late response to a command that timed out
+                continue
+            elif event_type == 'response':
+                command.lines.append(value)
+            elif event_type == 'prompt' and self.state == PROMPT:
+                command.prompt_event.set()
+                self.output += command.data + '\x1a'
+                command.written_at = tracing.monotonic()
+                self.state = RESULT
+                self.deadline = time.time() + self.current[1]
+            elif event_type == 'result':
+                self.finish(value)
+                command = None
+
+    def handle_write(self):
+        try:
+            written = os.write(self.fd, self.output)
+        except OSError, e:
+            if e.errno not in (errno.EAGAIN, errno.EINTR):
+                self.fail()
+            return
+        self.output = self.output[written:]
+
+    def check_timeout(self, now):
+        if self.deadline is None or now < self.deadline:
+            return
+
+        # Cancel the command rather than leaving the modem waiting for the
+        # data
+        if self.state == PROMPT:
+            self.output += '\x1b'
+        self.finish(None)
+
+    def fail(self):
+        """
+        Called on the loop thread when the port has failed or the channel is
+        closed. Every command that is waiting is finished with a result of
+        None.
+        """
+        first_failure = not self.failed
+        self.failed = True
+        self.loop.remove_channel(self)
+
+        # A command queued after the channel failed is not running yet, so it
+        # is made the current command to be finished with the rest
+        if self.current is None:
+            self.next_command()
+        while self.current is not None:
+            self.finish(None)
+        self.output = ''
+        if first_failure and self.closed is not None:
+            self.closed()
@@ -9,17 +9,38 @@ import platform
 # 3rd party modules
 from PyQt4.QtCore import *
 from PyQt4.QtGui import *
-import serial
+
+# Local application modules
+import discovery
+import recipients
+import threads
+
+def com_port_value(variant):
+    """
+    Returns the COM port setting held in a QVariant: a COM port number, or a
+    device name on systems without COM ports, (see discovery.port_name).
+    """
+    number, ok = variant.toInt()
+    if ok:
+        return number
+    return str(variant.toString())
+
 
 class SettingsDlg(QDialog):
     """
     Defines the GUI and behaviour of the application settings dialog.
     """
-    def __init__(self, user_settings, locked_com=None, locked_http=None, parent=None):
+    def __init__(self, user_settings, port_discovery, locked_com=None, locked_http=None, parent=None):
+        """
+        The "port_discovery" parameter is a discovery.PortDiscovery object
+        that is shared between dialogs, so that the ports found are
+        remembered.
+        """
         QDialog.__init__(self, parent)
 
         # Save the parameters as instance variables
         self.user_settings = user_settings
+        self.port_discovery = port_discovery
         self.locked_com = locked_com
         self.locked_http = locked_http
 
@@ -32,9 +53,17 @@ class SettingsDlg(QDialog):
         self.server_port_sb.setMinimum(1)
         self.server_port_sb.setMaximum(65536)
         self.server_port_sb.setSingleStep(1)
+        self.country_code_txt = QLineEdit()
+        self.country_code_txt.setMaxLength(3)
+        self.duplicate_window_sb = QSpinBox()
+        self.duplicate_window_sb.setMinimum(0)
+        self.duplicate_window_sb.setMaximum(3600)
+        self.duplicate_window_sb.setSingleStep(10)
+        self.duplicate_window_sb.setSuffix(self.tr(' s'))
+        self.duplicate_window_sb.setSpecialValueText(self.tr('Never'))
         self.refresh_btn = QPushButton(QIcon(':/images/action_refresh.gif'), '')
         self.refresh_btn.setMaximumWidth(30)
-        self.connect(self.refresh_btn, SIGNAL('clicked()'), self.populate_com_ports)
+        self.connect(self.refresh_btn, SIGNAL('clicked()'), self.refresh_com_ports)
 
         grid_layout = QGridLayout()
         grid_layout.addWidget(QLabel(self.tr('COM Port:')), 0, 0)
@@ -42,6 +71,14 @@ class SettingsDlg(QDialog):
         grid_layout.addWidget(self.refresh_btn, 0, 2)
         grid_layout.addWidget(QLabel(self.tr('HTTP Server Port:')), 1, 0)
         grid_layout.addWidget(self.server_port_sb, 1, 1)
+        grid_layout.addWidget(QLabel(self.tr('Default Country Code:')), 2, 0)
+        grid_layout.addWidget(self.country_code_txt, 2, 1)
+        grid_layout.addWidget(QLabel(self.tr('Drop Repeats Within:')), 3, 0)
+        grid_layout.addWidget(self.duplicate_window_sb, 3, 1)
+        self.delivery_reports_cb = QCheckBox(self.tr('Request delivery reports'))
+        grid_layout.addWidget(self.delivery_reports_cb, 4, 1)
+        self.receive_messages_cb = QCheckBox(self.tr('Receive SMS messages'))
+        grid_layout.addWidget(self.receive_messages_cb, 5, 1)
 
         self.duration_sb = QSpinBox()
         self.duration_sb.setMinimum(1)
@@ -80,6 +117,83 @@ class SettingsDlg(QDialog):
         self.http_log_gb.setLayout(http_log_box)
         self.connect(self.http_log_btn, SIGNAL('clicked()'), self.get_http_log_filename)
 
+        self.blocklist_txt = QLineEdit()
+        self.blocklist_btn = QPushButton(QIcon(':/images/folder_page.gif'), '')
+        self.blocklist_gb = QGroupBox(self.tr('Block numbers that have opted out'))
+        self.blocklist_gb.setCheckable(True)
+        self.blocklist_gb.setChecked(False)
+        blocklist_box = QHBoxLayout()
+        blocklist_box.addWidget(QLabel(self.tr('Blocklist File:')))
+        blocklist_box.addWidget(self.blocklist_txt)
+        blocklist_box.addWidget(self.blocklist_btn)
+        self.blocklist_gb.setLayout(blocklist_box)
+        self.connect(self.blocklist_btn, SIGNAL('clicked()'), self.get_blocklist_filename)
+
+        self.webhook_url_txt = QLineEdit()
+        self.webhook_gb = QGroupBox(self.tr('Forward received SMS messages'))
+        self.webhook_gb.setCheckable(True)
+        self.webhook_gb.setChecked(False)
+        webhook_box = QHBoxLayout()
+        webhook_box.addWidget(QLabel(self.tr('Webhook URL:')))
+        webhook_box.addWidget(self.webhook_url_txt)
+        self.webhook_gb.setLayout(webhook_box)
+
+        self.baud_rate_cb = QComboBox()
+        self.baud_rate_cb.addItem(self.tr('Detect automatically'), QVariant(0))
+        for baud_rate in sorted(threads.BAUD_RATES):
+            self.baud_rate_cb.addItem('%d' % baud_rate, QVariant(baud_rate))
+        self.rts_cts_cb = QCheckBox(self.tr('Hardware flow control (RTS/CTS)'))
+        self.write_timeout_sb = QSpinBox()
+        self.write_timeout_sb.setMinimum(0)
+        self.write_timeout_sb.setMaximum(60)
+        self.write_timeout_sb.setSingleStep(1)
+        self.write_timeout_sb.setSuffix(self.tr(' s'))
+        self.write_timeout_sb.setSpecialValueText(self.tr('Never'))
+        serial_options_gb = QGroupBox(self.tr('Serial port options'))
+        serial_options_layout = QGridLayout()
+        serial_options_layout.addWidget(QLabel(self.tr('Baud Rate:')), 0, 0)
+        serial_options_layout.addWidget(self.baud_rate_cb, 0, 1)
+        serial_options_layout.addWidget(self.rts_cts_cb, 0, 2)
+        serial_options_layout.addWidget(QLabel(self.tr('Write Timeout:')), 1, 0)
+        serial_options_layout.addWidget(self.write_timeout_sb, 1, 1)
+        serial_options_gb.setLayout(serial_options_layout)
+
+        self.log_flush_sb = QSpinBox()
+        self.log_flush_sb.setMinimum(0)
+        self.log_flush_sb.setMaximum(60)
+        self.log_flush_sb.setSingleStep(1)
+        self.log_flush_sb.setSuffix(self.tr(' s'))
+        self.log_max_size_sb = QSpinBox()
+        self.log_max_size_sb.setMinimum(0)
+        self.log_max_size_sb.setMaximum(2048)
+        self.log_max_size_sb.setSingleStep(1)
+        self.log_max_size_sb.setSuffix(self.tr(' MB'))
+        self.log_max_size_sb.setSpecialValueText(self.tr('Never'))
+        self.log_rotate_daily_cb = QCheckBox(self.tr('Rotate daily'))
+        self.log_backup_count_sb = QSpinBox()
+        self.log_backup_count_sb.setMinimum(1)
+        self.log_backup_count_sb.setMaximum(99)
+        self.log_backup_count_sb.setSingleStep(1)
+        self.log_compress_cb = QCheckBox(self.tr('Compress old log files'))
+        self.log_format_cb = QComboBox()
+        self.log_format_cb.addItem(self.tr('Plain text'), QVariant('text'))
+        self.log_format_cb.addItem(self.tr('JSON Lines (indexed)'), QVariant('json'))
+        self.log_traces_cb = QCheckBox(self.tr('Write message traces'))
+        log_options_gb = QGroupBox(self.tr('Log file options'))
+        log_options_layout = QGridLayout()
+        log_options_layout.addWidget(QLabel(self.tr('Flush Interval:')), 0, 0)
+        log_options_layout.addWidget(self.log_flush_sb, 0, 1)
+        log_options_layout.addWidget(QLabel(self.tr('Rotate At Size:')), 1, 0)
+        log_options_layout.addWidget(self.log_max_size_sb, 1, 1)
+        log_options_layout.addWidget(self.log_rotate_daily_cb, 1, 2)
+        log_options_layout.addWidget(QLabel(self.tr('Old Files Kept:')), 2, 0)
+        log_options_layout.addWidget(self.log_backup_count_sb, 2, 1)
+        log_options_layout.addWidget(self.log_compress_cb, 2, 2)
+        log_options_layout.addWidget(QLabel(self.tr('Log Format:')), 3, 0)
+        log_options_layout.addWidget(self.log_format_cb, 3, 1, 1, 2)
+        log_options_layout.addWidget(self.log_traces_cb, 4, 1, 1, 2)
+        log_options_gb.setLayout(log_options_layout)
+
         # Create the "accept" and "cancel" dialog buttons
         button_box = QDialogButtonBox(QDialogButtonBox.Ok |
                                       QDialogButtonBox.Cancel)
@@ -89,9 +203,13 @@ class SettingsDlg(QDialog):
         # Create main layout
         container = QVBoxLayout()
         container.addLayout(grid_layout)
+        container.addWidget(serial_options_gb)
         container.addWidget(self.message_gb)
         container.addWidget(self.sms_log_gb)
         container.addWidget(self.http_log_gb)
+        container.addWidget(self.blocklist_gb)
+        container.addWidget(self.webhook_gb)
+        container.addWidget(log_options_gb)
         container.addWidget(button_box)
         self.setLayout(container)
 
@@ -101,40 +219,75 @@ class SettingsDlg(QDialog):
         # Populate the form with the users settings
         self.load_user_settings()
 
-    def populate_com_ports(self):
-        self.com_port_cb.clear()
-
+    def populate_com_ports(self, force=False):
+        """
+        Fills the COM port combo box. The ports found by the last scan are
+        shown straight away & a scan runs in the background to bring them up
+        to date. "force" probes every port again rather than only the ports
+        that have been plugged in since the last scan.
+        """
         if self.locked_com:
-            self.com_port_cb.addItem(str(self.locked_com))
+            self.com_port_cb.clear()
+            self.com_port_cb.addItem(str(self.locked_com), QVariant(self.locked_com))
             self.com_port_cb.setDisabled(True)
             self.refresh_btn.setDisabled(True)
-        else:
+            return
 
-            # Define a flag to check if any COM ports are available
-            port_found = False
-
-            # Attempt to connect to all available COM ports to see which are
-            # available and populate the COM port combo box.
-            for i in range(256):
-                try:
-                    serial_conn = serial.Serial(i)
-                except serial.SerialException:
-                    pass
-                else:
-                    serial_conn.close()
-                    self.com_port_cb.addItem('%d' % (i + 1))
-                    port_found = True
+        ports = self.port_discovery.cached()
+        if ports:
+            self.show_com_ports(ports)
+        else:
+            self.com_port_cb.clear()
+            self.com_port_cb.addItem(self.tr('[Searching for COM ports...]'))
+            self.com_port_cb.setDisabled(True)
+        self.refresh_btn.setDisabled(True)
+
+        # The scanner's parent is the main window, so that it is not
+        # destroyed if the dialog is closed before the scan finishes
+        self.port_scanner = threads.PortScanner(self.port_discovery, force, self.parent())
+        self.connect(self.port_scanner, SIGNAL('threadExit()'), self.port_scan_finished)
+        self.port_scanner.start()
+
+    def refresh_com_ports(self):
+        self.populate_com_ports(force=True)
+
+    def port_scan_finished(self):
+        self.show_com_ports(self.port_scanner.ports)
+        self.refresh_btn.setEnabled(True)
+
+    def show_com_ports(self, ports):
+        """
+        Fills the COM port combo box from the results of a port scan, keeping
+        the selected port if it is still available. Modems are labelled with
+        their model.
+        """
+        selected = self.com_port_cb.itemData(self.com_port_cb.currentIndex())
+        if selected.isValid():
+            com_port = com_port_value(selected)
+        else:
+            com_port = self.user_settings['com_port']
 
-            if not port_found:
-                self.com_port_cb.addItem(self.tr('[No COM ports available]'))
+        self.com_port_cb.clear()
+        for info in ports:
+            value = discovery.port_setting(info['port'])
+            if info['modem']:
+                label = '%s - %s' % (value, info['model'] or self.tr('GSM modem'))
+            else:
+                label = str(value)
+            self.com_port_cb.addItem(label, QVariant(value))
 
-            self.com_port_cb.setEnabled(True)
-            self.refresh_btn.setEnabled(True)
+        if self.com_port_cb.count() == 0:
+            self.com_port_cb.addItem(self.tr('[No COM ports available]'))
+        else:
+            index = self.com_port_cb.findData(QVariant(com_port))
+            if index != -1:
+                self.com_port_cb.setCurrentIndex(index)
+        self.com_port_cb.setEnabled(True)
 
     def load_user_settings(self):
 
         # Load the COM port combo box
-        index = self.com_port_cb.findText(str(self.user_settings['com_port']))
+        index = self.com_port_cb.findData(QVariant(self.user_settings['com_port']))
         if index != -1:
             self.com_port_cb.setCurrentIndex(index)
 
@@ -152,6 +305,32 @@ class SettingsDlg(QDialog):
                 self.server_port_sb.setValue(server_port)
                 self.server_port_sb.setEnabled(True)
 
+        # Check that the "country_code" option is a country calling code
+        if recipients.COUNTRY_CODE_RE.match(self.user_settings['country_code']):
+            self.country_code_txt.setText(self.user_settings['country_code'])
+        else:
+            raise ValueError('"country_code" option must be a country calling code of 1-3 digits')
+
+        # Check that the "duplicate_window" option is within the correct range
+        if 0 <= self.user_settings['duplicate_window'] <= 3600:
+            self.duplicate_window_sb.setValue(self.user_settings['duplicate_window'])
+        else:
+            raise ValueError('"duplicate_window" option must be between 0 and 3600')
+
+        # Check that the "delivery_reports" option is either True or False
+        if isinstance(self.user_settings['delivery_reports'], bool):
+            self.delivery_reports_cb.setChecked(self.user_settings['delivery_reports'])
+            self.delivery_reports_cb.setDisabled(bool(self.locked_com))
+        else:
+            raise ValueError('"delivery_reports" option must be either True or False')
+
+        # Check that the "receive_messages" option is either True or False
+        if isinstance(self.user_settings['receive_messages'], bool):
+            self.receive_messages_cb.setChecked(self.user_settings['receive_messages'])
+            self.receive_messages_cb.setDisabled(bool(self.locked_com))
+        else:
+            raise ValueError('"receive_messages" option must be either True or False')
+
         # Check that the "show_message" option is either True or False
         if isinstance(self.user_settings['show_message'], bool):
             self.message_gb.setChecked(self.user_settings['show_message'])
@@ -188,6 +367,96 @@ class SettingsDlg(QDialog):
         else:
             raise ValueError('"http_log_file" is not a string')
 
+        # Check that the "baud_rate" option is one of the available rates.
+        # The serial settings cannot be changed while the COM port is in use.
+        index = self.baud_rate_cb.findData(QVariant(self.user_settings['baud_rate']))
+        if index != -1:
+            self.baud_rate_cb.setCurrentIndex(index)
+            self.baud_rate_cb.setDisabled(bool(self.locked_com))
+        else:
+            raise ValueError('"baud_rate" option must be 0 or a standard baud rate')
+
+        # Check that the "rts_cts" option is either True or False
+        if isinstance(self.user_settings['rts_cts'], bool):
+            self.rts_cts_cb.setChecked(self.user_settings['rts_cts'])
+            self.rts_cts_cb.setDisabled(bool(self.locked_com))
+        else:
+            raise ValueError('"rts_cts" option must be either True or False')
+
+        # Check that the "write_timeout" option is within the correct range
+        if 0 <= self.user_settings['write_timeout'] <= 60:
+            self.write_timeout_sb.setValue(self.user_settings['write_timeout'])
+            self.write_timeout_sb.setDisabled(bool(self.locked_com))
+        else:
+            raise ValueError('"write_timeout" option must be between 0 and 60')
+
+        # Check that the "use_blocklist" option is either True or False
+        if isinstance(self.user_settings['use_blocklist'], bool):
+            self.blocklist_gb.setChecked(self.user_settings['use_blocklist'])
+        else:
+            raise ValueError('"use_blocklist" option must be either True or False')
+
+        # Check that the "blocklist_file" is a string
+        if isinstance(self.user_settings['blocklist_file'], basestring):
+            self.blocklist_txt.setText(self.user_settings['blocklist_file'])
+        else:
+            raise ValueError('"blocklist_file" is not a string')
+
+        # Check that the "forward_webhook" option is either True or False
+        if isinstance(self.user_settings['forward_webhook'], bool):
+            self.webhook_gb.setChecked(self.user_settings['forward_webhook'])
+        else:
+            raise ValueError('"forward_webhook" option must be either True or False')
+
+        # Check that the "webhook_url" is a string
+        if isinstance(self.user_settings['webhook_url'], basestring):
+            self.webhook_url_txt.setText(self.user_settings['webhook_url'])
+        else:
+            raise ValueError('"webhook_url" is not a string')
+
+        # Check that the "log_flush_interval" option is within the correct range
+        if 0 <= self.user_settings['log_flush_interval'] <= 60:
+            self.log_flush_sb.setValue(self.user_settings['log_flush_interval'])
+        else:
+            raise ValueError('"log_flush_interval" option must be between 0 and 60')
+
+        # Check that the "log_max_size" option is within the correct range
+        if 0 <= self.user_settings['log_max_size'] <= 2048:
+            self.log_max_size_sb.setValue(self.user_settings['log_max_size'])
+        else:
+            raise ValueError('"log_max_size" option must be between 0 and 2048')
+
+        # Check that the "log_rotate_daily" option is either True or False
+        if isinstance(self.user_settings['log_rotate_daily'], bool):
+            self.log_rotate_daily_cb.setChecked(self.user_settings['log_rotate_daily'])
+        else:
+            raise ValueError('"log_rotate_daily" option must be either True or False')
+
+        # Check that the "log_backup_count" option is within the correct range
+        if 1 <= self.user_settings['log_backup_count'] <= 99:
+            self.log_backup_count_sb.setValue(self.user_settings['log_backup_count'])
+        else:
+            raise ValueError('"log_backup_count" option must be between 1 and 99')
+
+        # Check that the "log_compress" option is either True or False
+        if isinstance(self.user_settings['log_compress'], bool):
+            self.log_compress_cb.setChecked(self.user_settings['log_compress'])
+        else:
+            raise ValueError('"log_compress" option must be either True or False')
+
+        # Check that the "log_format" option is one of the available formats
+        index = self.log_format_cb.findData(QVariant(self.user_settings['log_format']))
+        if index != -1:
+            self.log_format_cb.setCurrentIndex(index)
+        else:
+            raise ValueError('"log_format" option must be either "text" or "json"')
+
+        # Check that the "log_traces" option is either True or False
+        if isinstance(self.user_settings['log_traces'], bool):
+            self.log_traces_cb.setChecked(self.user_settings['log_traces'])
+        else:
+            raise ValueError('"log_traces" option must be either True or False')
+
     def get_sms_log_filename(self):
         location = QFileDialog.getSaveFileName(self,
                                                self.tr('Choose SMS Log Location'),
@@ -208,14 +477,25 @@ class SettingsDlg(QDialog):
                 location = location.replace('/','\\')
             self.http_log_txt.setText(location)
 
+    def get_blocklist_filename(self):
+        location = QFileDialog.getOpenFileName(self,
+                                               self.tr('Choose Blocklist File'),
+                                               self.blocklist_txt.text(),
+                                               'Text File (*.txt)')
+        if not location.isEmpty():
+            if platform.system() == 'Windows':
+                location = location.replace('/','\\')
+            self.blocklist_txt.setText(location)
+
     def accept(self):
 
-        # Get the COM port number. If there are no free COM ports then
-        # currentText() will return a string which will fail when converting to
-        # an integer, in which case use None.
-        try:
-            com_port = int(self.com_port_cb.currentText())
-        except ValueError:
+        # Get the COM port number. If there are no free COM ports (or the
+        # ports are still being searched) the selected item has no port
+        # number, in which case use None.
+        com_port = self.com_port_cb.itemData(self.com_port_cb.currentIndex())
+        if com_port.isValid():
+            com_port = com_port_value(com_port)
+        else:
             com_port = None
 
         if self.sms_log_gb.isChecked():
@@ -256,13 +536,65 @@ class SettingsDlg(QDialog):
         else:
             http_log_file = self.user_settings['http_log_file']
 
-        # Put the users settings into a new instance variable
-        self.updated_settings = {'com_port': com_port,
-                                 'server_port': self.server_port_sb.value(),
-                                 'show_message': self.message_gb.isChecked(),
-                                 'message_duration': self.duration_sb.value(),
-                                 'log_sms': self.sms_log_gb.isChecked(),
-                                 'sms_log_file': sms_log_file,
-                                 'log_http': self.http_log_gb.isChecked(),
-                                 'http_log_file': http_log_file}
+        # Check that the country code is a country calling code
+        country_code = str(self.country_code_txt.text()).strip().lstrip('+')
+        if not recipients.COUNTRY_CODE_RE.match(country_code):
+            QMessageBox.critical(self, self.tr('Error'), self.tr('Please enter a country calling code of 1-3 digits, i.e. 44.'), QMessageBox.Ok)
+            self.country_code_txt.setFocus()
+            self.country_code_txt.selectAll()
+            return
+
+        if self.blocklist_gb.isChecked():
+
+            # Check that the blocklist file exists
+            blocklist_file = str(self.blocklist_txt.text())
+            if not os.path.isfile(blocklist_file):
+                QMessageBox.critical(self, self.tr('Error'), self.tr('The blocklist file does not exist.'), QMessageBox.Ok)
+                self.blocklist_txt.setFocus()
+                self.blocklist_txt.selectAll()
+                return
+        else:
+            blocklist_file = self.user_settings['blocklist_file']
+
+        if self.webhook_gb.isChecked():
+
+            # Check that the webhook URL is a HTTP URL
+            webhook_url = str(self.webhook_url_txt.text()).strip()
+            if not (webhook_url.startswith('http://') or webhook_url.startswith('https://')):
+                QMessageBox.critical(self, self.tr('Error'), self.tr('Please enter a webhook URL starting with http:// or https://.'), QMessageBox.Ok)
+                self.webhook_url_txt.setFocus()
+                self.webhook_url_txt.selectAll()
+                return
+        else:
+            webhook_url = self.user_settings['webhook_url']
+
+        # Put the users settings into a new instance variable. Settings that
+        # are not shown in the dialog are kept unchanged.
+        self.updated_settings = self.user_settings.copy()
+        self.updated_settings.update({'com_port': com_port,
+                                      'server_port': self.server_port_sb.value(),
+                                      'country_code': country_code,
+                                      'duplicate_window': self.duplicate_window_sb.value(),
+                                      'delivery_reports': self.delivery_reports_cb.isChecked(),
+                                      'receive_messages': self.receive_messages_cb.isChecked(),
+                                      'baud_rate': self.baud_rate_cb.itemData(self.baud_rate_cb.currentIndex()).toInt()[0],
+                                      'rts_cts': self.rts_cts_cb.isChecked(),
+                                      'write_timeout': self.write_timeout_sb.value(),
+                                      'use_blocklist': self.blocklist_gb.isChecked(),
+                                      'blocklist_file': blocklist_file,
+                                      'forward_webhook': self.webhook_gb.isChecked(),
+                                      'webhook_url': webhook_url,
+                                      'show_message': self.message_gb.isChecked(),
+                                      'message_duration': self.duration_sb.value(),
+                                      'log_sms': self.sms_log_gb.isChecked(),
+                                      'sms_log_file': sms_log_file,
+                                      'log_http': self.http_log_gb.isChecked(),
+                                      'http_log_file': http_log_file,
+                                      'log_flush_interval': self.log_flush_sb.value(),
+                                      'log_max_size': self.log_max_size_sb.value(),
+                                      'log_rotate_daily': self.log_rotate_daily_cb.isChecked(),
+                                      'log_backup_count': self.log_backup_count_sb.value(),
+                                      'log_compress': self.log_compress_cb.isChecked(),
+                                      'log_format': str(self.log_format_cb.itemData(self.log_format_cb.currentIndex()).toString()),
+                                      'log_traces': self.log_traces_cb.isChecked()})
         QDialog.accept(self)
@@ -9,9 +9,23 @@ AUTHOR = 'Craig Dodd'
 ORGANIZATION = 'CDodd'
 COPYRIGHT = 'MIT License'
 
+# How often (in milliseconds) the GUI applies events posted by worker threads
+EVENT_INTERVAL = 100
+
+# The delay (in seconds) before the first attempt at reconnecting a lost COM
+# port. The delay doubles with each failed attempt, up to MAX_RECONNECT_DELAY.
+RECONNECT_DELAY = 1
+MAX_RECONNECT_DELAY = 300
+
+# The most messages restored from the queue snapshot that are listed in the
+# queue list box, the rest are counted by a single item
+RESTORED_ITEMS = 1000
+
 # Try to import required modules
 try:
     # Standard library modules
+    import os
+    import random
     import sys
     import threading
     import webbrowser
@@ -22,12 +36,26 @@ try:
     import serial
 
     # Local application modules
+    import blocklist
+    import discovery
+    import duplicates
     import httpserver
+    import logwriter
+    import metrics
+    import modem
+    import msgstore
+    import profiler
+    import recipients
     import resources
+    import serialloop
     import settingsdlg
+    import snapshot
+    import templates
     import threads
     import time
+    import tracing
     import util
+    import webhook
 
 # Display a Tkinter messagebox if a module failed to import (assumes that the
 # Tkinter modules are available, which they should be)
@@ -75,6 +103,18 @@ class MainWindow(QMainWindow):
         self.sent_message_lst = QListWidget()
         self.message_queue_lst = QListWidget()
         self.http_log_lst = QListWidget()
+        self.inbound_message_lst = QListWidget()
+
+        # The items of the queue list box, keyed on message ID. They are kept
+        # here rather than with the messages, so the queued messages hold no
+        # GUI objects.
+        self.queue_items = {}
+
+        # The messages restored from the queue snapshot that are not listed,
+        # (see "show_restored_messages")
+        self.restored_backlog = None
+        self.restored_item = None
+        self.restored_listed = 0
 
         # Add the listboxes as tabs
         tabs = QTabWidget()
@@ -82,6 +122,7 @@ class MainWindow(QMainWindow):
         tabs.addTab(self.sent_message_lst, self.tr('Sent Messages'))
         tabs.addTab(self.message_queue_lst, self.tr('Queued Messages'))
         tabs.addTab(self.http_log_lst, self.tr('HTTP Log'))
+        tabs.addTab(self.inbound_message_lst, self.tr('Received Messages'))
 
         # Create the main layout
         main_layout = QVBoxLayout()
@@ -125,6 +166,10 @@ class MainWindow(QMainWindow):
         self.disconnect_com_action.setDisabled(True)
         self.connect(self.disconnect_com_action, SIGNAL('triggered()'), self.disconnect_com_port)
 
+        self.profile_action = QAction('Profile Gateway...', self)
+        self.profile_action.setToolTip('Profile Gateway')
+        self.connect(self.profile_action, SIGNAL('triggered()'), self.profile_gateway)
+
         about_action = QAction('About', self)
         about_action.setToolTip('About')
         about_action.setIcon(QIcon(':/images/icon_info.gif'))
@@ -164,6 +209,8 @@ class MainWindow(QMainWindow):
         server_menu.addAction(self.start_server_action)
         server_menu.addAction(self.stop_server_action)
         server_menu.addAction(self.launch_browser_action)
+        server_menu.addSeparator()
+        server_menu.addAction(self.profile_action)
 
         com_port_menu = self.menuBar().addMenu('&COM Port')
         com_port_menu.addAction(self.connect_com_action)
@@ -195,32 +242,99 @@ class MainWindow(QMainWindow):
 
         self.log_activity('Application started')
 
+        # Store the Qt system tray icons in the class instance for external
+        # access by other modules (so they don't need to import the Qt modules)
+        self.tray_icon_critical = QSystemTrayIcon.MessageIcon(QSystemTrayIcon.Critical)
+        self.tray_icon_information = QSystemTrayIcon.MessageIcon(QSystemTrayIcon.Information)
+
         # Load saved settings
         self.load_settings()
 
         # Create a queue to store SMS messages
         self.msg_queue = util.CustomQueue()
+        metrics.QUEUE_DEPTH.set_function(self.msg_queue.qsize)
 
         # Create a serial object & a mutex to access it
         self.serial_conn = serial.Serial()
         self.serial_conn_mutex = threading.Lock()
 
+        # Worker threads never touch the GUI directly. Instead they post events
+        # to a buffer which is drained by a timer on the GUI thread, so that
+        # widget updates are applied in batches.
+        self.event_buffer = util.EventBuffer()
+        self.event_timer = QTimer(self)
+        self.connect(self.event_timer, SIGNAL('timeout()'), self.process_events)
+        self.event_timer.start(EVENT_INTERVAL)
+
+        # Create a background thread to write the log files. A user could
+        # potentially use the same filename for the SMS and HTTP logs. As all
+        # writes go through the one thread there are no access conflicts.
+        self.log_writer = logwriter.LogWriter(self.log_write_error)
+        self.configure_log_writer()
+        self.log_writer.start()
+
+        # Create a timer to reconnect the COM port after the connection is
+        # lost
+        self.reconnect_timer = QTimer(self)
+        self.reconnect_timer.setSingleShot(True)
+        self.connect(self.reconnect_timer, SIGNAL('timeout()'), self.reconnect_com_port)
+        self.reconnecting = False
+        self.reconnect_attempts = 0
+        self.modem_identity = None
+
+        # Create the cache of the serial ports & modems found on the system,
+        # used by the settings dialog & when searching for a lost modem
+        self.port_discovery = discovery.PortDiscovery()
+
+        # Create the event loop that does the serial I/O, where the serial
+        # ports can be multiplexed (not on Windows, where each port is read
+        # by its own thread instead)
+        self.io_loop = None
+        if serialloop.supported():
+            self.io_loop = serialloop.SerialLoop()
+            self.io_loop.start()
+
+        # The capabilities of the modems that have been connected, keyed on
+        # their identity, so that a modem is only probed once
+        self.modem_profiles = {}
+        self.modem_model = None
+
+        # Create the index used to match delivery reports to sent messages
+        self.report_index = modem.DeliveryReportIndex()
+
+        # Create the stream of events served to "/events" clients
+        self.event_stream = httpserver.EventStream()
+
+        # Create the filter that drops repeats of recently sent messages
+        self.duplicate_filter = duplicates.DuplicateFilter(self.settings['duplicate_window'])
+
+        # Load the numbers that have opted out of receiving messages
+        self.blocklist = None
+        self.pending_blocklist = None
+        self.configure_blocklist()
+
+        # Create the database that records the status of every message, then
+        # put any messages that were not sent before the last exit back into
+        # the queue
+        self.message_store = msgstore.MessageStore(self.settings['message_db_file'], self.message_store_error)
+        self.message_store.start()
+        self.restore_queue()
+
+        # Create a background thread to forward received messages to the
+        # webhook, starting with any that were not forwarded before the last
+        # exit
+        self.webhook_sender = webhook.WebhookSender(self.settings['webhook_url'], self.inbound_forwarded)
+        self.webhook_sender.start()
+        if self.settings['forward_webhook']:
+            for inbound_data in self.message_store.unforwarded_inbound():
+                self.webhook_sender.forward(inbound_data)
+
         # Connect the COM port & server if necessary
         if self.auto_com_connect:
             self.connect_com_port(silent_fail=False)
         if self.auto_server:
             self.start_server()
 
-        # Create a mutex for accessing log files. A user could potentially use
-        # the same filename for the SMS and HTTP logs. A mutex makes sure
-        # there are no access conflicts.
-        self.log_file_lock = threading.Lock()
-
-        # Store the Qt system tray icons in the class instance for external
-        # access by other modules (so they don't need to import the Qt modules)
-        self.tray_icon_critical = QSystemTrayIcon.MessageIcon(QSystemTrayIcon.Critical)
-        self.tray_icon_information = QSystemTrayIcon.MessageIcon(QSystemTrayIcon.Information)
-
     def launch_browser(self):
         if self.settings['server_port'] == 80:
             address = 'http://localhost/sms_sender.html'
@@ -231,7 +345,8 @@ class MainWindow(QMainWindow):
 
     def connect_com_port(self, silent_fail=False):
         """
-        Connects to the COM port chosen in the settings dialog.
+        Connects to the COM port chosen in the settings dialog. Returns True
+        if the port was connected.
         """
 
         # Check if a COM port has been defined
@@ -240,10 +355,18 @@ class MainWindow(QMainWindow):
             # Display a message box if necessary & return
             if not silent_fail:
                 QMessageBox.critical(self, 'SMS Gateway Server - Error', 'No COM port selected. Please choose a COM port in the settings menu.', QMessageBox.Ok)
-            return
-
-        # Set the serial port in the serial object
-        self.serial_conn.port = 'COM%s' % self.settings['com_port']
+            return False
+
+        # Set the serial port in the serial object. A read timeout lets the
+        # reader thread check regularly whether it should stop, and a write
+        # timeout stops a modem that is not reading (i.e. holding CTS low)
+        # from blocking the sender forever. If the baud rate is detected
+        # automatically the port is opened at the first rate that is tried.
+        self.serial_conn.port = discovery.port_name(self.settings['com_port'])
+        self.serial_conn.timeout = 1
+        self.serial_conn.baudrate = self.settings['baud_rate'] or threads.BAUD_RATES[0]
+        self.serial_conn.rtscts = self.settings['rts_cts']
+        self.serial_conn.writeTimeout = self.settings['write_timeout'] or None
 
         try:
 
@@ -255,44 +378,88 @@ class MainWindow(QMainWindow):
             if not silent_fail:
                 QMessageBox.critical(self,
                                      self.tr('SMS Gateway Server - Error'),
-                                     self.tr('Could not connect to COM port (COM%s). Please check the COM port settings.' % self.settings['com_port']),
+                                     self.tr('Could not connect to COM port (%s). Please check the COM port settings.' % self.serial_conn.port),
                                      QMessageBox.Ok)
 
             # Update the GUI
             self.connect_com_action.setEnabled(True)
             self.disconnect_com_action.setDisabled(True)
             self.com_status_lbl.setText(self.tr('<font size="+1" color="grey">Not connected</font>'))
+            return False
         else:
 
+            # Stop any attempts at reconnecting
+            self.reconnect_timer.stop()
+            self.reconnecting = False
+            self.reconnect_attempts = 0
+
+            # Create & start a thread to read the modem output
+            self.modem_reader = threads.ModemReader(self.serial_conn,
+                                                    self.serial_conn_mutex,
+                                                    self.report_index,
+                                                    self.delivery_report,
+                                                    self.message_arrived,
+                                                    self.modem_health,
+                                                    self.io_loop)
+            self.modem_reader.open()
+
+            # Turn off command echo & ask for +CREG codes when the network
+            # registration changes, then ask the modem to pass delivery reports
+            # straight to the serial port (+CDS) & to announce received
+            # messages as they are stored (+CMTI) if they are wanted
+            setup_commands = ['ATE0', 'AT+CREG=1']
+            if self.settings['delivery_reports'] or self.settings['receive_messages']:
+                setup_commands.append('AT+CNMI=2,%d,0,%d,0' % (int(self.settings['receive_messages']),
+                                                               int(self.settings['delivery_reports'])))
+
+            # Read any messages that arrived while the gateway was not running
+            if self.settings['receive_messages']:
+                self.modem_reader.list_stored_messages()
+
             # Create & start a thread to process the message queue
             self.sender_thread = threads.MsgSender(self.msg_queue,
                                                    self.serial_conn,
                                                    self.serial_conn_mutex,
-                                                   self.message_sent)
+                                                   self.message_sent,
+                                                   self.message_status,
+                                                   self.modem_reader,
+                                                   self.settings['delivery_reports'],
+                                                   setup_commands,
+                                                   self.modem_profiles,
+                                                   not self.settings['baud_rate'],
+                                                   self.sim_location_changed)
             self.connect(self.sender_thread, SIGNAL('threadExit()'), self.com_disconnected)
             self.sender_thread.start()
 
-            # Create & start a thread to monitor the connection status
-            self.com_checker = threads.COMChecker(self)
-            self.com_checker.start()
-
             # Update the GUI
             self.connect_com_action.setDisabled(True)
             self.disconnect_com_action.setEnabled(True)
-            self.com_status_lbl.setText(self.tr('<font size="+1" color="green"><b>Connected (COM%d)</b></font>' % self.settings['com_port']))
-            self.log_activity('COM port connected (COM%d)' % self.settings['com_port'])
+            self.com_status_lbl.setText(self.tr('<font size="+1" color="green"><b>Connected (%s)</b></font>' % self.serial_conn.port))
+            self.log_activity('COM port connected (%s)' % self.serial_conn.port)
+            self.event_stream.publish('modem', {'state': 'connected', 'port': self.serial_conn.port})
+            return True
 
     def disconnect_com_port(self, block=False):
 
         # Update the GUI
         self.disconnect_com_action.setDisabled(True)
 
-        # Stop the thread that monitors the COM port connection.
+        # Stop any attempts at reconnecting
+        self.reconnect_timer.stop()
+        self.reconnecting = False
         try:
-            if self.com_checker.isRunning():
-                self.com_checker.stop()
+            if self.port_finder.isRunning():
+                self.port_finder.stop()
                 if block:
-                    self.com_checker.wait()
+                    self.port_finder.wait()
+        except AttributeError:
+            pass
+
+        # Stop the thread (or the I/O loop) reading the modem output
+        try:
+            self.modem_reader.stop()
+            if block and self.modem_reader.isRunning():
+                self.modem_reader.wait()
         except AttributeError:
             pass
 
@@ -315,8 +482,15 @@ class MainWindow(QMainWindow):
         self.com_status_lbl.setText(self.tr('<font size="+1" color="grey">Not connected</font>'))
 
         try:
-            if not self.sender_thread.conn_error:
+            if self.sender_thread.conn_error:
+
+                # The sender thread stopped because the port failed or the
+                # modem stopped responding
+                self.modem_reader.stop()
+                self.com_connection_lost()
+            else:
                 self.log_activity('COM port disconnected')
+                self.event_stream.publish('modem', {'state': 'disconnected', 'port': self.serial_conn.port})
         except AttributeError:
             pass
 
@@ -341,7 +515,7 @@ class MainWindow(QMainWindow):
             self.settings['com_port'] = None
             self.auto_com_connect = False
         else:
-            self.settings['com_port'] = com_port.toInt()[0]
+            self.settings['com_port'] = settingsdlg.com_port_value(com_port)
             self.auto_com_connect = True
 
         # Get the server port setting
@@ -353,6 +527,35 @@ class MainWindow(QMainWindow):
             self.settings['server_port'] = server_port.toInt()[0]
             self.auto_server = True
 
+        # Get the "Country Code" setting, which is given to national numbers
+        country_code = saved_settings.value('country_code')
+        if country_code.isNull():
+            self.settings['country_code'] = recipients.DEFAULT_COUNTRY_CODE
+        else:
+            self.settings['country_code'] = str(country_code.toString())
+
+        # Get the "Duplicate Window" setting (0 sends repeated messages)
+        duplicate_window = saved_settings.value('duplicate_window')
+        if duplicate_window.isNull():
+            self.settings['duplicate_window'] = duplicates.DEFAULT_WINDOW
+        else:
+            self.settings['duplicate_window'] = duplicate_window.toInt()[0]
+
+        # Get the "Use Blocklist" setting
+        use_blocklist = saved_settings.value('use_blocklist')
+        if use_blocklist.isNull():
+            self.settings['use_blocklist'] = False
+        else:
+            self.settings['use_blocklist'] = use_blocklist.toBool()
+
+        # Get the "Blocklist File" setting. By default the blocklist is kept
+        # with the application.
+        blocklist_file = saved_settings.value('blocklist_file')
+        if blocklist_file.isNull():
+            self.settings['blocklist_file'] = os.path.join(os.path.dirname(os.path.abspath(sys.argv[0])), 'blocklist.txt')
+        else:
+            self.settings['blocklist_file'] = str(blocklist_file.toString())
+
         # Get the "show message" setting
         show_message = saved_settings.value('show_message')
         if show_message.isNull():
@@ -395,6 +598,120 @@ class MainWindow(QMainWindow):
         else:
             self.settings['http_log_file'] = str(http_log_file.toString())
 
+        # Get the "Log Flush Interval" setting
+        log_flush_interval = saved_settings.value('log_flush_interval')
+        if log_flush_interval.isNull():
+            self.settings['log_flush_interval'] = 1
+        else:
+            self.settings['log_flush_interval'] = log_flush_interval.toInt()[0]
+
+        # Get the "Log Max Size" setting (in MB, 0 disables size rotation)
+        log_max_size = saved_settings.value('log_max_size')
+        if log_max_size.isNull():
+            self.settings['log_max_size'] = 0
+        else:
+            self.settings['log_max_size'] = log_max_size.toInt()[0]
+
+        # Get the "Log Rotate Daily" setting
+        log_rotate_daily = saved_settings.value('log_rotate_daily')
+        if log_rotate_daily.isNull():
+            self.settings['log_rotate_daily'] = False
+        else:
+            self.settings['log_rotate_daily'] = log_rotate_daily.toBool()
+
+        # Get the "Log Backup Count" setting
+        log_backup_count = saved_settings.value('log_backup_count')
+        if log_backup_count.isNull():
+            self.settings['log_backup_count'] = 5
+        else:
+            self.settings['log_backup_count'] = log_backup_count.toInt()[0]
+
+        # Get the "Log Compress" setting
+        log_compress = saved_settings.value('log_compress')
+        if log_compress.isNull():
+            self.settings['log_compress'] = False
+        else:
+            self.settings['log_compress'] = log_compress.toBool()
+
+        # Get the "Baud Rate" setting (0 detects the baud rate automatically)
+        baud_rate = saved_settings.value('baud_rate')
+        if baud_rate.isNull():
+            self.settings['baud_rate'] = 9600
+        else:
+            self.settings['baud_rate'] = baud_rate.toInt()[0]
+
+        # Get the "RTS/CTS Flow Control" setting
+        rts_cts = saved_settings.value('rts_cts')
+        if rts_cts.isNull():
+            self.settings['rts_cts'] = False
+        else:
+            self.settings['rts_cts'] = rts_cts.toBool()
+
+        # Get the "Write Timeout" setting (0 waits forever)
+        write_timeout = saved_settings.value('write_timeout')
+        if write_timeout.isNull():
+            self.settings['write_timeout'] = 10
+        else:
+            self.settings['write_timeout'] = write_timeout.toInt()[0]
+
+        # Get the "Delivery Reports" setting
+        delivery_reports = saved_settings.value('delivery_reports')
+        if delivery_reports.isNull():
+            self.settings['delivery_reports'] = False
+        else:
+            self.settings['delivery_reports'] = delivery_reports.toBool()
+
+        # Get the "Receive Messages" setting
+        receive_messages = saved_settings.value('receive_messages')
+        if receive_messages.isNull():
+            self.settings['receive_messages'] = False
+        else:
+            self.settings['receive_messages'] = receive_messages.toBool()
+
+        # Get the "Forward Webhook" setting
+        forward_webhook = saved_settings.value('forward_webhook')
+        if forward_webhook.isNull():
+            self.settings['forward_webhook'] = False
+        else:
+            self.settings['forward_webhook'] = forward_webhook.toBool()
+
+        # Get the "Webhook URL" setting
+        webhook_url = saved_settings.value('webhook_url')
+        if webhook_url.isNull():
+            self.settings['webhook_url'] = ''
+        else:
+            self.settings['webhook_url'] = str(webhook_url.toString())
+
+        # Get the "Message Database File" setting (not shown in the settings
+        # dialog). By default the database is kept with the application.
+        message_db_file = saved_settings.value('message_db_file')
+        if message_db_file.isNull():
+            self.settings['message_db_file'] = os.path.join(os.path.dirname(os.path.abspath(sys.argv[0])), 'messages.db')
+        else:
+            self.settings['message_db_file'] = str(message_db_file.toString())
+
+        # Get the "Log Traces" setting
+        log_traces = saved_settings.value('log_traces')
+        if log_traces.isNull():
+            self.settings['log_traces'] = False
+        else:
+            self.settings['log_traces'] = log_traces.toBool()
+
+        # Get the "Trace File" setting (not shown in the settings dialog). By
+        # default the traces are kept with the application.
+        trace_file = saved_settings.value('trace_file')
+        if trace_file.isNull():
+            self.settings['trace_file'] = os.path.join(os.path.dirname(os.path.abspath(sys.argv[0])), 'traces.jsonl')
+        else:
+            self.settings['trace_file'] = str(trace_file.toString())
+
+        # Get the "Log Format" setting ("text" or "json")
+        log_format = saved_settings.value('log_format')
+        if log_format.isNull():
+            self.settings['log_format'] = 'text'
+        else:
+            self.settings['log_format'] = str(log_format.toString())
+
     def edit_settings(self):
 
         # Detect if the HTTP server is running and if so get the port number
@@ -410,24 +727,64 @@ class MainWindow(QMainWindow):
             com_port = None
 
         settings_dlg = settingsdlg.SettingsDlg(self.settings,
+                                               self.port_discovery,
                                                locked_http=serv_port,
                                                locked_com=com_port,
                                                parent=self)
         if settings_dlg.exec_():
 
             # Get the updated settings from the dialog window
+            was_forwarding = self.settings['forward_webhook']
             self.settings = settings_dlg.updated_settings
 
             # Save the settings using a QSettings object
             saved_settings = QSettings()
             saved_settings.setValue('com_port', QVariant(self.settings['com_port']))
             saved_settings.setValue('server_port', QVariant(self.settings['server_port']))
+            saved_settings.setValue('country_code', QVariant(self.settings['country_code']))
+            saved_settings.setValue('duplicate_window', QVariant(self.settings['duplicate_window']))
+            saved_settings.setValue('use_blocklist', QVariant(self.settings['use_blocklist']))
+            saved_settings.setValue('blocklist_file', QVariant(self.settings['blocklist_file']))
             saved_settings.setValue('show_message', QVariant(self.settings['show_message']))
             saved_settings.setValue('message_duration', QVariant(self.settings['message_duration']))
             saved_settings.setValue('log_sms', QVariant(self.settings['log_sms']))
             saved_settings.setValue('sms_log_file', QVariant(self.settings['sms_log_file']))
             saved_settings.setValue('log_http', QVariant(self.settings['log_http']))
             saved_settings.setValue('http_log_file', QVariant(self.settings['http_log_file']))
+            saved_settings.setValue('log_flush_interval', QVariant(self.settings['log_flush_interval']))
+            saved_settings.setValue('log_max_size', QVariant(self.settings['log_max_size']))
+            saved_settings.setValue('log_rotate_daily', QVariant(self.settings['log_rotate_daily']))
+            saved_settings.setValue('log_backup_count', QVariant(self.settings['log_backup_count']))
+            saved_settings.setValue('log_compress', QVariant(self.settings['log_compress']))
+            saved_settings.setValue('log_format', QVariant(self.settings['log_format']))
+            saved_settings.setValue('log_traces', QVariant(self.settings['log_traces']))
+            saved_settings.setValue('baud_rate', QVariant(self.settings['baud_rate']))
+            saved_settings.setValue('rts_cts', QVariant(self.settings['rts_cts']))
+            saved_settings.setValue('write_timeout', QVariant(self.settings['write_timeout']))
+            saved_settings.setValue('delivery_reports', QVariant(self.settings['delivery_reports']))
+            saved_settings.setValue('receive_messages', QVariant(self.settings['receive_messages']))
+            saved_settings.setValue('forward_webhook', QVariant(self.settings['forward_webhook']))
+            saved_settings.setValue('webhook_url', QVariant(self.settings['webhook_url']))
+
+            # Apply the new log file options
+            self.configure_log_writer()
+
+            # Apply the new duplicate window, blocklist & country code
+            if self.settings['duplicate_window'] != self.duplicate_filter.window:
+                self.duplicate_filter.set_window(self.settings['duplicate_window'])
+            self.configure_blocklist()
+            try:
+                self.server_thread.http_server.country_code = self.settings['country_code']
+                self.server_thread.http_server.blocklist = self.blocklist
+            except AttributeError:
+                pass
+
+            # Apply the new webhook URL. If forwarding has just been turned on
+            # then the messages received in the meantime are forwarded too.
+            self.webhook_sender.set_url(self.settings['webhook_url'])
+            if self.settings['forward_webhook'] and not was_forwarding:
+                for inbound_data in self.message_store.unforwarded_inbound():
+                    self.webhook_sender.forward(inbound_data)
 
         # For some reason if the main window is not currently visible (i.e. the
         # program is running from the system tray) the program will crash when
@@ -479,6 +836,25 @@ class MainWindow(QMainWindow):
         # Stop the HTTP server & disconnect the COM port
         self.stop_server(block=True)
         self.disconnect_com_port(block=True)
+        if self.io_loop is not None:
+            self.io_loop.stop()
+
+        # Apply any events that the worker threads posted while stopping
+        self.process_events()
+
+        # Messages that have not been forwarded yet are forwarded after the
+        # next start
+        self.webhook_sender.stop()
+
+        # Write any remaining log lines & message changes to disk
+        self.log_writer.stop()
+        self.log_writer.join()
+        self.message_store.stop()
+        self.message_store.join()
+
+        # Save the messages that are still queued, so that they are back in
+        # the queue as soon as the application starts again
+        self.save_queue()
 
         # Exit the application
         QApplication.exit()
@@ -489,7 +865,14 @@ class MainWindow(QMainWindow):
         """
 
         # Create & start the HTTP server
-        self.server_thread = threads.MsgReceiver(self.log_http_data, self.message_received, self.settings['server_port'])
+        self.server_thread = threads.MsgReceiver(self.log_http_data,
+                                                 self.message_received,
+                                                 self.message_store,
+                                                 self.event_stream,
+                                                 self.settings['server_port'],
+                                                 country_code=self.settings['country_code'],
+                                                 duplicate_filter=self.duplicate_filter,
+                                                 blocklist=self.blocklist)
         self.connect(self.server_thread, SIGNAL('threadExit()'), self.server_stopped)
         self.server_thread.start()
 
@@ -526,94 +909,709 @@ class MainWindow(QMainWindow):
         self.server_status_lbl.setText(self.tr('<font size="+1" color="grey">Not running</font>'))
         self.log_activity('Server stopped')
 
-    def message_sent(self, message_data):
+    def configure_log_writer(self):
+        """
+        Passes the log file options from the settings to the log writer.
+        """
+        if self.settings['log_rotate_daily']:
+            rotate_interval = util.secs_from_days(1)
+        else:
+            rotate_interval = 0
 
-        # Get the message data & remove the line breaks
-        message_text = message_data['message']
-        message_text = message_text.replace('\r\n', ' ')
-        message_text = message_text.replace('\n', ' ')
+        self.log_writer.configure(flush_interval=self.settings['log_flush_interval'],
+                                  max_bytes=self.settings['log_max_size'] * 1024 * 1024,
+                                  rotate_interval=rotate_interval,
+                                  backup_count=self.settings['log_backup_count'],
+                                  compress=self.settings['log_compress'])
 
-        # Make a truncated version for GUI display
-        truncated_text = message_text[:57] + '...' if len(message_text) > 60 else message_text
+    def log_write_error(self, filename):
+        """
+        This function is called by the log writer thread when a log file could
+        not be written to.
+        """
+        self.event_buffer.put('activity', ('Error when writing to the log file (%s).' % filename, True))
 
-        # Update the SMS log list box
-        list_item = QListWidgetItem('%s - %s - %s - C%d: %s' % (message_data['timestamp'],
-                                                               message_data['sender_ip'],
-                                                               message_data['recipient'],
-                                                               message_data['class'],
-                                                               truncated_text))
-        self.sent_message_lst.addItem(list_item)
-        self.sent_message_lst.setCurrentItem(list_item)
+    def message_sent(self, message_data):
+        """
+        This function is called by the sender thread once a message has been
+        sent. The message is passed to the log writer & the GUI is updated
+        later by "process_events".
+        """
 
-        # Remove the message from the queue list box
-        row = self.message_queue_lst.row(message_data['widget'])
-        self.message_queue_lst.takeItem(row)
+        self.message_store.set_status(message_data.id, msgstore.SENT)
+        self.publish_status(message_data, msgstore.SENT)
 
         # Write to the log text file
         if self.settings['log_sms']:
-            self.log_file_lock.acquire()
+            self.write_sms_log(message_data, msgstore.SENT)
+        self.finish_trace(message_data, msgstore.SENT)
+
+        self.event_buffer.put('sent', message_data)
+
+    def message_status(self, message_data, status, error=None):
+        """
+        This function is called by the sender thread when the status of a
+        message changes (other than when it is sent, see "message_sent"). A
+        message that has failed is taken off the queue list box later by
+        "process_events".
+        """
+        # The text of a template message is recorded once it has been rendered
+        if status == msgstore.SENDING and message_data.template is not None:
+            self.message_store.set_status(message_data.id, status, error, message_data.message)
+        else:
+            self.message_store.set_status(message_data.id, status, error)
+        self.publish_status(message_data, status, error)
+        if status == msgstore.FAILED:
+            self.finish_trace(message_data, status)
+            self.forget_duplicate(message_data)
+            self.event_buffer.put('failed', (message_data, error))
+
+    def forget_duplicate(self, message_data):
+        """
+        Removes a message that could not be sent from the duplicate filter,
+        so that the client can send it again straight away, (see
+        httpserver.HTTPHandler.queue_messages).
+        """
+        if message_data.template is None:
+            text_key = duplicates.text_key(message_data.job.message)
+        else:
+            text_key = duplicates.template_key(message_data.template.id, message_data.variables)
+        self.duplicate_filter.forget(message_data.recipient, text_key)
+
+    def sim_location_changed(self, message_data):
+        """
+        This function is called by the sender thread when a message that is
+        being sent is stored on the SIM or removed from it.
+        """
+        self.message_store.set_sim_location(message_data.id, message_data.sim_location)
+
+    def finish_trace(self, message_data, status):
+        """
+        Adds the trace of a message that has been sent (or has failed) to the
+        summary, & writes it to the trace file if required, (see tracing).
+        """
+        tracing.SUMMARY.add(message_data.trace)
+        if self.settings['log_traces']:
+            self.log_writer.write(self.settings['trace_file'],
+                                  util.json.dumps(tracing.trace_record(message_data, status)) + '\n')
+
+    def publish_status(self, message_data, status, error=None):
+        """
+        Sends a message status event to the "/events" clients.
+        """
+        self.event_stream.publish(status, {'id': message_data.id,
+                                           'recipient': message_data.recipient,
+                                           'status': status,
+                                           'error': error,
+                                           'time': time.time()})
+
+    def delivery_report(self, message_data, outcome, report_status):
+        """
+        This function is called by the modem reader thread (or the I/O loop)
+        when a delivery report is matched to a sent message. The message is
+        kept by the report index, so nothing is read from the database.
+        """
+        if outcome == modem.DELIVERED:
+            status = msgstore.DELIVERED
+            error = None
+        else:
+            status = msgstore.FAILED
+            error = 'The message could not be delivered (status %d)' % report_status
+        self.message_store.set_status(message_data.id, status, error)
+        self.publish_status(message_data, status, error)
+        if self.settings['log_sms']:
+            self.write_sms_log(message_data, status)
+
+    def message_arrived(self, sender, text, timestamp):
+        """
+        This function is called by the modem reader thread when a message is
+        received. The message is recorded in the message database & forwarded
+        to the webhook if necessary. The GUI is updated later by
+        "process_events".
+        """
+        now = time.time()
+        inbound_data = {'time': now,
+                        'timestamp': time.strftime('%d/%m/%y %H:%M:%S', time.localtime(now)),
+                        'sender': sender,
+                        'message': text.encode('utf-8'),
+                        'sent_at': timestamp}
+        self.message_store.add_inbound(inbound_data)
+        if self.settings['forward_webhook']:
+            self.webhook_sender.forward(inbound_data)
+
+        self.event_stream.publish('inbound', {'id': inbound_data['id'],
+                                              'sender': sender,
+                                              'message': inbound_data['message'],
+                                              'sent_at': timestamp,
+                                              'time': now})
+        self.event_buffer.put('inbound', inbound_data)
+
+    def inbound_forwarded(self, inbound_id, error):
+        """
+        This function is called by the webhook thread after each attempt at
+        forwarding a received message.
+        """
+        self.message_store.set_forwarded(inbound_id, error)
+        if error is not None:
+            self.event_buffer.put('activity', ('%s. The message will be retried later.' % error, True))
+
+    def modem_health(self, status):
+        """
+        This function is called by the modem threads when the health of the
+        modem changes. See modem.ModemHealth.status.
+        """
+        self.event_buffer.put('health', status)
+        if status['model'] is not None and status['model'] != self.modem_model:
+            self.modem_model = status['model']
+            self.event_buffer.put('activity', ('Modem profile: %s' % status['model'], False))
+        self.event_stream.publish('modem', {'state': 'health', 'port': self.serial_conn.port, 'health': status})
+
+    def configure_blocklist(self):
+        """
+        Loads the blocklist if it is turned on & the file or country code has
+        changed, (see blocklist). The blocklist is loaded on a background
+        thread. If there is no blocklist in use the new one is used at once,
+        & lookups wait until it has loaded so that no message is sent to a
+        number that has opted out. Otherwise the old one is used until the
+        new one has loaded, (see "swap_blocklist").
+        """
+        if not self.settings['use_blocklist']:
+            self.blocklist = None
+            self.pending_blocklist = None
+            return
+
+        current = self.pending_blocklist or self.blocklist
+        if current is not None and current.filename == self.settings['blocklist_file'] \
+                and current.country_code == self.settings['country_code']:
+            return
+
+        new_blocklist = blocklist.Blocklist(self.settings['blocklist_file'],
+                                            self.settings['country_code'],
+                                            self.blocklist_error,
+                                            self.blocklist_loaded)
+        if self.blocklist is None:
+            self.blocklist = new_blocklist
+            self.pending_blocklist = None
+        else:
+            self.pending_blocklist = new_blocklist
+        new_blocklist.start()
+
+    def blocklist_loaded(self, loaded_blocklist):
+        """
+        This function is called by the blocklist thread when the blocklist
+        has been loaded.
+        """
+        self.event_buffer.put('blocklist', loaded_blocklist)
+
+    def swap_blocklist(self, loaded_blocklist):
+        """
+        Replaces the blocklist in use with one that has finished loading, if
+        it is still the one chosen in the settings.
+        """
+        if loaded_blocklist is self.pending_blocklist:
+            self.blocklist = loaded_blocklist
+            self.pending_blocklist = None
             try:
-                open(self.settings['sms_log_file'], 'a').write('%s - %s - %s - C%d: %s\n' % (message_data['timestamp'],
-                                                                                             message_data['sender_ip'],
-                                                                                             message_data['recipient'],
-                                                                                             message_data['class'],
-                                                                                             message_text))
-            except IOError:
-                self.log_activity('Error when writing to the SMS log file.', error=True)
-            finally:
-                self.log_file_lock.release()
-
-        # Display a tray icon message if necessary
+                self.server_thread.http_server.blocklist = self.blocklist
+            except AttributeError:
+                pass
+        if loaded_blocklist is self.blocklist:
+            self.log_activity('Blocklist loaded (%d numbers)' % len(loaded_blocklist))
+
+    def blocklist_error(self, error_message):
+        """
+        This function is called when the blocklist could not be read.
+        """
+        self.event_buffer.put('activity', (error_message, True))
+
+    def message_store_error(self, error_message):
+        """
+        This function is called by the message database thread when changes
+        could not be written to the database.
+        """
+        self.event_buffer.put('activity', (error_message, True))
+
+    def write_sms_log(self, message_data, status):
+        """
+        Passes a line for the SMS log file to the log writer, in the format
+        chosen in the settings.
+        """
+        templates.render_message(message_data)
+        if self.settings['log_format'] == 'json':
+
+            # The text is stored as it was received, which may not be UTF-8,
+            # so it is decoded the same way as for sending, (see
+            # smspdu.segments) rather than letting the JSON encoder raise
+            message_text = message_data.message
+            if not isinstance(message_text, unicode):
+                message_text = message_text.decode('utf-8', 'replace')
+            log_text = util.json.dumps({'type': 'sms',
+                                        'time': time.time(),
+                                        'received': message_data.time,
+                                        'status': status,
+                                        'sender_ip': message_data.sender_ip,
+                                        'recipient': message_data.recipient,
+                                        'class': message_data.msg_class,
+                                        'message': message_text})
+            index_key = (time.time(), message_data.recipient)
+        else:
+            message_text = message_data.summary()
+            if status != msgstore.SENT:
+                message_text = '[%s] %s' % (status.upper(), message_text)
+            log_text = '%s - %s - %s - C%d: %s' % (message_data.timestamp(),
+                                                   message_data.sender_ip,
+                                                   message_data.recipient,
+                                                   message_data.msg_class,
+                                                   message_text)
+            index_key = None
+
+        self.log_writer.write(self.settings['sms_log_file'], log_text + '\n', index_key)
+
+    def message_received(self, job, messages):
+        """
+        This function is called by the HTTP server when a new message request
+        is received, with the job & a message for each of its recipients, (see
+        msgstore.Job). The messages are recorded in the message database &
+        added to the queue to be sent. The GUI is updated later by
+        "process_events".
+        """
+        self.message_store.add_messages(job, messages)
+        self.queue_messages(messages)
+        for message_data in messages:
+            self.publish_status(message_data, msgstore.QUEUED)
+
+    def queue_messages(self, messages):
+        """
+        Adds a list of messages to the queue to be sent.
+        """
+
+        # Post the GUI event before queueing the messages, so that the
+        # "received" event is always applied before the matching "sent" event
+        self.event_buffer.put('received', messages)
+
+        # Add the messages to the queue to be sent
+        queued_at = time.time()
+        for message_data in messages:
+            message_data.queued_at = queued_at
+            tracing.stage(message_data, 'enqueued')
+            self.msg_queue.put(message_data)
+        metrics.MESSAGES_QUEUED.inc(len(messages))
+
+    def restore_queue(self):
+        """
+        Puts the messages that were not sent before the last exit back into
+        the queue. The snapshot of the queue written at the last exit is
+        mapped & placed ahead of the queue as a backlog, (see snapshot) or if
+        there is no snapshot (i.e. the application did not exit cleanly) the
+        messages are read from the message database.
+        """
+        backlog = snapshot.load(snapshot.snapshot_name(self.message_store.filename),
+                                self.message_store.snapshot_token,
+                                self.message_store.templates)
+        if backlog is None:
+            self.queue_messages(self.message_store.queued_messages())
+        else:
+            self.event_buffer.put('restored', backlog)
+            self.msg_queue.set_backlog(backlog)
+            metrics.MESSAGES_QUEUED.inc(len(backlog))
+
+    def save_queue(self):
+        """
+        Writes the snapshot of the messages that are still queued, (see
+        snapshot). If it cannot be written, the messages are read from the
+        message database after the next start instead.
+        """
+        messages = self.msg_queue.items()
+        if self.msg_queue.backlog is not None:
+            self.msg_queue.backlog.close()
+
+        token = snapshot.new_token()
+        try:
+            snapshot.write(snapshot.snapshot_name(self.message_store.filename), token, messages)
+        except (IOError, OSError):
+            return
+        self.message_store.set_snapshot_token(token)
+
+    def log_http_data(self, request_data):
+        """
+        This function is called by the HTTP server when a HTTP request is
+        received. A dictionary is provided with log information which is used
+        to update the GUI and is written to a file if necessary.
+        """
+        log_text = '%s - %s:%d - %s - %s' % (request_data['timestamp'],
+                                             request_data['client_ip'],
+                                             request_data['client_port'],
+                                             request_data['request'],
+                                             request_data['user_agent'])
+
+        # Write to the HTTP log text file
+        if self.settings['log_http']:
+            if self.settings['log_format'] == 'json':
+                self.log_writer.write(self.settings['http_log_file'],
+                                      util.json.dumps({'type': 'http',
+                                                       'time': request_data['time'],
+                                                       'client_ip': request_data['client_ip'],
+                                                       'client_port': request_data['client_port'],
+                                                       'request': request_data['request'],
+                                                       'user_agent': request_data['user_agent']}) + '\n',
+                                      (request_data['time'], ''))
+            else:
+                self.log_writer.write(self.settings['http_log_file'], log_text + '\n')
+
+        self.event_buffer.put('http', log_text)
+
+    def process_events(self):
+        """
+        Called by the event timer to apply all of the events posted by the
+        worker threads since the last call. Events are grouped by type so that
+        each list box & log file is only updated once per batch.
+        """
+        events = self.event_buffer.drain()
+        if not events:
+            return
+
+        restored = None
+        received = []
+        sent = []
+        failed = []
+        http_log = []
+        inbound = []
+        health = None
+        for event_type, data in events:
+            if event_type == 'restored':
+                restored = data
+            elif event_type == 'received':
+                received.extend(data)
+            elif event_type == 'sent':
+                sent.append(data)
+            elif event_type == 'failed':
+                failed.append(data)
+            elif event_type == 'http':
+                http_log.append(data)
+            elif event_type == 'inbound':
+                inbound.append(data)
+            elif event_type == 'activity':
+                self.log_activity(*data)
+            elif event_type == 'health':
+                health = data
+            elif event_type == 'profiled':
+                self.profile_action.setDisabled(False)
+            elif event_type == 'blocklist':
+                self.swap_blocklist(data)
+
+        if restored is not None:
+            self.show_restored_messages(restored)
+        if received:
+            self.show_queued_messages(received, sent + [message_data for message_data, error in failed])
+        if sent:
+            self.show_sent_messages(sent)
+        if failed:
+            self.show_failed_messages(failed)
+        if (sent or failed) and self.restored_item is not None:
+            self.show_restored_count()
+        if http_log:
+            self.show_http_log(http_log)
+        if inbound:
+            self.show_inbound_messages(inbound)
+        if health is not None:
+            self.show_modem_health(health)
+
+    def show_queued_messages(self, messages, finished):
+        """
+        Adds newly received messages to the queue list box. Messages that have
+        already been sent (or have failed) within the same batch are skipped.
+        """
+        finished_ids = set([id(message_data) for message_data in finished])
+
+        self.message_queue_lst.setUpdatesEnabled(False)
+        try:
+            for message_data in messages:
+                if id(message_data) in finished_ids:
+                    continue
+
+                # Get the message text without line breaks, which is shared by
+                # the messages of a job, & make a truncated version for GUI
+                # display
+                message_text = message_data.summary()
+                truncated_text = message_text[:47] + '...' if len(message_text) > 50 else message_text
+
+                # Create a list widget & add it to the GUI queue list box
+                list_item = QListWidgetItem('%s - %s - %s - C%d: %s' % (message_data.timestamp(),
+                                                                       message_data.sender_ip,
+                                                                       message_data.recipient,
+                                                                       message_data.msg_class,
+                                                                       truncated_text))
+                self.queue_items[message_data.id] = list_item
+                self.message_queue_lst.addItem(list_item)
+        finally:
+            self.message_queue_lst.setUpdatesEnabled(True)
+
+    def show_restored_messages(self, backlog):
+        """
+        Lists the first RESTORED_ITEMS messages restored from the queue
+        snapshot in the queue list box, followed by an item that counts the
+        rest, so that a large backlog does not hold up the GUI.
+        """
+        first = backlog.position
+        last = min(first + RESTORED_ITEMS, backlog.count)
+        self.show_queued_messages([backlog.message(x) for x in xrange(first, last)], [])
+
+        self.restored_backlog = backlog
+        self.restored_listed = last
+        if last < backlog.count:
+            self.restored_item = QListWidgetItem()
+            self.message_queue_lst.addItem(self.restored_item)
+            self.show_restored_count()
+
+    def show_restored_count(self):
+        """
+        Updates the item that counts the restored messages that are not
+        listed, or removes it once they have all been taken from the queue.
+        """
+        backlog = self.restored_backlog
+        remaining = backlog.count - max(backlog.position, self.restored_listed)
+        if remaining > 0:
+            self.restored_item.setText('... & %d more messages queued before the last exit' % remaining)
+        else:
+            self.message_queue_lst.takeItem(self.message_queue_lst.row(self.restored_item))
+            self.restored_item = None
+            self.restored_backlog = None
+
+    def show_sent_messages(self, messages):
+        """
+        Moves a batch of sent messages from the queue list box to the sent
+        messages list box, then displays a tray icon message.
+        """
+        self.sent_message_lst.setUpdatesEnabled(False)
+        self.message_queue_lst.setUpdatesEnabled(False)
+        try:
+            for message_data in messages:
+
+                # Get the message text without line breaks & make a truncated
+                # version for GUI display
+                message_text = message_data.summary()
+                truncated_text = message_text[:57] + '...' if len(message_text) > 60 else message_text
+
+                # Update the SMS log list box
+                list_item = QListWidgetItem('%s - %s - %s - C%d: %s' % (message_data.timestamp(),
+                                                                       message_data.sender_ip,
+                                                                       message_data.recipient,
+                                                                       message_data.msg_class,
+                                                                       truncated_text))
+                self.sent_message_lst.addItem(list_item)
+
+                # Remove the message from the queue list box
+                widget = self.queue_items.pop(message_data.id, None)
+                if widget is not None:
+                    self.message_queue_lst.takeItem(self.message_queue_lst.row(widget))
+
+            self.sent_message_lst.setCurrentItem(list_item)
+        finally:
+            self.sent_message_lst.setUpdatesEnabled(True)
+            self.message_queue_lst.setUpdatesEnabled(True)
+
+        # Display a tray icon message for the most recent message if necessary
         if self.settings['show_message']:
-            self.tray_icon.showMessage(self.tr('SMS Message Sent'),
-                                       self.tr('To: %s\n%s' % (message_data['recipient'], truncated_text)),
+            if len(messages) == 1:
+                title = 'SMS Message Sent'
+            else:
+                title = '%d SMS Messages Sent' % len(messages)
+            self.tray_icon.showMessage(self.tr(title),
+                                       self.tr('To: %s\n%s' % (message_data.recipient, truncated_text)),
                                        self.tray_icon_information,
                                        self.settings['message_duration'] * 1000)
 
-    def message_received(self, message_data):
+    def show_failed_messages(self, failures):
+        """
+        Removes a batch of messages that could not be sent from the queue list
+        box, then logs the failure (or the number of failures) in the activity
+        log.
+        """
+        self.message_queue_lst.setUpdatesEnabled(False)
+        try:
+            for message_data, error in failures:
+                widget = self.queue_items.pop(message_data.id, None)
+                if widget is not None:
+                    self.message_queue_lst.takeItem(self.message_queue_lst.row(widget))
+        finally:
+            self.message_queue_lst.setUpdatesEnabled(True)
+
+        if len(failures) == 1:
+            self.log_activity('The message to %s could not be sent: %s' % (message_data.recipient, error), True)
+        else:
+            self.log_activity('%d messages could not be sent, the last to %s: %s' % (len(failures),
+                                                                                  message_data.recipient,
+                                                                                  error), True)
 
-        # Get the message data & remove the line breaks
-        message_text = message_data['message']
-        message_text = message_text.replace('\r\n', ' ')
-        message_text = message_text.replace('\n', ' ')
+    def show_http_log(self, log_lines):
+        """
+        Adds a batch of HTTP log lines to the HTTP log list box.
+        """
+        self.http_log_lst.setUpdatesEnabled(False)
+        try:
+            for log_text in log_lines:
+                list_item = QListWidgetItem(log_text)
+                self.http_log_lst.addItem(list_item)
+            self.http_log_lst.setCurrentItem(list_item)
+        finally:
+            self.http_log_lst.setUpdatesEnabled(True)
+
+    def show_inbound_messages(self, messages):
+        """
+        Adds a batch of received messages to the received messages list box,
+        then displays a tray icon message.
+        """
+        self.inbound_message_lst.setUpdatesEnabled(False)
+        try:
+            for inbound_data in messages:
 
-        # Make a truncated version for GUI display
-        truncated_text = message_text[:47] + '...' if len(message_text) > 50 else message_text
+                # Get the message text & remove the line breaks
+                message_text = inbound_data['message'].decode('utf-8')
+                message_text = message_text.replace('\r\n', ' ')
+                message_text = message_text.replace('\n', ' ')
 
-        # Create a list widget
-        message_data['widget'] = QListWidgetItem('%s - %s - %s - C%d: %s' % (message_data['timestamp'],
-                                                                             message_data['sender_ip'],
-                                                                             message_data['recipient'],
-                                                                             message_data['class'],
-                                                                             truncated_text))
+                # Make a truncated version for GUI display
+                truncated_text = message_text[:57] + '...' if len(message_text) > 60 else message_text
 
-        # Add the message widget to the GUI queue list box
-        self.message_queue_lst.addItem(message_data['widget'])
+                list_item = QListWidgetItem(u'%s - %s: %s' % (inbound_data['timestamp'],
+                                                              inbound_data['sender'],
+                                                              truncated_text))
+                self.inbound_message_lst.addItem(list_item)
+            self.inbound_message_lst.setCurrentItem(list_item)
+        finally:
+            self.inbound_message_lst.setUpdatesEnabled(True)
 
-        # Add the message to the queue to be sent
-        self.msg_queue.put(message_data)
+        # Display a tray icon message for the most recent message if necessary
+        if self.settings['show_message']:
+            if len(messages) == 1:
+                title = 'SMS Message Received'
+            else:
+                title = '%d SMS Messages Received' % len(messages)
+            self.tray_icon.showMessage(self.tr(title),
+                                       u'From: %s\n%s' % (inbound_data['sender'], truncated_text),
+                                       self.tray_icon_information,
+                                       self.settings['message_duration'] * 1000)
 
-    def log_http_data(self, log_text):
+    def show_modem_health(self, status):
         """
-        This function is called by the HTTP server when a HTTP request is
-        received. A string is provided with log information which is used to
-        update the GUI and is written to a file if necessary.
+        Shows the latest health of the modem in the COM port status label.
         """
+        try:
+            if not self.sender_thread.isRunning():
+                return
+        except AttributeError:
+            return
 
-        # Update the HTTP log listbox
-        list_item = QListWidgetItem(log_text)
-        self.http_log_lst.addItem(list_item)
-        self.http_log_lst.setCurrentItem(list_item)
+        if not status['responding']:
+            text = '<font size="+1" color="red"><b>Connected (%s) - Not responding</b></font>'
+        elif not status['registered']:
+            text = '<font size="+1" color="orange"><b>Connected (%s) - No network</b></font>'
+        elif status['signal'] is None or status['signal'] == 99:
+            text = '<font size="+1" color="green"><b>Connected (%s)</b></font>'
+        else:
+            text = '<font size="+1" color="green"><b>Connected (%%s) - Signal %d%%%%</b></font>' % status['score']
+        self.com_status_lbl.setText(self.tr(text % self.serial_conn.port))
 
-        # Write to the HTTP log text file
-        if self.settings['log_http']:
-            self.log_file_lock.acquire()
-            try:
-                open(self.settings['http_log_file'], 'a').write(log_text + '\n')
-            except IOError:
-                self.log_activity('Error when writing to the HTTP log file.', error=True)
-            finally:
-                self.log_file_lock.release()
+    def com_connection_lost(self):
+        """
+        Called when the sender thread stops because the connection to the COM
+        port has been lost or the modem has stopped responding.
+        """
+        self.tray_icon.showMessage('SMS Gateway Server',
+                                   'The connection to the COM port has been lost',
+                                   self.tray_icon_critical,
+                                   10 * 1000)
+        self.log_activity('Connection to the COM port was lost.', error=True)
+        self.event_stream.publish('modem', {'state': 'lost', 'port': self.serial_conn.port})
+
+        # Remember which modem was connected, so that it can be found again if
+        # it reappears on a different port, then start trying to reconnect
+        try:
+            self.modem_identity = self.modem_reader.identity or self.modem_identity
+        except AttributeError:
+            pass
+        self.reconnecting = True
+        self.reconnect_attempts = 0
+        self.schedule_reconnect()
+
+    def schedule_reconnect(self):
+        """
+        Waits before the next attempt at reconnecting the COM port. The delay
+        grows exponentially with each attempt & is randomised, so that a
+        modem that is slow to come back is not hammered.
+        """
+        delay = min(RECONNECT_DELAY * 2 ** self.reconnect_attempts, MAX_RECONNECT_DELAY)
+        delay = random.uniform(delay / 2.0, delay)
+        self.reconnect_attempts += 1
+        self.reconnect_timer.start(int(delay * 1000))
+        self.com_status_lbl.setText(self.tr('<font size="+1" color="orange"><b>Reconnecting...</b></font>'))
+
+    def reconnect_com_port(self):
+        """
+        Called by the reconnect timer to search for the lost modem.
+        """
+        if not self.reconnecting:
+            return
+        self.port_finder = threads.PortFinder(self.port_discovery, self.serial_conn.port, self.modem_identity)
+        self.connect(self.port_finder, SIGNAL('threadExit()'), self.port_search_finished)
+        self.port_finder.start()
+
+    def port_search_finished(self):
+        """
+        Called when the port finder thread has finished. If the modem was
+        found the COM port is reconnected, otherwise another attempt is
+        scheduled.
+        """
+        if not self.reconnecting:
+            return
+
+        port = self.port_finder.port
+        if not port:
+            self.schedule_reconnect()
+            return
+
+        # A USB modem may have been given a different port number
+        com_port = discovery.port_setting(port)
+        if com_port != self.settings['com_port']:
+            self.log_activity('The modem has moved to %s' % port)
+            self.settings['com_port'] = com_port
+            QSettings().setValue('com_port', QVariant(com_port))
+
+        attempts = self.reconnect_attempts
+        if self.connect_com_port(silent_fail=True):
+            self.log_activity('COM port reconnected after %d attempt(s)' % attempts)
+        else:
+            self.schedule_reconnect()
+
+    def profile_gateway(self):
+        """
+        Asks how long to profile for, then profiles every thread in the
+        background & writes the collapsed stacks next to the application,
+        (see profiler).
+        """
+        seconds, ok = QInputDialog.getInteger(self, 'Profile Gateway',
+                                              'Profile every thread for (seconds):',
+                                              30, 1, profiler.MAX_SECONDS)
+        if not ok:
+            return
+
+        filename = os.path.join(os.path.dirname(os.path.abspath(sys.argv[0])),
+                                'profile-%s.folded' % time.strftime('%Y%m%d-%H%M%S'))
+        self.profile_action.setDisabled(True)
+        self.log_activity('Profiling the gateway for %d second(s)' % seconds)
+        self.profile_writer = profiler.ProfileWriter(seconds, filename, self.profile_finished)
+        self.profile_writer.start()
+
+    def profile_finished(self, filename, error):
+        """
+        This function is called by the profile writer thread once the profile
+        has been written (or has failed).
+        """
+        if error is None:
+            self.event_buffer.put('activity', ('Profile written to %s' % filename, False))
+        else:
+            self.event_buffer.put('activity', ('The profile could not be written (%s).' % error, True))
+        self.event_buffer.put('profiled')
 
     def show_about(self):
         """
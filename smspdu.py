@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+
+"""
+Module containing functions to decode the SMS PDUs (3GPP TS 23.040) that a
+modem returns in PDU mode (AT+CMGF=0), & to work out how the text of a
+message is encoded & split up to be sent.
+"""
+
+# Standard library modules
+import binascii
+
+# Message types (the lowest two bits of the first octet)
+SMS_DELIVER = 0
+SMS_STATUS_REPORT = 2
+
+# The GSM 03.38 default alphabet & its extension table (characters following
+# the 0x1B escape)
+GSM_ALPHABET = (u'@£$¥èéùìòÇ\nØø\rÅå'
+                u'Δ_ΦΓΛΩΠΨΣΘΞ\x1bÆæßÉ'
+                u' !"#¤%&\'()*+,-./0123456789:;<=>?'
+                u'¡ABCDEFGHIJKLMNOPQRSTUVWXYZÄÖÑÜ§'
+                u'¿abcdefghijklmnopqrstuvwxyzäöñüà')
+GSM_EXTENSION = {0x0a: u'\x0c', 0x14: u'^', 0x28: u'{', 0x29: u'}', 0x2f: u'\\',
+                 0x3c: u'[', 0x3d: u'~', 0x3e: u']', 0x40: u'|', 0x65: u'€'}
+
+# The characters that can be sent in the default alphabet, & those of them
+# that take two septets (the escape & the character)
+GSM_CHARACTERS = frozenset(GSM_ALPHABET.replace(u'\x1b', u'') + u''.join(GSM_EXTENSION.values()))
+GSM_EXTENSION_CHARACTERS = frozenset(GSM_EXTENSION.values())
+
+# The most septets (or UCS-2 characters) in a single message, & in each part
+# of a concatenated message, which loses some to the header
+GSM_SINGLE, GSM_PART = 160, 153
+UCS2_SINGLE, UCS2_PART = 70, 67
+
+class PDUError(Exception):
+    """
+    Raised when a PDU cannot be decoded.
+    """
+    pass
+
+
+def decode(pdu):
+    """
+    Decodes a hex encoded PDU, including the leading SMSC address, into a
+    dictionary. The "type" key is either SMS_DELIVER or SMS_STATUS_REPORT.
+
+    An SMS-DELIVER has the keys "sender", "timestamp", "text" (unicode) and
+    "concat", which is a tuple of (reference, total parts, part number) for
+    part of a concatenated message or None.
+
+    An SMS-STATUS-REPORT has the keys "reference", "recipient", "timestamp",
+    "discharged" and "status".
+    """
+    try:
+        data = [ord(x) for x in binascii.unhexlify(pdu.strip())]
+    except (TypeError, binascii.Error):
+        raise PDUError('The PDU is not valid hex')
+
+    try:
+        position = data[0] + 1
+        first_octet = data[position]
+        position += 1
+        message_type = first_octet & 0x03
+
+        if message_type == SMS_DELIVER:
+            sender, position = decode_address(data, position)
+            data_coding = data[position + 1]
+            timestamp = decode_timestamp(data[position + 2:position + 9])
+            position += 9
+            text, concat = decode_user_data(data, position, data_coding, first_octet & 0x40)
+            return {'type': SMS_DELIVER,
+                    'sender': sender,
+                    'timestamp': timestamp,
+                    'text': text,
+                    'concat': concat}
+
+        elif message_type == SMS_STATUS_REPORT:
+            reference = data[position]
+            recipient, position = decode_address(data, position + 1)
+            return {'type': SMS_STATUS_REPORT,
+                    'reference': reference,
+                    'recipient': recipient,
+                    'timestamp': decode_timestamp(data[position:position + 7]),
+                    'discharged': decode_timestamp(data[position + 7:position + 14]),
+                    'status': data[position + 14]}
+
+    except IndexError:
+        raise PDUError('The PDU is too short')
+
+    raise PDUError('Unsupported message type (%d)' % message_type)
+
+
+def segments(text):
+    """
+    Works out how the text of a message (unicode or UTF-8) is sent. Returns a
+    tuple of (encoding, length, parts) where the encoding is "gsm" if every
+    character is in the default alphabet, otherwise "ucs2", the length is in
+    septets or UCS-2 characters & parts is the number of messages it is sent
+    as, (i.e. 1 unless it has to be concatenated).
+    """
+    if not isinstance(text, unicode):
+        text = text.decode('utf-8', 'replace')
+    characters = set(text)
+    if characters <= GSM_CHARACTERS:
+        encoding = 'gsm'
+        length = len(text) + sum([text.count(x) for x in characters & GSM_EXTENSION_CHARACTERS])
+        single, part = GSM_SINGLE, GSM_PART
+    else:
+        encoding = 'ucs2'
+        length = len(text.encode('utf-16-be')) // 2
+        single, part = UCS2_SINGLE, UCS2_PART
+    if length <= single:
+        return encoding, length, 1
+    return encoding, length, (length + part - 1) // part
+
+
+def decode_address(data, position):
+    """
+    Decodes an address field. Returns a tuple of (address, position of the
+    next field).
+    """
+    length = data[position]
+    address_type = data[position + 1]
+    octets = data[position + 2:position + 2 + (length + 1) // 2]
+    next_position = position + 2 + (length + 1) // 2
+
+    # Alphanumeric addresses are packed in the GSM default alphabet
+    if address_type & 0x70 == 0x50:
+        return decode_gsm(unpack_septets(octets, length * 4 // 7)), next_position
+
+    digits = decode_semi_octets(octets)[:length]
+    if address_type & 0x70 == 0x10:
+        digits = '+' + digits
+    return digits, next_position
+
+
+def decode_semi_octets(octets):
+    """
+    Decodes swapped BCD digits, (i.e. 0x21 0xF3 returns "123").
+    """
+    digits = []
+    for octet in octets:
+        digits.append('%d' % (octet & 0x0f))
+        if octet >> 4 != 0x0f:
+            digits.append('%d' % (octet >> 4))
+    return ''.join(digits)
+
+
+def decode_timestamp(octets):
+    """
+    Decodes a service centre timestamp into the same format used by text mode
+    responses, (i.e. "10/01/18,17:10:02+00").
+    """
+    values = ['%d%d' % (x & 0x0f, x >> 4) for x in octets[:6]]
+    zone = octets[6]
+    quarters = (zone & 0x07) * 10 + (zone >> 4)
+    sign = zone & 0x08 and '-' or '+'
+    return '%s/%s/%s,%s:%s:%s%s%02d' % tuple(values + [sign, quarters])
+
+
+def decode_user_data(data, position, data_coding, has_header):
+    """
+    Decodes the user data of a message. Returns a tuple of (text, concat),
+    see "decode".
+    """
+    length = data[position]
+    user_data = data[position + 1:]
+
+    concat = None
+    header_length = 0
+    if has_header:
+        header_length = user_data[0] + 1
+        concat = decode_concat_header(user_data[1:header_length])
+
+    alphabet = data_coding_alphabet(data_coding)
+    if alphabet == 'gsm':
+
+        # The length is in septets & the text starts on the first septet
+        # boundary after the header
+        header_bits = header_length * 8
+        fill_bits = (7 - header_bits % 7) % 7
+        count = length - (header_bits + fill_bits) // 7
+        return decode_gsm(unpack_septets(user_data, count, header_bits + fill_bits)), concat
+
+    text_octets = ''.join([chr(x) for x in user_data[header_length:length]])
+    if alphabet == 'ucs2':
+        return text_octets.decode('utf-16-be', 'replace'), concat
+    return text_octets.decode('latin-1'), concat
+
+
+def decode_concat_header(header):
+    """
+    Returns (reference, total parts, part number) from the information elements
+    of a user data header, or None if the message is not concatenated.
+    """
+    position = 0
+    while position + 1 < len(header):
+        element_id = header[position]
+        element_length = header[position + 1]
+        element = header[position + 2:position + 2 + element_length]
+        if element_id == 0x00 and element_length == 3:
+            return element[0], element[1], element[2]
+        if element_id == 0x08 and element_length == 4:
+            return (element[0] << 8) | element[1], element[2], element[3]
+        position += 2 + element_length
+    return None
+
+
+def data_coding_alphabet(data_coding):
+    """
+    Returns the alphabet ("gsm", "8bit" or "ucs2") of a data coding scheme.
+    """
+    group = data_coding & 0xf0
+    if group & 0xc0 == 0x00 or group & 0xc0 == 0x40:
+        return ('gsm', '8bit', 'ucs2', 'gsm')[(data_coding >> 2) & 0x03]
+    if group == 0xe0:
+        return 'ucs2'
+    if group == 0xf0 and data_coding & 0x04:
+        return '8bit'
+    return 'gsm'
+
+
+def unpack_septets(octets, count, skip_bits=0):
+    """
+    Unpacks "count" 7-bit values from packed octets, starting "skip_bits" bits
+    into the data.
+    """
+    number = 0
+    for i, octet in enumerate(octets):
+        number |= octet << (8 * i)
+    return [(number >> (skip_bits + 7 * i)) & 0x7f for i in range(count)]
+
+
+def decode_gsm(septets):
+    """
+    Converts GSM default alphabet values to a unicode string.
+    """
+    characters = []
+    escape = False
+    for septet in septets:
+        if escape:
+            characters.append(GSM_EXTENSION.get(septet, u' '))
+            escape = False
+        elif septet == 0x1b:
+            escape = True
+        else:
+            characters.append(GSM_ALPHABET[septet])
+    return u''.join(characters)
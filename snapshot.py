@@ -0,0 +1,236 @@
+"""
+Module containing the snapshot of the send queue that is written when the
+application exits, so that the messages that were still queued are back in
+the queue as soon as it starts again, rather than being read back from the
+message database & rebuilt.
+
+The snapshot is a binary file alongside the message database
+("<database>.queue") holding a header, a record for each job (see
+msgstore.Job) & for each message in the order they are taken from the
+queue, followed by the strings that the records point to. When the
+application starts the file is memory mapped & handed to the queue as a
+Backlog, which only builds each message when the sender takes it, so even a
+backlog of millions of messages is back in service at once.
+
+The snapshot is only used if the message database holds the same token,
+(see msgstore.MessageStore.snapshot_token) which it gives up when it is
+opened. A snapshot left behind by a run that did not exit cleanly is
+ignored & the queue is read from the database instead.
+"""
+
+# Standard library modules
+import mmap
+import os
+import struct
+import time
+
+# Local application modules
+import msgstore
+import tracing
+import util
+
+# The header of the snapshot: a magic string, the token that the message
+# database must hold & the number of jobs & messages that follow
+HEADER = struct.Struct('<8s32sII')
+MAGIC = 'SMSGWQS1'
+
+# Each job: the time it was received, the SMS class, the template ID (0 if a
+# template is not used) & the offset & length of the text & the sender IP in
+# the strings
+JOB_RECORD = struct.Struct('<dBxxxIQIQI')
+
+# Each message: the message ID, the job it belongs to & the offset & length
+# of its fields in the strings, (see "message_fields")
+MESSAGE_RECORD = struct.Struct('<QIQI')
+
+def snapshot_name(db_filename):
+    return db_filename + '.queue'
+
+
+def new_token():
+    return os.urandom(16).encode('hex')
+
+
+def message_fields(message_data):
+    """
+    Returns the fields of a message that are written to the snapshot, joined
+    by NUL characters: the recipient, then the template values (as JSON) &
+    the location on the SIM of a message that was being sent, (see
+    threads.MsgSender.send) if the message has them.
+    """
+    fields = [util.utf8(message_data.recipient)]
+    if message_data.variables is not None or message_data.sim_location is not None:
+        if message_data.variables is None:
+            fields.append('')
+        else:
+            fields.append(util.json.dumps(message_data.variables))
+    if message_data.sim_location is not None:
+        fields.append(util.utf8(message_data.sim_location[0]))
+        fields.append(str(message_data.sim_location[1]))
+    return '\0'.join(fields)
+
+
+def write(filename, token, messages):
+    """
+    Writes a snapshot of a list of messages, through a temporary file that is
+    renamed over the old snapshot so that a snapshot is never left half
+    written. Raises IOError or OSError if the snapshot cannot be written.
+    """
+    job_indexes = {}
+    job_records = []
+    message_records = []
+    strings = []
+    position = 0
+    for message_data in messages:
+        job = message_data.job
+        job_index = job_indexes.get(id(job))
+        if job_index is None:
+            job_index = job_indexes[id(job)] = len(job_records)
+            if job.template is None:
+                text = util.utf8(job.message)
+                template_id = 0
+            else:
+                text = ''
+                template_id = job.template.id
+            sender_ip = util.utf8(job.sender_ip)
+            job_records.append(JOB_RECORD.pack(job.time, job.msg_class, template_id,
+                                               position, len(text), position + len(text), len(sender_ip)))
+            strings.append(text)
+            strings.append(sender_ip)
+            position += len(text) + len(sender_ip)
+
+        fields = message_fields(message_data)
+        message_records.append(MESSAGE_RECORD.pack(message_data.id, job_index, position, len(fields)))
+        strings.append(fields)
+        position += len(fields)
+
+    temp_name = filename + '.tmp'
+    temp_file = open(temp_name, 'wb')
+    try:
+        temp_file.write(HEADER.pack(MAGIC, token, len(job_records), len(message_records)))
+        temp_file.write(''.join(job_records))
+        temp_file.write(''.join(message_records))
+        temp_file.write(''.join(strings))
+        temp_file.flush()
+        os.fsync(temp_file.fileno())
+    finally:
+        temp_file.close()
+
+    # Windows cannot rename over an existing file
+    if os.name == 'nt' and os.path.exists(filename):
+        os.remove(filename)
+    os.rename(temp_name, filename)
+
+
+def load(filename, token, templates):
+    """
+    Returns a Backlog of the messages in the snapshot, memory mapped, or None
+    if there is no snapshot or it is not the one with the given token.
+    "templates" is the templates of the message database, keyed on ID.
+    """
+    if not token:
+        return None
+    try:
+        snapshot_file = open(filename, 'rb')
+    except IOError:
+        return None
+    try:
+        header = snapshot_file.read(HEADER.size)
+        if len(header) < HEADER.size:
+            return None
+        magic, snapshot_token, job_count, message_count = HEADER.unpack(header)
+        if magic != MAGIC or snapshot_token != token:
+            return None
+        size = HEADER.size + job_count * JOB_RECORD.size + message_count * MESSAGE_RECORD.size
+        if os.path.getsize(filename) < size:
+            return None
+        try:
+            data = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+        except EnvironmentError:
+            return None
+        return Backlog(data, job_count, message_count, templates)
+    finally:
+        snapshot_file.close()
+
+
+class Backlog(object):
+    """
+    The messages of a snapshot that have not been taken from the send queue
+    yet, (see util.CustomQueue.set_backlog). Each message is built from the
+    mapped file when it is taken, so loading the snapshot takes the same time
+    however many messages it holds. The messages of a job are written one
+    after another, so the last job built is kept for the next message.
+    """
+    def __init__(self, data, job_count, message_count, templates):
+        self.data = data
+        self.templates = templates
+        self.count = message_count
+        self.position = 0
+        self.messages_offset = HEADER.size + job_count * JOB_RECORD.size
+        self.strings_offset = self.messages_offset + message_count * MESSAGE_RECORD.size
+        self.last_job = (None, None)
+
+        # The restored messages are counted as queued when they are loaded
+        self.queued_at = time.time()
+        self.enqueued_at = tracing.monotonic()
+
+    def __len__(self):
+        return self.count - self.position
+
+    def next(self):
+        """
+        Returns the next message, which is taken from the backlog.
+        """
+        message_data = self.message(self.position)
+        self.position += 1
+        message_data.queued_at = self.queued_at
+        tracing.stage(message_data, 'enqueued', self.enqueued_at)
+        return message_data
+
+    def remaining(self):
+        """
+        Returns a list of the messages that have not been taken, without
+        taking them.
+        """
+        return [self.message(x) for x in xrange(self.position, self.count)]
+
+    def message(self, index):
+        """
+        Builds the message at a position in the snapshot.
+        """
+        message_id, job_index, offset, length = MESSAGE_RECORD.unpack_from(self.data, self.messages_offset +
+                                                                           index * MESSAGE_RECORD.size)
+        fields = self.string(offset, length).split('\0')
+        if len(fields) > 1 and fields[1]:
+            variables = tuple([util.utf8(x) for x in util.json.loads(fields[1])])
+        else:
+            variables = None
+        message_data = msgstore.Message(message_id, self.job(job_index), fields[0], variables)
+        if len(fields) > 2:
+            message_data.sim_location = (fields[2], int(fields[3]))
+        return message_data
+
+    def job(self, index):
+        last_index, job = self.last_job
+        if last_index == index:
+            return job
+
+        received_at, msg_class, template_id, text_offset, text_length, ip_offset, ip_length = \
+            JOB_RECORD.unpack_from(self.data, HEADER.size + index * JOB_RECORD.size)
+        sender_ip = intern(self.string(ip_offset, ip_length)) or None
+        if template_id:
+            job = msgstore.Job(received_at, msg_class, sender_ip, template=self.templates[template_id])
+        else:
+            job = msgstore.Job(received_at, msg_class, sender_ip, self.string(text_offset, text_length))
+        self.last_job = (index, job)
+        return job
+
+    def string(self, offset, length):
+        start = self.strings_offset + offset
+        return self.data[start:start + length]
+
+    def close(self):
+        """
+        Unmaps the snapshot, so that it can be replaced.
+        """
+        self.data.close()
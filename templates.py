@@ -0,0 +1,67 @@
+"""
+Module containing message templates, (i.e. "Hi {name}, your code is {code}")
+which are sent to many recipients with different values for the fields.
+Each template is compiled once into a format string, & a queued message only
+holds the template & a tuple of its values. The text is rendered when the
+sender takes the message from the queue.
+"""
+
+# Standard library modules
+import re
+
+# A field in a template ("{name}"), or a brace written twice to be taken
+# literally
+FIELD_RE = re.compile(r'\{\{|\}\}|\{([A-Za-z_][A-Za-z0-9_]*)\}')
+
+class Template(object):
+    """
+    A compiled template. "fields" is the names of the fields in the order
+    they first appear, which is the order of the values given to "render".
+    """
+    def __init__(self, template_id, body):
+        self.id = template_id
+        self.body = body
+
+        fields = []
+        parts = []
+        position = 0
+        for match in FIELD_RE.finditer(body):
+            parts.append(body[position:match.start()].replace('%', '%%'))
+            name = match.group(1)
+            if name is None:
+                parts.append(match.group()[0])
+            else:
+                parts.append('%%(%s)s' % name)
+                if name not in fields:
+                    fields.append(name)
+            position = match.end()
+        parts.append(body[position:].replace('%', '%%'))
+
+        self.format = ''.join(parts)
+        self.fields = tuple(fields)
+
+    def columns(self, names):
+        """
+        Returns the positions of the template's fields in a list of column
+        names. Raises ValueError if a field has no column.
+        """
+        missing = [x for x in self.fields if x not in names]
+        if missing:
+            raise ValueError('There is no column for the template field(s): %s.' % ', '.join(missing))
+        return [list(names).index(x) for x in self.fields]
+
+    def render(self, values):
+        """
+        Returns the text of the template with a tuple of field values.
+        """
+        return self.format % dict(zip(self.fields, values))
+
+
+def render_message(message_data):
+    """
+    Sets message_data.message to the rendered text of a message that was
+    queued with a template, if it has not been rendered yet.
+    """
+    if message_data.message is None:
+        message_data.message = message_data.template.render(message_data.variables)
+    return message_data.message
@@ -0,0 +1,85 @@
+"""
+Tests for the blocklist module.
+"""
+
+# Standard library modules
+import os
+import shutil
+import tempfile
+import unittest
+
+# Local application modules
+import blocklist
+
+class BlocklistTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'blocklist.txt')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, lines):
+        blocklist_file = open(self.filename, 'w')
+        blocklist_file.write('\n'.join(lines) + '\n')
+        blocklist_file.close()
+
+    def load(self):
+        errors = []
+        numbers = blocklist.Blocklist(self.filename, load_error=errors.append)
+        numbers.load()
+        return numbers, errors
+
+    def test_number_key(self):
+        self.assertEqual(blocklist.number_key('+447745896325'), 447745896325)
+        self.assertEqual(blocklist.number_key('447745896325'), 447745896325)
+        self.assertEqual(blocklist.number_key('88222'), None)
+
+    def test_every_format(self):
+        self.write(['+447745896325', '00447745896326', '07745896327', '447745896328', '# comment'])
+        numbers, errors = self.load()
+        self.assertEqual(len(numbers), 4)
+        self.assertEqual(errors, [])
+        for number in ('+447745896325', '+447745896326', '+447745896327', '+447745896328'):
+            self.assertTrue(numbers.is_blocked(number))
+        self.assertFalse(numbers.is_blocked('+447745896329'))
+
+    def test_bare_digits_blocked(self):
+        self.write(['+447745896325'])
+        numbers, errors = self.load()
+        self.assertTrue(numbers.is_blocked('447745896325'))
+
+    def test_short_codes_reported(self):
+        self.write(['+447745896325', '88222'])
+        numbers, errors = self.load()
+        self.assertEqual(len(numbers), 1)
+        self.assertEqual(len(errors), 1)
+        self.assertFalse(numbers.is_blocked('88222'))
+
+    def test_compiled_file_reused(self):
+        self.write(['07745896325', '07745896325'])
+        self.load()
+        self.assertTrue(os.path.exists(blocklist.compiled_name(self.filename)))
+        numbers, errors = self.load()
+        self.assertEqual(len(numbers), 1)
+        self.assertTrue(numbers.is_blocked('+447745896325'))
+
+    def test_start(self):
+        self.write(['+447745896325'])
+        loaded = []
+        numbers = blocklist.Blocklist(self.filename, loaded=loaded.append)
+        numbers.start()
+        self.assertTrue(numbers.is_blocked('+447745896325'))
+        numbers.ready.wait()
+        self.assertEqual(len(numbers), 1)
+
+    def test_missing_file(self):
+        errors = []
+        numbers = blocklist.Blocklist(os.path.join(self.directory, 'missing.txt'), load_error=errors.append)
+        numbers.start()
+        self.assertFalse(numbers.is_blocked('+447745896325'))
+        self.assertEqual(len(errors), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,42 @@
+"""
+Tests for the duplicates module.
+"""
+
+# Standard library modules
+import unittest
+
+# Local application modules
+import duplicates
+
+class DuplicateFilterTest(unittest.TestCase):
+    def setUp(self):
+        self.filter = duplicates.DuplicateFilter(60)
+
+    def test_repeat(self):
+        self.assertFalse(self.filter.is_duplicate('+447745896325', 'Hello', 1000))
+        self.assertTrue(self.filter.is_duplicate('+447745896325', 'Hello', 1030))
+        self.assertFalse(self.filter.is_duplicate('+447745896326', 'Hello', 1030))
+        self.assertFalse(self.filter.is_duplicate('+447745896325', 'Hello again', 1030))
+
+    def test_window(self):
+        self.assertFalse(self.filter.is_duplicate('+447745896325', 'Hello', 1000))
+        self.assertFalse(self.filter.is_duplicate('+447745896325', 'Hello', 1071))
+
+    def test_forget(self):
+        key = duplicates.text_key('Hello')
+        self.assertFalse(self.filter.is_duplicate('+447745896325', key, 1000))
+        self.filter.forget('+447745896325', key)
+        self.assertFalse(self.filter.is_duplicate('+447745896325', key, 1010))
+        self.assertTrue(self.filter.is_duplicate('+447745896325', key, 1020))
+
+    def test_template_key(self):
+        self.assertEqual(duplicates.template_key(2, ('Ann', '4821')), '2\0Ann\x004821')
+
+    def test_turned_off(self):
+        self.filter.set_window(0)
+        self.assertFalse(self.filter.is_duplicate('+447745896325', 'Hello'))
+        self.assertFalse(self.filter.is_duplicate('+447745896325', 'Hello'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,54 @@
+"""
+Tests for the logwriter module, & the index search of the logquery module.
+"""
+
+# Standard library modules
+import os
+import shutil
+import tempfile
+import unittest
+
+# Local application modules
+import logquery
+import logwriter
+
+class IndexTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'sms_log.txt')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, lines):
+        log_file = logwriter.RotatingLogFile(self.filename)
+        try:
+            for line_time, recipient in lines:
+                log_file.write('{"recipient": "%s"}\n' % recipient, (line_time, recipient))
+        finally:
+            log_file.close()
+
+    def search(self, start_time, end_time):
+        index = logquery.LogIndex(logwriter.index_name(self.filename))
+        try:
+            return index.search(start_time, end_time), [index.record(x)[0] for x in range(index.count)]
+        finally:
+            index.close()
+
+    def test_out_of_order_times(self):
+        # A line logged by another thread reaches the writer late
+        self.write([(100.0, '+447745896301'), (102.0, '+447745896302'), (101.0, '+447745896303'),
+                    (103.0, '+447745896304')])
+        offsets, times = self.search(102.0, 104.0)
+        self.assertEqual(times, [100.0, 102.0, 102.0, 103.0])
+        self.assertEqual(len(offsets), 3)
+
+    def test_reopened(self):
+        self.write([(100.0, '+447745896301'), (102.0, '+447745896302')])
+        self.write([(101.0, '+447745896303')])
+        offsets, times = self.search(None, None)
+        self.assertEqual(times, [100.0, 102.0, 102.0])
+
+
+if __name__ == '__main__':
+    unittest.main()
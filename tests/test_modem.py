@@ -0,0 +1,53 @@
+"""
+Tests for the modem module.
+"""
+
+# Standard library modules
+import unittest
+
+# Local application modules
+import modem
+
+class DeliveryReportIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.index = modem.DeliveryReportIndex()
+        self.message1 = object()
+        self.message2 = object()
+
+    def test_match(self):
+        self.index.add('356938035643809', 12, self.message1, '+447745896325')
+        self.assertTrue(self.index.match('356938035643809', 12, '07745896325') is self.message1)
+        self.assertEqual(self.index.match('356938035643809', 12, '07745896325'), None)
+
+    def test_other_modem(self):
+        self.index.add('356938035643809', 12, self.message1, '+447745896325')
+        self.assertEqual(self.index.match('356938035643810', 12, '+447745896325'), None)
+
+    def test_other_recipient(self):
+        self.index.add('356938035643809', 12, self.message1, '+447745896325')
+        self.assertEqual(self.index.match('356938035643809', 12, '+447745896326'), None)
+
+    def test_reused_reference(self):
+        self.index.add('356938035643809', 12, self.message1, '+447745896325')
+        self.index.add('356938035643809', 12, self.message2, '+447745896326')
+        self.assertTrue(self.index.match('356938035643809', 12, '+447745896326') is self.message2)
+
+
+class ModemHealthTest(unittest.TestCase):
+    def test_connection_lost(self):
+        statuses = []
+        health = modem.ModemHealth(statuses.append)
+        self.assertTrue(health.responding())
+        health.connection_lost()
+        self.assertFalse(health.responding())
+        self.assertFalse(statuses[-1]['responding'])
+
+
+class SameNumberTest(unittest.TestCase):
+    def test_same_number(self):
+        self.assertTrue(modem.same_number('+447745896325', '07745896325'))
+        self.assertFalse(modem.same_number('+447745896325', '07745896326'))
+
+
+if __name__ == '__main__':
+    unittest.main()
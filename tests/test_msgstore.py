@@ -0,0 +1,110 @@
+"""
+Tests for the msgstore module.
+"""
+
+# Standard library modules
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+import unittest
+
+# Local application modules
+import msgstore
+
+class MessageStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'messages.db')
+        self.errors = []
+        self.store = self.open_store()
+
+    def tearDown(self):
+        if self.store.isAlive():
+            self.store.stop()
+            self.store.join()
+        shutil.rmtree(self.directory)
+
+    def open_store(self):
+        store = msgstore.MessageStore(self.filename, self.errors.append, flush_interval=0.01)
+        store.start()
+        return store
+
+    def reopen(self):
+        self.store.stop()
+        self.store.join()
+        self.store = self.open_store()
+
+    def add(self, recipients, text='Hello'):
+        job = msgstore.Job(time.time(), 1, '127.0.0.1', text)
+        messages = [msgstore.Message(None, job, recipient) for recipient in recipients]
+        self.store.add_messages(job, messages)
+        return messages
+
+    def test_ids(self):
+        messages = self.add(['+447745896325', '+447745896326'])
+        self.assertEqual([x.id for x in messages], [1, 2])
+        self.reopen()
+        self.assertEqual(self.add(['+447745896327'])[0].id, 3)
+
+    def test_unsent_restored(self):
+        messages = self.add(['+447745896325', '+447745896326', '+447745896327', '+447745896328'])
+        self.store.set_status(messages[1].id, msgstore.SENDING)
+        self.store.set_status(messages[2].id, msgstore.SENT)
+        self.store.set_status(messages[3].id, msgstore.FAILED, 'Error')
+        self.reopen()
+
+        restored = self.store.queued_messages()
+        self.assertEqual([x.id for x in restored], [messages[0].id, messages[1].id])
+        self.assertTrue(restored[0].job is restored[1].job)
+        self.assertEqual(restored[0].message, 'Hello')
+
+    def test_sim_location_restored(self):
+        message_data = self.add(['+447745896325'])[0]
+        self.store.set_status(message_data.id, msgstore.SENDING)
+        self.store.set_sim_location(message_data.id, ('356938035643809', 7))
+        self.reopen()
+        self.assertEqual(self.store.queued_messages()[0].sim_location, ('356938035643809', 7))
+
+    def test_failed_batch_kept(self):
+        original_interval = msgstore.RETRY_INTERVAL
+        msgstore.RETRY_INTERVAL = 0.05
+        try:
+            message_data = self.add(['+447745896325'])[0]
+            self.wait_written(message_data.id)
+
+            # A change to a column that does not exist yet fails until the
+            # column is added
+            self.store.record_change(message_data.id, {'extra': 'x'}, False)
+            self.wait_for(lambda: self.errors)
+            self.assertEqual(self.store.get_message(message_data.id)['extra'], 'x')
+
+            conn = sqlite3.connect(self.filename)
+            conn.execute('ALTER TABLE messages ADD COLUMN extra TEXT')
+            conn.commit()
+            conn.close()
+            self.wait_written(message_data.id)
+            self.assertEqual(len(self.errors), 1)
+        finally:
+            msgstore.RETRY_INTERVAL = original_interval
+
+    def test_stop_gives_up(self):
+        message_data = self.add(['+447745896325'])[0]
+        self.store.record_change(message_data.id, {'missing': 'x'}, False)
+        self.store.stop()
+        self.store.join(5)
+        self.assertFalse(self.store.isAlive())
+
+    def wait_written(self, message_id):
+        self.wait_for(lambda: message_id not in self.store.pending)
+
+    def wait_for(self, condition):
+        deadline = time.time() + 5
+        while not condition():
+            self.assertTrue(time.time() < deadline)
+            time.sleep(0.01)
+
+
+if __name__ == '__main__':
+    unittest.main()
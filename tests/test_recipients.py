@@ -0,0 +1,54 @@
+"""
+Tests for the recipients module.
+"""
+
+# Standard library modules
+import unittest
+
+# Local application modules
+import recipients
+
+class NormaliseTest(unittest.TestCase):
+    def test_prefixes(self):
+        self.assertEqual(recipients.normalise('+447745896325'), '+447745896325')
+        self.assertEqual(recipients.normalise('00447745896325'), '+447745896325')
+        self.assertEqual(recipients.normalise('07745896325'), '+447745896325')
+        self.assertEqual(recipients.normalise('07745896325', '353'), '+3537745896325')
+
+    def test_bare_international(self):
+        self.assertEqual(recipients.normalise('447745896325'), '+447745896325')
+
+    def test_short_code(self):
+        self.assertEqual(recipients.normalise('88222'), '88222')
+        self.assertEqual(recipients.normalise('12345678'), '12345678')
+
+
+class ParseRecipientsTest(unittest.TestCase):
+    def test_normalised(self):
+        self.assertEqual(recipients.parse_recipients('07745896325, 0044 7745 896326;+447745896327'),
+                         ['+447745896325', '+447745896326', '+447745896327'])
+
+    def test_duplicates(self):
+        self.assertEqual(recipients.parse_recipients('447745896325;+447745896325;07745896325;88222;88222'),
+                         ['+447745896325', '88222'])
+
+    def test_empty_entries(self):
+        self.assertEqual(recipients.normalise_recipients('07745896325;;88222'), ['+447745896325', '', '88222'])
+
+    def test_invalid_character(self):
+        self.assertRaises(ValueError, recipients.parse_recipients, '07745896325;abc')
+
+    def test_misplaced_plus(self):
+        self.assertRaises(ValueError, recipients.parse_recipients, '0774+5896325')
+
+    def test_too_short(self):
+        for number in ('0', '00', '+', '+44', '0123'):
+            self.assertRaises(ValueError, recipients.parse_recipients, '07745896325;' + number)
+
+    def test_too_long(self):
+        self.assertRaises(ValueError, recipients.parse_recipients, '+1234567890123456')
+        self.assertRaises(ValueError, recipients.parse_recipients, '1234567890123456')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+"""
+Tests for the serialloop module.
+"""
+
+# Standard library modules
+import os
+import unittest
+
+# Local application modules
+import modem
+import serialloop
+
+class StubLoop(object):
+    """
+    Stands in for a SerialLoop, running the calls straight away.
+    """
+    def call(self, function, *args):
+        function(*args)
+
+    def add(self, channel):
+        pass
+
+    def remove_channel(self, channel):
+        pass
+
+
+class StubPort(object):
+    def __init__(self, fd):
+        self.fd = fd
+
+    def fileno(self):
+        return self.fd
+
+
+class ChannelTest(unittest.TestCase):
+    def setUp(self):
+        self.read_fd, self.write_fd = os.pipe()
+        self.closed = []
+        self.channel = serialloop.Channel(StubLoop(), StubPort(self.write_fd), closed=lambda: self.closed.append(True))
+
+    def tearDown(self):
+        os.close(self.read_fd)
+        os.close(self.write_fd)
+
+    def test_fail_finishes_waiting_commands(self):
+        running = modem.Command('AT')
+        waiting = modem.Command('AT+CSQ')
+        self.channel.submit(running, 1)
+        self.channel.submit(waiting, 1)
+        self.channel.fail()
+        self.assertTrue(running.done_event.isSet())
+        self.assertTrue(waiting.done_event.isSet())
+        self.assertEqual((running.result, waiting.result), (None, None))
+        self.assertEqual(self.closed, [True])
+
+    def test_submit_after_fail(self):
+        self.channel.fail()
+        finished = []
+        command = modem.Command('AT')
+        self.channel.submit(command, 1, finished.append)
+        self.assertTrue(command.done_event.isSet())
+        self.assertEqual(command.result, None)
+        self.assertEqual(finished, [command])
+        self.assertEqual(self.channel.commands, [])
+        self.assertEqual(self.channel.output, '')
+        self.assertEqual(self.closed, [True])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests for the smspdu module.
+"""
+
+# Standard library modules
+import unittest
+
+# Local application modules
+import smspdu
+
+class DecodeTest(unittest.TestCase):
+    def test_deliver(self):
+        message = smspdu.decode('07917283010010F5040BC87238880900F10000993092516195800AE8329BFD4697D9EC37')
+        self.assertEqual(message['type'], smspdu.SMS_DELIVER)
+        self.assertEqual(message['sender'], '27838890001')
+        self.assertEqual(message['timestamp'], '99/03/29,15:16:59+08')
+        self.assertEqual(message['text'], u'hellohello')
+        self.assertEqual(message['concat'], None)
+
+    def test_concatenated_part(self):
+        message = smspdu.decode('00440C914479035290960000500151325322400C0500030A0201D06536FB0D')
+        self.assertEqual(message['sender'], '+449730250969')
+        self.assertEqual(message['text'], u'hello')
+        self.assertEqual(message['concat'], (10, 2, 1))
+
+    def test_ucs2(self):
+        message = smspdu.decode('00040C914479035290960008500151325322400C041F04400438043204350442')
+        self.assertEqual(message['text'], u'Привет')
+
+    def test_status_report(self):
+        report = smspdu.decode('00062A0C91447903529096500151325322405001513253324000')
+        self.assertEqual(report['type'], smspdu.SMS_STATUS_REPORT)
+        self.assertEqual(report['reference'], 42)
+        self.assertEqual(report['recipient'], '+449730250969')
+        self.assertEqual(report['status'], 0)
+
+    def test_invalid(self):
+        self.assertRaises(smspdu.PDUError, smspdu.decode, 'not hex')
+        self.assertRaises(smspdu.PDUError, smspdu.decode, '0004')
+
+
+class SegmentsTest(unittest.TestCase):
+    def test_single(self):
+        self.assertEqual(smspdu.segments('a' * 160), ('gsm', 160, 1))
+
+    def test_concatenated(self):
+        self.assertEqual(smspdu.segments('a' * 161), ('gsm', 161, 2))
+        self.assertEqual(smspdu.segments('a' * 307), ('gsm', 307, 3))
+
+    def test_extension_characters(self):
+        # The euro sign takes two septets
+        self.assertEqual(smspdu.segments(u'€' * 80), ('gsm', 160, 1))
+        self.assertEqual(smspdu.segments('[' * 81), ('gsm', 162, 2))
+
+    def test_ucs2(self):
+        self.assertEqual(smspdu.segments(u'П' * 70), ('ucs2', 70, 1))
+        self.assertEqual(smspdu.segments(u'П' * 71), ('ucs2', 71, 2))
+
+    def test_utf8(self):
+        self.assertEqual(smspdu.segments(u'été'.encode('utf-8')), ('gsm', 3, 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
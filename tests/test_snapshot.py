@@ -0,0 +1,107 @@
+"""
+Tests for the snapshot module, & the backlog of util.CustomQueue that a
+snapshot is loaded into.
+"""
+
+# Standard library modules
+import os
+import shutil
+import tempfile
+import unittest
+
+# Local application modules
+import msgstore
+import snapshot
+import templates
+import util
+
+class SnapshotTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'messages.db.queue')
+        self.token = snapshot.new_token()
+        self.template = templates.Template(3, 'Hi {name}, your code is {code}')
+        self.backlog = None
+
+    def tearDown(self):
+        if self.backlog is not None:
+            self.backlog.close()
+        shutil.rmtree(self.directory)
+
+    def round_trip(self, messages):
+        snapshot.write(self.filename, self.token, messages)
+        self.backlog = snapshot.load(self.filename, self.token, {3: self.template})
+        return self.backlog
+
+    def test_round_trip(self):
+        job = msgstore.Job(1700000000.5, 2, '10.0.0.1', 'First line\nsecond line \xc3\xa9')
+        template_job = msgstore.Job(1700000001.0, 1, None, template=self.template)
+        messages = [msgstore.Message(1, job, '+447745896325'),
+                    msgstore.Message(2, job, '+447745896326'),
+                    msgstore.Message(3, template_job, '+447745896327', ('Ann', '12\xc3\xa9'))]
+        messages[1].sim_location = ('356938035643809', 4)
+
+        backlog = self.round_trip(messages)
+        self.assertEqual(len(backlog), 3)
+
+        first = backlog.next()
+        self.assertEqual((first.id, first.recipient, first.sim_location), (1, '+447745896325', None))
+        self.assertEqual((first.time, first.msg_class, first.sender_ip), (1700000000.5, 2, '10.0.0.1'))
+        self.assertEqual(first.message, 'First line\nsecond line \xc3\xa9')
+        self.assertTrue(first.queued_at is not None)
+
+        second = backlog.next()
+        self.assertEqual(second.sim_location, ('356938035643809', 4))
+        self.assertTrue(second.job is first.job)
+
+        third = backlog.next()
+        self.assertTrue(third.template is self.template)
+        self.assertEqual(third.sender_ip, None)
+        self.assertEqual(third.variables, ('Ann', '12\xc3\xa9'))
+        self.assertEqual(templates.render_message(third), 'Hi Ann, your code is 12\xc3\xa9')
+        self.assertEqual(len(backlog), 0)
+
+    def test_remaining(self):
+        job = msgstore.Job(1700000000.0, 1, '10.0.0.1', 'Hello')
+        backlog = self.round_trip([msgstore.Message(x, job, '+4477458963%02d' % x) for x in range(1, 4)])
+        backlog.next()
+        self.assertEqual([x.id for x in backlog.remaining()], [2, 3])
+        self.assertEqual(len(backlog), 2)
+
+    def test_other_token(self):
+        job = msgstore.Job(1700000000.0, 1, '10.0.0.1', 'Hello')
+        snapshot.write(self.filename, self.token, [msgstore.Message(1, job, '+447745896325')])
+        self.assertEqual(snapshot.load(self.filename, snapshot.new_token(), {}), None)
+        self.assertEqual(snapshot.load(self.filename, None, {}), None)
+
+    def test_missing(self):
+        self.assertEqual(snapshot.load(self.filename, self.token, {}), None)
+
+
+class CustomQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        filename = os.path.join(self.directory, 'messages.db.queue')
+        token = snapshot.new_token()
+        job = msgstore.Job(1700000000.0, 1, '10.0.0.1', 'Hello')
+        snapshot.write(filename, token, [msgstore.Message(x, job, '+4477458963%02d' % x) for x in (1, 2)])
+        self.backlog = snapshot.load(filename, token, {})
+        self.job = job
+
+    def tearDown(self):
+        self.backlog.close()
+        shutil.rmtree(self.directory)
+
+    def test_order(self):
+        queue = util.CustomQueue()
+        queue.put(msgstore.Message(3, self.job, '+447745896303'))
+        queue.set_backlog(self.backlog)
+        queue.put(msgstore.Message(4, self.job, '+447745896304'), front=True)
+        self.assertEqual(queue.qsize(), 4)
+        self.assertEqual([x.id for x in queue.items()], [4, 1, 2, 3])
+        self.assertEqual([queue.get().id for x in range(4)], [4, 1, 2, 3])
+        self.assertTrue(queue.empty())
+
+
+if __name__ == '__main__':
+    unittest.main()
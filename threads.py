@@ -4,7 +4,6 @@ Module containing classes that run in separate threads.
 
 # Standard library modules
 import Queue
-import threading
 import time
 
 # 3rd party modules
@@ -12,13 +11,31 @@ from PyQt4.QtCore import *
 import serial
 
 # Local application modules
+import discovery
 import httpserver
+import metrics
+import modem
+import msgstore
+import serialloop
+import smspdu
+import templates
+import tracing
+
+# How long (in seconds) to wait for the response to an AT command, and for
+# the response to AT+CMGS, which waits on the network
+COMMAND_TIMEOUT = 10
+SEND_TIMEOUT = 60
+
+# The baud rates that are tried, in order, when the baud rate is detected
+# automatically, & how long (in seconds) to wait for "OK" at each one
+BAUD_RATES = (115200, 57600, 38400, 19200, 9600, 230400, 460800, 921600)
+BAUD_PROBE_TIMEOUT = 0.5
 
 class MsgSender(QThread):
     """
     Consumer thread for processing the SMS message queue.
     """
-    def __init__(self, msg_queue, serial_conn, serial_conn_mutex, message_sent):
+    def __init__(self, msg_queue, serial_conn, serial_conn_mutex, message_sent, message_status, modem_reader, request_reports=False, setup_commands=(), profiles=None, auto_baud=False, location_changed=None):
         """
         the "serial_conn" parameter is expected to be a serial.Serial object
         that is already connected to a handset. The "serial_conn_mutex" is a
@@ -27,6 +44,26 @@ class MsgSender(QThread):
         The "message_sent" parameter is a function that is called once a
         message has been sent. This takes care of updating the GUI and logging
         to a file if neccessary.
+
+        The "message_status" parameter is a function that is called with the
+        message, the new status & an optional error message whenever the
+        status of a message changes before it is sent.
+
+        The "modem_reader" parameter is the ModemReader thread for the serial
+        port, which all AT commands are run through. If "request_reports" is
+        True a delivery report is requested for each message, and the
+        reference number returned by the modem is passed to the reader so
+        that the report can be matched to the message.
+
+        The "setup_commands" are AT commands that are run once before the
+        first message is sent. "profiles" is a dictionary of the modem
+        profiles learnt so far, see ModemReader.load_profile. If "auto_baud"
+        is True the baud rate is detected before anything else is sent, (see
+        ModemReader.detect_baud_rate).
+
+        The "location_changed" parameter is a function that is called with
+        the message whenever its "sim_location" changes, (see "send") so that
+        the location can be recorded.
         """
 
         # Store the parameters as instance variables
@@ -34,6 +71,15 @@ class MsgSender(QThread):
         self.serial_conn = serial_conn
         self.serial_conn_mutex = serial_conn_mutex
         self.message_sent = message_sent
+        self.message_status = message_status
+        self.modem_reader = modem_reader
+        self.request_reports = request_reports
+        self.setup_commands = setup_commands
+        if profiles is None:
+            profiles = {}
+        self.profiles = profiles
+        self.auto_baud = auto_baud
+        self.location_changed = location_changed
 
         self.keep_running = False
         self.conn_error = False
@@ -44,40 +90,95 @@ class MsgSender(QThread):
         Starts the thread which monitors and processes the message queue.
         """
         self.keep_running = True
+        try:
+            if self.auto_baud and self.modem_reader.detect_baud_rate() is None:
+
+                # A modem that does not answer at any baud rate is treated
+                # like a lost connection
+                raise serial.SerialException('The modem did not answer at any baud rate')
+            for command in self.setup_commands:
+                self.modem_reader.command(command, timeout=COMMAND_TIMEOUT)
+            self.modem_reader.identify()
+            self.modem_reader.load_profile(self.profiles)
+        except serial.SerialException:
+            self.stop(conn_error=True)
+
         while self.keep_running:
 
+            # A modem that has stopped answering commands is treated like a
+            # lost connection
+            health = self.modem_reader.health
+            if not health.responding():
+                self.stop(conn_error=True)
+                break
+
+            # Messages are left in the queue while the modem cannot send
+            # them, (i.e. it is not registered on the network)
+            if not health.can_send():
+                try:
+                    self.modem_reader.check_health()
+                except serial.SerialException:
+                    self.stop(conn_error=True)
+                if self.keep_running:
+                    time.sleep(2)
+                continue
+
             # Get a message from the queue
             try:
                 message_data = self.msg_queue.get(timeout=2)
             except Queue.Empty:
-                pass
-            else:
-                self.serial_conn_mutex.acquire()
+
+                # Probe the modem while there is nothing to send
                 try:
+                    self.modem_reader.check_health()
+                except serial.SerialException:
+                    self.stop(conn_error=True)
+            else:
+                tracing.stage(message_data, 'dequeued')
+                metrics.QUEUE_WAIT_SECONDS.observe(time.time() - (message_data.queued_at or time.time()))
 
-                    # Write the message to the serial port
-                    self.serial_conn.write('AT+CMGF=1\r')
-                    self.serial_conn.write('AT+CSMP=17,169,0,24%d\r' % message_data['class'])
-                    self.serial_conn.write('AT+CMGS="%s"\r' % message_data['recipient'])
-                    self.serial_conn.write('%s\x1a' % message_data['message'])
+                # The modem may have lost the network while this thread was
+                # waiting for the message
+                if not health.can_send():
+                    self.requeue(message_data)
+                    continue
 
+                # Messages queued with a template are only rendered now, so
+                # the queue holds just their values
+                templates.render_message(message_data)
+                self.message_status(message_data, msgstore.SENDING)
+                try:
+                    status, reference, error = self.send(message_data)
                 except serial.SerialException:
-
-                    # Put the failed message back into the queue (at the front).
-                    self.msg_queue.put(message_data, front=True)
+                    status, reference, error = msgstore.QUEUED, None, 'The connection to the COM port was lost'
 
                     # Stop the thread from running
                     self.stop(conn_error=True)
+
+                if status == msgstore.QUEUED:
+                    self.requeue(message_data)
+                    self.message_status(message_data, status, error)
+                elif status == msgstore.FAILED:
+                    metrics.MESSAGES_FAILED.inc()
+                    self.message_status(message_data, status, error)
                 else:
+                    metrics.MESSAGES_SENT.labels(self.serial_conn.port).inc()
+                    if self.request_reports and reference is not None:
+                        self.modem_reader.track_report(reference, message_data)
 
                     # Log the sent message
                     self.message_sent(message_data)
-                finally:
-                    self.serial_conn_mutex.release()
 
                 # Sleep between sending messages (unless service is stopping)
                 if self.keep_running:
-                    time.sleep(2)
+                    time.sleep(self.modem_reader.profile.send_interval)
+
+            # Read any messages & reports that have been stored on the SIM
+            if self.keep_running:
+                try:
+                    self.modem_reader.read_stored_messages()
+                except serial.SerialException:
+                    self.stop(conn_error=True)
 
         # Close the connection to the handset before exiting the thread
         self.serial_conn_mutex.acquire()
@@ -88,6 +189,151 @@ class MsgSender(QThread):
 
         self.emit(SIGNAL('threadExit()'))
 
+    def requeue(self, message_data):
+        """
+        Puts a message back into the queue (at the front) to be tried again.
+        """
+        message_data.queued_at = time.time()
+        tracing.stage(message_data, 'requeued')
+        metrics.MESSAGES_REQUEUED.inc()
+        self.msg_queue.put(message_data, front=True)
+
+    def send(self, message_data):
+        """
+        Sends a message. Returns a tuple of (status, reference, error), where
+        the status is msgstore.SENT, msgstore.FAILED or msgstore.QUEUED if the
+        message should be tried again, and the reference is the message
+        reference returned by the modem (or None if it is not known).
+
+        The message is written to the SIM (AT+CMGW) & then sent from there
+        (AT+CMSS). Until the modem has answered, the storage location is kept
+        in message_data.sim_location along with the identity of the modem, &
+        recorded in the message database so that it survives a crash. If the
+        connection is lost in the meantime, the next attempt reads the
+        status of the stored copy ("STO SENT" or "STO UNSENT") to find out
+        whether the message went out, so that it is neither lost nor sent
+        twice. If the modem does not come back, the message is sent by
+        whichever modem is connected next. If the message cannot be stored,
+        (i.e. the SIM is full) or the modem does not support storing messages
+        (see modem.ModemProfile) it is sent directly with AT+CMGS instead.
+
+        The message format & parameters are only set when they change, rather
+        than before every message.
+        """
+        reader = self.modem_reader
+        profile = reader.profile
+        if not profile.text_mode:
+            return msgstore.FAILED, None, 'The modem does not support text mode'
+        reader.configure('+CMGF', '1')
+
+        # Find out whether an earlier attempt at sending the message went out
+        # The location is kept until the answer is known, in case the
+        # connection is lost again while it is being read
+        location = message_data.sim_location
+        if location is not None and location[0] == reader.identity:
+            response = reader.command('AT+CMGR=%d' % location[1], timeout=COMMAND_TIMEOUT)
+            values = response.values()
+            if response.result is None:
+                return msgstore.QUEUED, None, 'The modem did not respond'
+            if values and values[0][0] == 'STO SENT':
+                self.trace_command(message_data, response, ('acknowledged',))
+                self.set_sim_location(message_data, None)
+                reader.command('AT+CMGD=%d' % location[1], timeout=COMMAND_TIMEOUT)
+                return msgstore.SENT, None, None
+            if values and values[0][0] == 'STO UNSENT':
+                return self.send_stored(message_data, location[1])
+        self.set_sim_location(message_data, None)
+
+        length = message_data.segments()[1]
+        if profile.max_length is not None and length > profile.max_length:
+            return msgstore.FAILED, None, 'The message is longer than the %d characters the modem can send' % profile.max_length
+
+        # The first octet of the SMS-SUBMIT is 17, plus 32 (the status report
+        # request bit) if a report is wanted
+        if self.request_reports:
+            first_octet = 49
+        else:
+            first_octet = 17
+        if profile.supports('+CSMP'):
+            reader.configure('+CSMP', '%d,169,0,24%d' % (first_octet, message_data.msg_class))
+
+        if profile.store_and_send():
+            response = reader.command('AT+CMGW="%s"' % message_data.recipient,
+                                      data=message_data.message,
+                                      timeout=COMMAND_TIMEOUT)
+            values = response.values()
+            if response.ok() and values and values[0][0].isdigit():
+                self.trace_command(message_data, response, ('mutex_acquired', 'written'))
+                return self.send_stored(message_data, int(values[0][0]))
+            if response.result is None:
+
+                # Nothing has been sent yet, so the message can simply be
+                # retried
+                return msgstore.QUEUED, None, 'The modem did not respond'
+
+            # The modem may have reset itself & lost the message format
+            reader.forget_settings()
+            reader.configure('+CMGF', '1')
+
+        # Send the message directly & wait for the modem to return its
+        # reference number, which the delivery report will refer to
+        response = reader.command('AT+CMGS="%s"' % message_data.recipient,
+                                  data=message_data.message,
+                                  timeout=SEND_TIMEOUT)
+        self.trace_command(message_data, response, ('mutex_acquired', 'written', 'acknowledged'))
+        if response.result is not None and not response.ok():
+            reader.forget_settings()
+        return self.send_result(response)
+
+    def send_stored(self, message_data, location):
+        """
+        Sends a message that has been written to the SIM, then deletes it
+        from the SIM once the modem has answered.
+        """
+        reader = self.modem_reader
+        self.set_sim_location(message_data, (reader.identity, location))
+        response = reader.command('AT+CMSS=%d' % location, timeout=SEND_TIMEOUT)
+        self.trace_command(message_data, response, ('acknowledged',))
+        if response.result is None:
+            return msgstore.QUEUED, None, 'The modem did not confirm whether the message was sent'
+
+        self.set_sim_location(message_data, None)
+        reader.command('AT+CMGD=%d' % location, timeout=COMMAND_TIMEOUT)
+        return self.send_result(response)
+
+    def set_sim_location(self, message_data, location):
+        if location != message_data.sim_location:
+            message_data.sim_location = location
+            if self.location_changed is not None:
+                self.location_changed(message_data)
+
+    def trace_command(self, message_data, command, stages):
+        """
+        Records the stages of sending a message that a command has reached,
+        (see tracing). A command that timed out was not acknowledged.
+        """
+        times = {'mutex_acquired': command.acquired_at,
+                 'written': command.written_at,
+                 'acknowledged': command.result is not None and command.finished_at or None}
+        for stage in stages:
+            if times[stage] is not None:
+                tracing.stage(message_data, stage, times[stage])
+
+    def send_result(self, response):
+        """
+        Returns the (status, reference, error) tuple for the response to
+        AT+CMGS or AT+CMSS.
+        """
+        if response.result is None:
+            return msgstore.FAILED, None, 'The modem did not respond'
+        if not response.ok():
+            return msgstore.FAILED, None, 'The modem returned an error (%s)' % response.result
+
+        values = response.values()
+        if values and values[0][0].isdigit():
+            return msgstore.SENT, int(values[0][0]), None
+        return msgstore.SENT, None, None
+
     def stop(self, conn_error=False):
         """
         Stops the thread from processing any more messages, closes the COM port
@@ -102,15 +348,25 @@ class MsgReceiver(QThread):
     """
     Wrapper to run StoppableHTTPServer in a separate thread.
     """
-    def __init__(self, log_http_data, message_received, port, hostname=''):
+    def __init__(self, log_http_data, message_received, message_store, event_stream, port, hostname='',
+                 country_code=None, duplicate_filter=None, blocklist=None):
         """
         Creates and instance of StoppableHTTPServer and saves it as an instance
-        variable.
+        variable. "country_code" is the country calling code given to national
+        numbers, (see recipients), "duplicate_filter" is the
+        duplicates.DuplicateFilter that repeated messages are dropped by &
+        "blocklist" is the blocklist.Blocklist of numbers not to send to.
         """
         self.http_server = httpserver.StoppableHTTPServer(log_http_data,
                                                           message_received,
+                                                          message_store,
+                                                          event_stream,
                                                           (hostname, port),
                                                           httpserver.HTTPHandler)
+        if country_code is not None:
+            self.http_server.country_code = country_code
+        self.http_server.duplicate_filter = duplicate_filter
+        self.http_server.blocklist = blocklist
         QThread.__init__(self)
 
     def run(self):
@@ -131,42 +387,518 @@ class MsgReceiver(QThread):
         self.http_server.stop()
 
 
-class COMChecker(QThread):
-    def __init__(self, parent):
-        self.parent = parent
+class ModemReader(QThread):
+    """
+    The only thread that reads from the serial port, so that the modem's
+    output buffer never fills. The output is parsed by a
+    modem.ResponseParser: solicited responses are passed to the command
+    waiting for them (see "command") & unsolicited result codes are passed to
+    the functions subscribed to them (see "subscribe").
+
+    The reader subscribes to delivery reports & received messages itself.
+    These are either sent directly (+CDS & +CMT) or stored on the SIM (+CDSI &
+    +CMTI), in which case they are read in PDU mode & then deleted so that the
+    SIM storage never fills.
+
+    If the reader is given a serialloop.SerialLoop the port is read & written
+    by the loop instead of by this thread, (see "open").
+    """
+    def __init__(self, serial_conn, serial_conn_mutex, report_index, delivery_report, message_arrived, health_changed=None, io_loop=None):
+        """
+        The "serial_conn" must have a read timeout set so that the thread can
+        be stopped. The "serial_conn_mutex" is held while a command is run, so
+        that only one command is waiting for a response at a time. The
+        "report_index" is a modem.DeliveryReportIndex that sent messages are
+        added to.
+
+        The "delivery_report" parameter is a function that is called with the
+        message (see msgstore.Message), the outcome (modem.DELIVERED or
+        modem.FAILED) & the status value of the report when a final delivery
+        report is received. It can be called from the I/O loop, so it must
+        return quickly & must not wait on the disk.
+
+        The "message_arrived" parameter is a function that is called with the
+        sender, the text (unicode) & the service centre timestamp of each
+        received message, once all of its parts have arrived.
+
+        The "health_changed" parameter is passed to the modem.ModemHealth
+        that tracks the modem, which is available as the "health" attribute.
+
+        The "io_loop" parameter is a serialloop.SerialLoop that does the I/O
+        of the port, or None to read the port on this thread.
+        """
+        self.serial_conn = serial_conn
+        self.serial_conn_mutex = serial_conn_mutex
+        self.report_index = report_index
+        self.delivery_report = delivery_report
+        self.message_arrived = message_arrived
+
+        self.parser = modem.ResponseParser()
+
+        # The modem.Command waiting for a response, if any
+        self.current = None
+
+        # Functions subscribed to unsolicited result codes, keyed on prefix
+        self.subscribers = {}
+
+        # SIM storage locations that need to be read & deleted
+        self.stored_locations = []
+        self.list_stored = False
+
+        self.assembler = modem.MessageAssembler()
+        self.health = modem.ModemHealth(health_changed)
+
+        # The connection to the port on the I/O loop, see "open"
+        self.io_loop = io_loop
+        self.channel = None
+
+        # The serial number (IMEI) of the modem, see "identify"
+        self.identity = None
+
+        # What the modem supports, see "load_profile"
+        self.profile = modem.ModemProfile()
+
+        # The values of the settings that have been changed with "configure",
+        # keyed on the setting name
+        self.configured = {}
+
+        self.subscribe('+CREG:', self.registration_changed)
+        self.subscribe('+CMTI:', self.message_stored)
+        self.subscribe('+CDSI:', self.message_stored)
+        self.subscribe('+CMT:', self.message_pushed)
+        self.subscribe('+CDS:', self.message_pushed)
+
         self.keep_running = False
         QThread.__init__(self)
 
     def run(self):
+        """
+        Starts the thread which reads from the serial port.
+        """
         self.keep_running = True
         while self.keep_running:
+
+            # Everything that is waiting is read in one go, otherwise wait up
+            # to the read timeout for the next byte
             try:
-                if self.parent.sender_thread.isRunning():
-                    self.parent.serial_conn_mutex.acquire()
-                    try:
-                        self.parent.serial_conn.write('AT\r')
-                    finally:
-                        self.parent.serial_conn_mutex.release()
-            except serial.SerialException:
-                self.parent.sender_thread.stop(conn_error=True)
-                self.parent.sender_thread.wait()
-
-            if not self.parent.sender_thread.isRunning():
-                self.parent.sender_thread.stop(conn_error=True)
-                self.parent.sender_thread.wait()
-                self.parent.tray_icon.showMessage('SMS Gateway Server',
-                                                  'The connection to the COM port has been lost',
-                                                  self.parent.tray_icon_critical,
-                                                  10 * 1000)
-                self.parent.log_activity('Connection to the COM port was lost.', error=True)
-
-                # As the connection is now closed stop the thread from any future checking
-                self.keep_running = False
+                data = self.serial_conn.read(self.serial_conn.inWaiting() or 1)
+            except (serial.SerialException, ValueError):
 
-            if self.keep_running:
-                time.sleep(2)
+                # The port has been closed or has failed. The sender thread
+                # sees that the modem is no longer responding & deals with
+                # the lost connection.
+                self.connection_lost()
+                break
+
+            if data:
+                self.health.activity()
+                command = self.current
+                for event_type, value in self.parser.feed(data, command):
+                    if event_type == 'urc':
+                        self.dispatch(*value)
+                    elif command is None:
+
+                        # A late response to a command that timed out
+                        continue
+                    elif event_type == 'response':
+                        command.lines.append(value)
+                    elif event_type == 'prompt':
+                        command.prompt_event.set()
+                    elif event_type == 'result':
+                        command.result = value
+                        command.done_event.set()
+                        command = None
 
         self.emit(SIGNAL('threadExit()'))
 
+    def open(self):
+        """
+        Starts reading the modem output. Where the port can be multiplexed
+        with the other ports, (see serialloop.supported) it is added to the
+        I/O loop, otherwise this thread is started to read it.
+        """
+        if self.io_loop is not None and serialloop.supported(self.serial_conn):
+            self.channel = serialloop.Channel(self.io_loop,
+                                              self.serial_conn,
+                                              self.dispatch,
+                                              self.health.activity,
+                                              self.connection_lost)
+            self.keep_running = True
+            self.channel.open()
+        else:
+            self.start()
+
+    def connection_lost(self):
+        """
+        Called when the port has been closed or has failed. Nothing is
+        reported when the reader is being stopped.
+        """
+        if self.keep_running:
+            self.health.connection_lost()
+
     def stop(self):
         self.keep_running = False
+        if self.channel is not None:
+            self.channel.close()
+
+    def command(self, text, data=None, timeout=10):
+        """
+        Runs an AT command (without the trailing carriage return) & waits for
+        the response. If "data" is given it is written after the modem's "> "
+        prompt, followed by Ctrl-Z. Returns the modem.Command, whose result is
+        None if the modem did not respond in time. This must not be called
+        from the reader thread or from a subscribed function.
+
+        Raises serial.SerialException if the serial port has failed.
+        """
+        command = modem.Command(text, data)
+        if self.channel is not None:
+            return self.channel_command(command, timeout)
+
+        self.serial_conn_mutex.acquire()
+        try:
+            start_time = time.time()
+            command.acquired_at = tracing.monotonic()
+            self.current = command
+            try:
+                self.serial_conn.write(text + '\r')
+                if data is not None:
+                    command.prompt_event.wait(timeout)
+                if data is None:
+                    command.written_at = tracing.monotonic()
+                    command.done_event.wait(timeout)
+                elif command.prompt_event.isSet():
+                    self.serial_conn.write(data + '\x1a')
+                    command.written_at = tracing.monotonic()
+                    command.done_event.wait(timeout)
+                else:
+
+                    # Cancel the command rather than leaving the modem waiting
+                    # for the data
+                    self.serial_conn.write('\x1b')
+            finally:
+                self.current = None
+                command.finished_at = tracing.monotonic()
+        finally:
+            self.serial_conn_mutex.release()
+        metrics.AT_COMMAND_SECONDS.observe(time.time() - start_time)
+        self.health.command_finished(command)
+        return command
+
+    def channel_command(self, command, timeout):
+        """
+        Runs a command on the I/O loop, which writes the data after the prompt
+        & times the command out itself.
+        """
+        self.serial_conn_mutex.acquire()
+        try:
+            start_time = time.time()
+            command.acquired_at = tracing.monotonic()
+            self.channel.submit(command, timeout)
+
+            # The loop normally finishes the command within the timeout, for
+            # the prompt & then for the result
+            command.done_event.wait(2 * timeout + 1)
+        finally:
+            self.serial_conn_mutex.release()
+        if self.channel.failed:
+            raise serial.SerialException('The connection to the COM port was lost')
+        metrics.AT_COMMAND_SECONDS.observe(time.time() - start_time)
+        self.health.command_finished(command)
+        return command
+
+    def subscribe(self, prefix, function):
+        """
+        Calls "function" with the line & the body (the second line, or None)
+        of every unsolicited result code starting with "prefix", (i.e.
+        '+CMTI:'). Subscribed functions are called from the reader thread so
+        must return quickly & must not run commands.
+        """
+        self.subscribers.setdefault(prefix, []).append(function)
+
+    def dispatch(self, line, body):
+        for function in self.subscribers.get(modem.urc_prefix(line), []):
+            function(line, body)
+
+    def identify(self):
+        """
+        Reads the serial number (IMEI) of the modem, which identifies it if it
+        reappears under a different port name. The port name is used if the
+        modem does not give a serial number.
+        """
+        self.identity = modem.serial_number(self.command('AT+CGSN').lines) or self.serial_conn.port
+        return self.identity
+
+    def detect_baud_rate(self):
+        """
+        Finds the baud rate that the modem answers at by sending "AT" at each
+        of the BAUD_RATES in turn. Modems that detect the baud rate themselves
+        lock on to the first rate that they answer at. Returns the baud rate,
+        or None if the modem did not answer.
+        """
+        for baud_rate in BAUD_RATES:
+            self.serial_conn_mutex.acquire()
+            try:
+                self.serial_conn.baudrate = baud_rate
+                self.serial_conn.flushInput()
+            finally:
+                self.serial_conn_mutex.release()
+            if self.command('AT', timeout=BAUD_PROBE_TIMEOUT).ok():
+                return baud_rate
+        return None
+
+    def load_profile(self, profiles):
+        """
+        Learns what the modem supports, (see modem.ModemProfile) from the
+        manufacturer (AT+CGMI), the model (AT+CGMM or ATI), the commands it
+        lists (AT+CLAC), the message formats (AT+CMGF=?) & the baud rates
+        (AT+IPR=?). "profiles" is a dictionary of the profiles already learnt,
+        keyed on the modem's identity, so that a modem is only asked the
+        first time it is connected. The profile is available as the "profile"
+        attribute.
+        """
+        profile = profiles.get(self.identity)
+        if profile is None:
+            manufacturer = ' '.join(self.command('AT+CGMI').lines) or None
+            model = ' '.join(self.command('AT+CGMM').lines or self.command('ATI').lines) or None
+            response = self.command('AT+CLAC')
+            commands = None
+            if response.ok() and response.lines:
+                commands = modem.command_list(response.lines)
+            formats = modem.number_list(self.command('AT+CMGF=?').lines)
+            baud_rates = modem.number_list(self.command('AT+IPR=?').lines)
+            profile = modem.ModemProfile(manufacturer, model, commands, formats, baud_rates)
+            profiles[self.identity] = profile
+
+        self.profile = profile
+        self.health.update_model(profile.description())
+        return profile
+
+    def configure(self, setting, value):
+        """
+        Runs "AT<setting>=<value>", (i.e. AT+CMGF=1) unless the setting was
+        already given that value. Returns True if the modem has the value.
+        """
+        if self.configured.get(setting) == value:
+            return True
+        response = self.command('AT%s=%s' % (setting, value))
+        if response.ok():
+            self.configured[setting] = value
+        else:
+            self.configured.pop(setting, None)
+        return response.ok()
+
+    def forget_settings(self):
+        """
+        Forgets the settings changed by "configure", so that they are set
+        again. This is called when a command fails in a way that suggests the
+        modem has reset itself.
+        """
+        self.configured = {}
+
+    def registration_changed(self, line, body):
+        """
+        Handles the +CREG codes sent when the network registration changes.
+        """
+        try:
+            self.health.update_registration(int(modem.response_fields(line)[0]))
+        except ValueError:
+            pass
+
+    def check_health(self):
+        """
+        Probes the modem if it has been quiet for a while or if its signal
+        quality & registration are due to be refreshed. This runs commands,
+        so it is called from the sender thread when it is idle.
+        """
+        if not self.health.probe_due():
+            return
+        self.health.last_probe = time.time()
+
+        values = self.command('AT+CSQ').values()
+        if values and values[0][0].isdigit():
+            self.health.update_signal(int(values[0][0]))
+
+        # The solicited response is "<n>,<stat>", while a +CREG code that
+        # arrives during the command is just "<stat>"
+        values = self.command('AT+CREG?').values()
+        if values and values[0][-1].isdigit():
+            self.health.update_registration(int(values[0][-1]))
+
+    def message_stored(self, line, body):
+        """
+        Notes the SIM storage location of a message or report, which is read
+        by "read_stored_messages".
+        """
+        try:
+            self.stored_locations.append(int(modem.response_fields(line)[1]))
+        except (IndexError, ValueError):
+            pass
+
+    def message_pushed(self, line, body):
+        """
+        Handles a message or report sent directly to the serial port.
+        """
+        if line.startswith('+CDS:') and body is None:
+
+            # A text mode status report, which is all on one line
+            report = modem.parse_status_report(modem.response_fields(line))
+            if report is not None:
+                self.handle_report(*report)
+        elif len(modem.response_fields(line)) == 2:
+
+            # In PDU mode the header is the alpha & the length of the PDU
+            self.handle_pdu(body)
+        else:
+            fields = modem.response_fields(line)
+            self.handle_message(fields[0], body.decode('latin-1'), fields[-1])
+
+    def handle_pdu(self, pdu):
+        """
+        Decodes a PDU read from the modem. Returns False if it could not be
+        decoded.
+        """
+        try:
+            decoded = smspdu.decode(pdu)
+        except smspdu.PDUError:
+            return False
+
+        if decoded['type'] == smspdu.SMS_STATUS_REPORT:
+            self.handle_report(decoded['reference'], decoded['recipient'], decoded['status'])
+        else:
+            self.handle_message(decoded['sender'], decoded['text'], decoded['timestamp'], decoded['concat'])
+        return True
+
+    def handle_message(self, sender, text, timestamp, concat=None):
+        for sender, text, timestamp in self.assembler.add(sender, text, timestamp, concat):
+            self.message_arrived(sender, text, timestamp)
+
+    def handle_report(self, reference, recipient, report_status):
+        """
+        Matches a delivery report to a sent message. Reports saying that the
+        service centre is still trying to deliver the message are ignored.
+        """
+        outcome = modem.report_outcome(report_status)
+        if outcome == modem.PENDING:
+            return
+
+        message_data = self.report_index.match(self.identity or self.serial_conn.port, reference, recipient)
+        if message_data is not None:
+            self.delivery_report(message_data, outcome, report_status)
+
+    def list_stored_messages(self):
+        """
+        Reads everything already stored on the SIM the next time
+        "read_stored_messages" is called, (i.e. messages that arrived while
+        the gateway was not running).
+        """
+        self.list_stored = True
+
+    def read_stored_messages(self):
+        """
+        Reads the messages & reports stored on the SIM, then deletes the ones
+        that have been read in one batch. This runs commands, so it is called
+        from the sender thread between messages.
+        """
+        if not (self.stored_locations or self.list_stored):
+            return
+
+        deleted = []
+        self.configure('+CMGF', '0')
+
+        if self.list_stored:
+            self.list_stored = False
+            lines = self.command('AT+CMGL=4').lines
+            for i in range(len(lines) - 1):
+
+                # Only received messages (status 0 or 1) are read, so that sent
+                # messages stored on the SIM are not deleted
+                fields = modem.response_fields(lines[i]) if lines[i].startswith('+CMGL:') else []
+                if len(fields) > 1 and fields[0].isdigit() and fields[1] in ('0', '1'):
+                    self.handle_pdu(lines[i + 1])
+                    deleted.append(int(fields[0]))
+
+        while self.stored_locations:
+            location = self.stored_locations.pop(0)
+            response = self.command('AT+CMGR=%d' % location)
+            if response.ok() and len(response.lines) > 1:
+                self.handle_pdu(response.lines[1])
+
+            # Messages that cannot be decoded are deleted as well, otherwise
+            # they would fill the SIM
+            if response.result is not None:
+                deleted.append(location)
+
+        for location in deleted:
+            self.command('AT+CMGD=%d' % location)
+
+    def track_report(self, reference, message_data):
+        """
+        Adds a sent message to the delivery report index, under the modem's
+        identity so that reports still match after the modem reconnects on a
+        different port.
+        """
+        self.report_index.add(self.identity or self.serial_conn.port, reference, message_data, message_data.recipient)
+
+
+class PortFinder(QThread):
+    """
+    Finds the serial port of a modem after its connection has been lost. A
+    USB modem that is unplugged or reset can reappear under a different port
+    name, so if the modem's identity (see ModemReader.identify) is known &
+    the preferred port does not answer with it, the other serial ports are
+    searched for the same modem. Once the thread has finished the port found
+    is available as the "port" attribute, which is None if it was not found.
+    """
+    def __init__(self, port_discovery, preferred_port, identity=None):
+        """
+        The "port_discovery" parameter is a discovery.PortDiscovery object
+        that is used to search the other ports.
+        """
+        self.port_discovery = port_discovery
+        self.preferred_port = preferred_port
+        self.identity = identity
+        self.port = None
+
+        self.keep_running = False
+        QThread.__init__(self)
+
+    def run(self):
+        self.keep_running = True
+        info = discovery.probe_port(self.preferred_port)
+        if info['available'] and (self.identity is None or info['identity'] == self.identity):
+            self.port = self.preferred_port
+        elif self.identity is not None and self.keep_running:
+
+            # The ports have probably changed, so the cached results are not
+            # trusted
+            for info in self.port_discovery.discover(force=True):
+                if info['identity'] == self.identity:
+                    self.port = info['port']
+                    break
+
+        self.emit(SIGNAL('threadExit()'))
+
+    def stop(self):
+        self.keep_running = False
+
+
+class PortScanner(QThread):
+    """
+    Runs a scan of the serial ports (see discovery.PortDiscovery), so that
+    the GUI does not freeze while the ports are probed. Once the thread has
+    finished the results are available as the "ports" attribute.
+    """
+    def __init__(self, port_discovery, force=False, parent=None):
+        """
+        The thread is usually given a parent, so that it is not destroyed if
+        the window that started it is closed before the scan finishes.
+        """
+        self.port_discovery = port_discovery
+        self.force = force
+        self.ports = []
+        QThread.__init__(self, parent)
+
+    def run(self):
+        self.ports = self.port_discovery.discover(self.force)
+        self.emit(SIGNAL('threadExit()'))
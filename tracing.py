@@ -0,0 +1,143 @@
+"""
+Module containing functions to record the stages that a message passes
+through on its way to the modem, & a summary of where the time goes.
+
+A message's trace is a list of (stage, time) tuples kept in
+message_data.trace, (see msgstore.Message) where the stages are:
+
+received       - the HTTP request was received
+validated      - the request was checked & the message is about to be queued
+enqueued       - the message was put in the send queue
+dequeued       - the sender took the message from the queue
+requeued       - the message was put back in the queue to be tried again
+mutex_acquired - the sender got the serial port to send the message
+written        - the text of the message was written to the modem
+acknowledged   - the modem answered that the message was sent
+
+The times come from "monotonic", so only the differences between them mean
+anything. message_data.trace_start is the wall clock time of the first
+stage.
+"""
+
+# Standard library modules
+import sys
+import threading
+import time
+
+# The number of recent durations kept for each step of the summary, from
+# which the percentiles are worked out
+SUMMARY_SAMPLES = 1000
+
+# time.clock is a high resolution timer that never goes backwards on Windows.
+# Python 2 has no monotonic clock elsewhere, so time.time is used instead.
+if sys.platform == 'win32':
+    monotonic = time.clock
+else:
+    monotonic = time.time
+
+def start(message_data, stage, now=None):
+    """
+    Starts the trace of a message with its first stage.
+    """
+    if now is None:
+        now = monotonic()
+    message_data.trace = [(stage, now)]
+    message_data.trace_start = time.time()
+
+
+def stage(message_data, stage, now=None):
+    """
+    Records that a message has reached a stage. A message without a trace,
+    (i.e. one that was queued before the last restart) starts one.
+    """
+    if now is None:
+        now = monotonic()
+    if message_data.trace is None:
+        start(message_data, stage, now)
+    else:
+        message_data.trace.append((stage, now))
+
+
+def steps(trace):
+    """
+    Returns the time taken by each step of a trace, as a list of (step name,
+    seconds) where the step name is the two stages, (i.e.
+    "enqueued-dequeued").
+    """
+    return [('%s-%s' % (trace[i][0], trace[i + 1][0]), trace[i + 1][1] - trace[i][1])
+            for i in range(len(trace) - 1)]
+
+
+def trace_record(message_data, status):
+    """
+    Returns a compact record of a finished message's trace for the trace
+    file: the stages are given as offsets (in seconds) from the start.
+    """
+    trace = message_data.trace or []
+    first = trace and trace[0][1] or 0
+    return {'id': message_data.id,
+            'status': status,
+            'start': message_data.trace_start,
+            'stages': [[name, round(when - first, 6)] for name, when in trace]}
+
+
+class TraceSummary(object):
+    """
+    Collects the step times of finished messages, so that it can be seen
+    which steps take the time. For each step the count, total & maximum are
+    kept, along with the most recent SUMMARY_SAMPLES times for percentiles.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+
+        # Keyed on step name: [count, total, maximum, recent times, next
+        # position in recent times]
+        self.steps = {}
+
+    def add(self, trace):
+        if not trace:
+            return
+        self.lock.acquire()
+        try:
+            for name, seconds in steps(trace):
+                step = self.steps.get(name)
+                if step is None:
+                    step = self.steps[name] = [0, 0.0, 0.0, [], 0]
+                step[0] += 1
+                step[1] += seconds
+                step[2] = max(step[2], seconds)
+                if len(step[3]) < SUMMARY_SAMPLES:
+                    step[3].append(seconds)
+                else:
+                    step[3][step[4]] = seconds
+                    step[4] = (step[4] + 1) % SUMMARY_SAMPLES
+        finally:
+            self.lock.release()
+
+    def summary(self):
+        """
+        Returns a list of dictionaries with the "step", "count", "total",
+        "mean", "p50", "p95" & "max" (in seconds) of each step, with the step
+        that has taken the most time in total first.
+        """
+        self.lock.acquire()
+        try:
+            steps = [(name, step[0], step[1], step[2], sorted(step[3])) for name, step in self.steps.items()]
+        finally:
+            self.lock.release()
+
+        summary = []
+        for name, count, total, maximum, recent in steps:
+            summary.append({'step': name,
+                            'count': count,
+                            'total': total,
+                            'mean': total / count,
+                            'p50': recent[len(recent) // 2],
+                            'p95': recent[min(int(len(recent) * 0.95), len(recent) - 1)],
+                            'max': maximum})
+        summary.sort(key=lambda x: x['total'], reverse=True)
+        return summary
+
+
+# The summary of every message traced by the gateway
+SUMMARY = TraceSummary()
@@ -3,11 +3,19 @@ Module containing utility functions and classes.
 """
 
 # Standard library modules
+import collections
 import datetime
 import os
 import Queue
+import threading
 import time
 
+# The json module was added in Python 2.6, use simplejson with Python 2.5
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
 class CustomQueue(Queue.Queue):
     """
     Subclass of Queue.Queue to provide the ability to add an item to the front
@@ -15,7 +23,37 @@ class CustomQueue(Queue.Queue):
     error occurs when processing the item. If processing may continue at a
     later time then the item should be put at the front of the queue until
     processing is resumed.
+
+    A backlog of items can also be placed ahead of the rest of the queue,
+    (see "set_backlog").
     """
+    def _init(self, maxsize):
+        Queue.Queue._init(self, maxsize)
+
+        # The items put at the front of the queue & the backlog, which are
+        # both taken before the rest of the queue
+        self.front = collections.deque()
+        self.backlog = None
+
+    def _qsize(self, len=len):
+        size = len(self.front) + len(self.queue)
+        if self.backlog is not None:
+            size += len(self.backlog)
+        return size
+
+    def _empty(self):
+        return not self._qsize()
+
+    def _full(self):
+        return self.maxsize > 0 and self._qsize() >= self.maxsize
+
+    def _get(self):
+        if self.front:
+            return self.front.popleft()
+        if self.backlog:
+            return self.backlog.next()
+        return self.queue.popleft()
+
     def put(self, item, block=True, timeout=None, front=False):
         """
         To put an item at the front of the queue use:
@@ -39,7 +77,7 @@ class CustomQueue(Queue.Queue):
                         raise Full
                     self.not_full.wait(remaining)
             if front:
-                self.queue.appendleft(item)
+                self.front.appendleft(item)
             else:
                 self.queue.append(item)
             self.unfinished_tasks += 1
@@ -47,6 +85,72 @@ class CustomQueue(Queue.Queue):
         finally:
             self.not_full.release()
 
+    def set_backlog(self, backlog):
+        """
+        Places a backlog of items ahead of the rest of the queue, (but behind
+        the items put at the front). The backlog has a length & gives up its
+        items one at a time from its "next" method, so they are only built as
+        they are taken, (see snapshot.Backlog).
+        """
+        self.mutex.acquire()
+        try:
+            self.backlog = backlog
+            self.unfinished_tasks += len(backlog)
+            self.not_empty.notifyAll()
+        finally:
+            self.mutex.release()
+
+    def items(self):
+        """
+        Returns a list of the items in the queue, in the order they are taken,
+        without taking them.
+        """
+        self.mutex.acquire()
+        try:
+            items = list(self.front)
+            if self.backlog:
+                items.extend(self.backlog.remaining())
+            items.extend(self.queue)
+            return items
+        finally:
+            self.mutex.release()
+
+
+class EventBuffer(object):
+    """
+    Thread-safe buffer used by worker threads to pass events to the GUI thread.
+    Adding an event only appends to a list, so a worker thread never waits on
+    the GUI. The GUI periodically drains the buffer and applies all of the
+    pending events in one batch.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.events = []
+
+    def put(self, event_type, data=None):
+        """
+        Adds an event to the buffer. The "event_type" is a short string that
+        identifies how the GUI should handle the "data".
+        """
+        self.lock.acquire()
+        try:
+            self.events.append((event_type, data))
+        finally:
+            self.lock.release()
+
+    def drain(self):
+        """
+        Removes all of the events from the buffer and returns them as a list of
+        (event_type, data) tuples, in the order they were added.
+        """
+        self.lock.acquire()
+        try:
+            events = self.events
+            self.events = []
+        finally:
+            self.lock.release()
+        return events
+
 
 def get_http_expiry(days):
     """
@@ -73,3 +177,16 @@ def secs_from_days(days):
     (i.e. 1 returns 86400)
     """
     return 86400 * days
+
+
+def utf8(value):
+    """
+    Returns a value decoded from JSON as a byte string, the same as the text
+    of messages received from the web form. Unicode strings are encoded as
+    UTF-8 & numbers are formatted, (i.e. 1234 returns "1234").
+    """
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if value is None:
+        return ''
+    return str(value)
@@ -0,0 +1,192 @@
+"""
+Module containing a thread that forwards the messages received by the modem
+to a webhook URL.
+"""
+
+# Standard library modules
+import heapq
+import httplib
+import Queue
+import socket
+import threading
+import time
+import urlparse
+
+# Local application modules
+import util
+
+# How long (in seconds) to wait for the webhook to respond
+WEBHOOK_TIMEOUT = 10
+
+# The delay (in seconds) before the first retry of a failed request. The
+# delay doubles with each attempt, up to MAX_RETRY_DELAY.
+RETRY_DELAY = 5
+MAX_RETRY_DELAY = 3600
+
+class WebhookSender(threading.Thread):
+    """
+    Background thread that POSTs received messages to a webhook URL as JSON.
+    Requests that fail are retried with an exponentially increasing delay, so
+    messages are not lost while the webhook is down. The HTTP connection is
+    kept open between requests.
+    """
+    def __init__(self, url='', forwarded=None):
+        """
+        The "forwarded" parameter is a function that is called with the
+        message ID & None once a message has been accepted by the webhook, or
+        with the message ID & an error message when an attempt fails.
+        """
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+
+        self.forwarded = forwarded
+        self.queue = Queue.Queue()
+
+        # Messages waiting to be retried, as a heap of (due time, sequence
+        # number, attempts, inbound data). The sequence number keeps messages
+        # that are due at the same time in the order they were received.
+        self.retries = []
+        self.sequence = 0
+
+        self.conn = None
+        self.conn_target = None
+        self.set_url(url)
+
+        # Set before the thread starts so that an early "stop" is not lost
+        self.keep_running = True
+
+    def set_url(self, url):
+        """
+        Changes the webhook URL. The change is applied by the thread before
+        its next request.
+        """
+        parts = urlparse.urlsplit(url)
+        path = parts[2] or '/'
+        if parts[3]:
+            path += '?' + parts[3]
+        self.url = url
+        self.target = (parts[0].lower(), parts[1], path)
+
+    def forward(self, inbound_data):
+        """
+        Queues a received message to be sent to the webhook.
+        """
+        self.queue.put((0, inbound_data))
+
+    def run(self):
+        """
+        Starts the thread which sends the queued messages to the webhook.
+        """
+        while self.keep_running:
+
+            # Wait for a new message or for the next retry to become due,
+            # checking at least once a second whether the thread should stop
+            timeout = 1
+            if self.retries:
+                timeout = min(max(self.retries[0][0] - time.time(), 0), 1)
+            due = []
+            try:
+                due.append(self.queue.get(timeout=timeout))
+                while True:
+                    due.append(self.queue.get_nowait())
+            except Queue.Empty:
+                pass
+
+            now = time.time()
+            while self.retries and self.retries[0][0] <= now:
+                due_time, sequence, attempts, inbound_data = heapq.heappop(self.retries)
+                due.append((attempts, inbound_data))
+
+            while due and self.keep_running:
+                attempts, inbound_data = due.pop(0)
+                if not self.url:
+                    self.retry(attempts, inbound_data)
+                    continue
+
+                error = self.post(inbound_data)
+                if self.forwarded is not None:
+                    self.forwarded(inbound_data['id'], error)
+                if error is not None:
+
+                    # The webhook is failing, so the rest of the batch waits
+                    # for the next retry rather than failing in turn
+                    self.retry(attempts, inbound_data)
+                    for attempts, inbound_data in due:
+                        self.retry(attempts, inbound_data)
+                    due = []
+
+        self.close()
+
+    def stop(self):
+        """
+        Stops the thread. Messages that have not been forwarded are left in
+        the message database & are forwarded after the next start.
+        """
+        self.keep_running = False
+
+    def retry(self, attempts, inbound_data):
+        """
+        Schedules another attempt at sending a message.
+        """
+        delay = min(RETRY_DELAY * 2 ** min(attempts, 16), MAX_RETRY_DELAY)
+        self.sequence += 1
+        heapq.heappush(self.retries, (time.time() + delay, self.sequence, attempts + 1, inbound_data))
+
+    def post(self, inbound_data):
+        """
+        Sends a message to the webhook. Returns None if the webhook accepted
+        it, otherwise an error message.
+        """
+        body = util.json.dumps({'id': inbound_data['id'],
+                                'sender': inbound_data['sender'],
+                                'message': inbound_data['message'],
+                                'sent_at': inbound_data['sent_at'],
+                                'received_at': inbound_data['time']})
+
+        # A kept-alive connection may have been closed by the server since the
+        # last request, so a request that fails on an existing connection is
+        # tried once more on a new connection
+        for attempt in range(2):
+            reused = self.conn is not None and self.conn_target == self.target
+            try:
+                if not reused:
+                    self.connect()
+                self.conn.request('POST', self.target[2], body, {'Content-Type': 'application/json'})
+                response = self.conn.getresponse()
+                response.read()
+            except (socket.error, httplib.HTTPException), e:
+                self.close()
+                if reused:
+                    continue
+                return 'Could not connect to the webhook (%s)' % (str(e) or e.__class__.__name__)
+
+            if response.will_close:
+                self.close()
+            if 200 <= response.status < 300:
+                return None
+            return 'The webhook returned an error (%d %s)' % (response.status, response.reason)
+
+    def connect(self):
+        self.close()
+        scheme, host, path = self.target
+        if scheme == 'https':
+            connection_class = httplib.HTTPSConnection
+        else:
+            connection_class = httplib.HTTPConnection
+
+        # The timeout also applies to connecting, so that an unreachable host
+        # does not hold up the thread. Python 2.5 only has the socket timeout,
+        # which is set once connected.
+        try:
+            conn = connection_class(host, timeout=WEBHOOK_TIMEOUT)
+        except TypeError:
+            conn = connection_class(host)
+        conn.connect()
+        conn.sock.settimeout(WEBHOOK_TIMEOUT)
+        self.conn = conn
+        self.conn_target = self.target
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None